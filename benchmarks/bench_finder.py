@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Finder benchmarks on a synthetic TAP result: segmentation (_segment) of a
+large calibration query, and marking (_mark_as) and stacking
+(astropy.table.vstack) the tables of each frame type, as in Finder.run.
+"""
+import functools
+import astropy.table
+import numpy as np
+from niriPipe.utils.finder import Finder
+
+MJD_DATE = 58578.5
+
+
+def get_state():
+    return {
+        'config': {
+            'DATAFINDER': {
+                'min_objects': '1',
+                'min_flats': '1',
+                'min_longdarks': '1',
+                'min_shortdarks': '1'
+            }
+        },
+        'current_stack': {
+            'obs_name': 'GN-2019A-FT-108-12',
+            'bandpass': 'J',
+            'mjd_date': MJD_DATE
+        }
+    }
+
+
+def tap_table(n_observations=50, frames_per_observation=20, seed=0):
+    """
+    A table like a TAP query for calibrations returns: several
+    observations on nights around MJD_DATE, with consecutive frames.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for obs in range(n_observations):
+        night = 20190404 + obs // 5
+        start = MJD_DATE + rng.uniform(-30, 30)
+        for frame in range(1, frames_per_observation + 1):
+            number = obs * frames_per_observation + frame
+            obs_id = 'GN-CAL{}-{}-{:03d}'.format(night, obs % 5 + 1, frame)
+            product_id = 'N{}S{:04d}'.format(night, number)
+            rows.append((
+                'ivo://cadc.nrc.ca/GEMINI?{}/{}'.format(obs_id, product_id),
+                product_id, 'J', start + frame * 1e-3, 20.0, 'FLAT',
+                'calibration', 'GN-CAL{}'.format(night), obs_id))
+    return astropy.table.Table(
+        rows=rows,
+        names=[
+            'publisherID', 'productID', 'energy_bandpassName',
+            'time_bounds_lower', 'time_exposure', 'type', 'intent',
+            'proposal_id', 'observationID'])
+
+
+def mark_and_stack(finder, tables):
+    return astropy.table.vstack([
+        finder._mark_as(frame_type, table)
+        for frame_type, table in tables.items()
+    ])
+
+
+def fresh_tables(tables):
+    # _mark_as adds a column in place, so each round needs new tables.
+    return (), {'tables': {
+        frame_type: table.copy() for frame_type, table in tables.items()}}
+
+
+def bench_segment(benchmark):
+    finder = Finder(get_state())
+    table = tap_table()
+    out_table = benchmark(finder._segment, table)
+    assert len(out_table) == 20
+
+
+def bench_mark_as_vstack(benchmark):
+    finder = Finder(get_state())
+    tables = {
+        'object': tap_table(n_observations=1, seed=1),
+        'flat': tap_table(n_observations=2, seed=2),
+        'longdark': tap_table(n_observations=2, seed=3),
+        'shortdark': tap_table(n_observations=1, seed=4),
+    }
+    out_table = benchmark.pedantic(
+        functools.partial(mark_and_stack, finder),
+        setup=functools.partial(fresh_tables, tables),
+        rounds=50)
+    assert len(out_table) == 120
+    assert set(out_table['niriPipe_type']) == set(tables)
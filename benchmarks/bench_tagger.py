@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Tagger benchmarks on a realistic 4-HDU (PHU + SCI/VAR/DQ) stack.
+
+Compares the previous approach (one astropy.io.fits.setval call, so one
+open, per keyword) with the single-pass Tagger, both when the header has
+to grow and when blank cards were reserved for the new keywords. Also
+times Tagger.run on a full set of products with checksums, as in a run.
+"""
+import functools
+import os
+import shutil
+import astropy.io.fits as fits
+from niriPipe.utils.tagger import Tagger
+
+
+def get_state():
+    return {
+        'config': {
+            'DATAFINDER': {
+                'min_objects': '1',
+                'min_flats': '0',
+                'min_longdarks': '0',
+                'min_shortdarks': '0'
+            }
+        }
+    }
+
+
+def setval_per_keyword(filename):
+    tagger = Tagger(
+        products={'processed_bpm': 'N2019_bpm.fits'}, state=get_state())
+    for keyword, value, comment in tagger._cards():
+        fits.setval(
+            filename, keyword, value=value,
+            extname='PRIMARY', comment=comment)
+
+
+def single_pass(filename):
+    Tagger(
+        products={
+            'processed_stack': filename,
+            'processed_bpm': 'N2019_bpm.fits'},
+        state=get_state()
+    ).run()
+
+
+def bench_setval_per_keyword(benchmark, fresh_copy, stack_template):
+    benchmark.pedantic(
+        setval_per_keyword,
+        setup=functools.partial(fresh_copy, stack_template),
+        rounds=10)
+
+
+def bench_single_pass(benchmark, fresh_copy, stack_template):
+    benchmark.pedantic(
+        single_pass,
+        setup=functools.partial(fresh_copy, stack_template),
+        rounds=10)
+
+
+def bench_single_pass_reserved(
+        benchmark, fresh_copy, reserved_stack_template):
+    benchmark.pedantic(
+        single_pass,
+        setup=functools.partial(fresh_copy, reserved_stack_template),
+        rounds=10)
+
+
+def tag_all_products(products):
+    state = get_state()
+    for key in ['min_flats', 'min_longdarks', 'min_shortdarks']:
+        state['config']['DATAFINDER'][key] = '1'
+    state['config']['TAGGING'] = {'checksum': 'True'}
+    Tagger(products=products, state=state).run()
+
+
+def bench_run_all_products(benchmark, tmp_path, reserved_stack_template):
+    def setup():
+        products = {}
+        for name in ['stack', 'flat', 'dark', 'bpm']:
+            products['processed_' + name] = shutil.copyfile(
+                reserved_stack_template,
+                os.path.join(str(tmp_path), 'N2019_{}.fits'.format(name)))
+        return (products,), {}
+
+    benchmark.pedantic(tag_all_products, setup=setup, rounds=5)
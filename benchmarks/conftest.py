@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+import glob
+import os
+import shutil
+import numpy as np
+import pytest
+import pytest_benchmark.utils
+import astropy.io.fits as fits
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+# Pinned baselines are committed here, per machine and Python version.
+BASELINE_DIR = os.path.join(THIS_DIR, 'baselines')
+BASELINE = '0001'
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--benchmark-rebaseline', action='store_true', default=False,
+        help='Replace this machine\'s pinned baseline with this run.')
+    parser.addoption(
+        '--benchmark-no-baseline', action='store_true', default=False,
+        help='Only report timings if this machine has no pinned baseline, '
+             'instead of failing.')
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    """
+    Compare with this machine's pinned baseline (benchmarks/baselines,
+    whichever directory pytest is run from), or with --benchmark-rebaseline,
+    make this run the new baseline.
+
+    On a machine without a baseline the run fails, as the regression
+    gate would be off; with --benchmark-no-baseline it only reports
+    timings, and says so in the summary.
+    """
+    storage = config.getoption('benchmark_storage', None)
+    if storage is None:
+        return
+    if storage == 'file://./.benchmarks':
+        storage = 'file://' + BASELINE_DIR
+        config.option.benchmark_storage = storage
+    if not storage.startswith('file://'):
+        return
+    machine_dir = os.path.join(
+        storage[len('file://'):], pytest_benchmark.utils.get_machine_id())
+
+    if config.getoption('benchmark_rebaseline'):
+        # Saved runs are numbered from 0001 in an empty directory.
+        if os.path.isdir(machine_dir):
+            shutil.rmtree(machine_dir)
+        config.option.benchmark_save = 'baseline'
+        config.option.benchmark_compare = False
+        config.option.benchmark_compare_fail = []
+    elif config.option.benchmark_compare == BASELINE and not glob.glob(
+            os.path.join(machine_dir, BASELINE + '_*.json')):
+        if not config.getoption('benchmark_no_baseline'):
+            raise pytest.UsageError(
+                "No pinned benchmark baseline in {}. Pin one with "
+                "--benchmark-rebaseline and commit it, or run with "
+                "--benchmark-no-baseline to only report timings.".format(
+                    machine_dir))
+        config.option.benchmark_compare = False
+        config.option.benchmark_compare_fail = []
+        config._missing_baseline = machine_dir
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    machine_dir = getattr(config, '_missing_baseline', None)
+    if machine_dir:
+        terminalreporter.write_sep(
+            '=', "NOT compared with a baseline: none pinned in {}".format(
+                machine_dir), yellow=True, bold=True)
+
+
+def write_stack(filename, shape=(1024, 1024), n_cards=300, reserve=0):
+    """
+    Write a realistic DRAGONS-like NIRI stack: a primary header with
+    n_cards keywords and SCI, VAR and DQ extensions.
+
+    The primary header is filled up to the end of its last block, apart
+    from 'reserve' blank cards.
+    """
+    rng = np.random.default_rng(42)
+    phu = fits.PrimaryHDU()
+    for i in range(n_cards):
+        phu.header['HIERARCH NIRI KEY{}'.format(i)] = (i, 'Fake keyword')
+    free = -(len(phu.header) + 1) % 36
+    for i in range(free - reserve):
+        phu.header['HIERARCH NIRI PAD{}'.format(i)] = i
+    for i in range(reserve):
+        phu.header.add_blank()
+
+    sci = rng.normal(1000, 30, shape).astype(np.float32)
+    hdul = fits.HDUList([
+        phu,
+        fits.ImageHDU(sci, name='SCI'),
+        fits.ImageHDU(np.abs(sci) / 2.0, name='VAR'),
+        fits.ImageHDU(
+            (rng.random(shape) < 0.01).astype(np.uint16), name='DQ'),
+    ])
+    hdul.writeto(filename, overwrite=True)
+    return filename
+
+
+@pytest.fixture(scope='session')
+def stack_template(tmp_path_factory):
+    """
+    A 4-HDU 1024x1024 stack whose primary header has no room left.
+    """
+    return write_stack(
+        str(tmp_path_factory.mktemp('templates') / 'full_stack.fits'))
+
+
+@pytest.fixture(scope='session')
+def reserved_stack_template(tmp_path_factory):
+    """
+    Like stack_template, but with blank cards reserved for tagging.
+    """
+    return write_stack(
+        str(tmp_path_factory.mktemp('templates') / 'reserved_stack.fits'),
+        reserve=8)
+
+
+@pytest.fixture
+def fresh_copy(tmp_path):
+    """
+    Returns a function giving a fresh copy of a template per round.
+    """
+    def _copy(template):
+        dest = str(tmp_path / os.path.basename(template))
+        shutil.copyfile(template, dest)
+        return (dest,), {}
+    return _copy
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+End-to-end scaling benchmark: 'niriPipe run' on synthetic stacks served by
+the local CADC stand-in, sweeping the number of frames, worker threads
+and cache state.
+
+    python benchmarks/scaling.py --frames 10 100 --workers 1 4
+
+For each frame count, a synthetic dataset (that many object frames,
+flats and darks) is generated and served locally. Each combination of
+worker count and cache state is then run in a fresh process:
+
+- cold: new, empty header, download and calibration caches;
+- warm: the caches the cold run just filled.
+
+Per-stage wall times and bytes moved come from the run's trace; peak RSS
+from the operating system. Results are printed as a table and written as
+JSON (--output). Runs are kept under --directory for inspection.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import niriPipe.utils.localcadc
+import niriPipe.utils.synthetic
+
+STAGES = ['finder', 'downloader', 'reducer', 'tagger', 'checker']
+OBS_NAME = 'GN-2019A-FT-108-12'
+
+CONFIG = """\
+[DATAFINDER]
+min_objects = {frames}
+min_flats = {frames}
+min_longdarks = {frames}
+min_shortdarks = 0
+header_cache = {cache}/headers
+
+[DATARETRIEVAL]
+dataSource = {url}
+cache_path = {cache}/rawData
+
+[REDUCTION]
+calibration_cache = {cache}/calibrations
+
+[TAGGING]
+max_workers = {workers}
+
+[CHECKING]
+max_workers = {workers}
+
+[TRACING]
+trace_file = trace.jsonl
+
+[METRICS]
+textfile = niriPipe.prom
+"""
+
+RUN = "import sys, niriPipe.niriReduce as n; sys.argv[0] = 'niriPipe'; " \
+    "n.niri_reduce_main()"
+
+
+def run_pipeline(directory, configfile):
+    """
+    Run the pipeline in a fresh process; returns its return code (0 if it
+    succeeded, -N if signal N killed it), wall time and peak RSS (MB).
+    """
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'stdout.log'), 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-c', RUN, 'run', OBS_NAME, 'science', 'J',
+             '-c', configfile],
+            cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+        # wait4() gives the resource usage of this process alone. It reaps
+        # the process, so Popen never sees its status; set it as wait()
+        # would.
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kB on Linux.
+    return process.returncode, wall, rusage.ru_maxrss / 1024
+
+
+def summarize_trace(filename):
+    """
+    Stage durations and bytes moved, from a run's trace.
+    """
+    summary = {'stages': {}, 'downloaded_mb': 0.0, 'from_cache_mb': 0.0}
+    if not os.path.exists(filename):
+        return summary
+    with open(filename) as f:
+        for line in f:
+            span = json.loads(line)
+            attributes = span['attributes']
+            if span['name'] in STAGES:
+                summary['stages'][span['name']] = span['duration']
+            elif span['name'] == 'download':
+                key = 'from_cache_mb' if attributes.get('cached') \
+                    else 'downloaded_mb'
+                summary[key] += attributes.get('bytes', 0) / 1e6
+    return summary
+
+
+def sweep(directory, frame_counts, worker_counts, cache_states, size):
+    results = []
+    for frames in frame_counts:
+        data = os.path.join(directory, 'data_{}'.format(frames))
+        niriPipe.utils.synthetic.Generator(data, shape=(size, size)).run(
+            obs_name=OBS_NAME, n_objects=frames, n_flats=frames,
+            n_longdarks=frames)
+        catalog = niriPipe.utils.localcadc.read_catalog(
+            os.path.join(data, niriPipe.utils.synthetic.CATALOG_NAME))
+        with niriPipe.utils.localcadc.LocalCadc(catalog) as server:
+            for workers in worker_counts:
+                cache = os.path.join(
+                    directory, 'cache_{}_{}'.format(frames, workers))
+                for cache_state in cache_states:
+                    if cache_state == 'cold' and os.path.exists(cache):
+                        shutil.rmtree(cache)
+                    name = 'run_{}_{}_{}'.format(frames, workers, cache_state)
+                    configfile = os.path.join(directory, name + '.cfg')
+                    with open(configfile, 'w') as f:
+                        f.write(CONFIG.format(
+                            frames=frames, cache=cache, url=server.url,
+                            workers=workers))
+                    returncode, wall, rss = run_pipeline(
+                        os.path.join(directory, name), configfile)
+                    result = dict(
+                        frames=frames, workers=workers, cache=cache_state,
+                        succeeded=returncode == 0, wall=wall,
+                        peak_rss_mb=rss)
+                    result.update(summarize_trace(
+                        os.path.join(directory, name, 'trace.jsonl')))
+                    results.append(result)
+                    print_row(result)
+    return results
+
+
+def print_header():
+    print('{:>6} {:>7} {:>5} {:>6} {:>8} '.format(
+        'frames', 'workers', 'cache', 'ok', 'wall') +
+        ' '.join('{:>10}'.format(stage) for stage in STAGES) +
+        ' {:>8} {:>9} {:>9}'.format('rss_mb', 'down_mb', 'cache_mb'))
+
+
+def print_row(result):
+    print('{frames:>6} {workers:>7} {cache:>5} {ok:>6} {wall:>8.1f} '.format(
+        ok='yes' if result['succeeded'] else 'no', **result) +
+        ' '.join(
+            '{:>10.1f}'.format(result['stages'][stage])
+            if stage in result['stages'] else '{:>10}'.format('-')
+            for stage in STAGES) +
+        ' {:>8.0f} {:>9.1f} {:>9.1f}'.format(
+            result['peak_rss_mb'], result['downloaded_mb'],
+            result['from_cache_mb']))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, nargs='+', default=[10, 100],
+                        help='Object frames (and flats, and darks) per run.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+                        help='Tagger and Checker worker threads.')
+    parser.add_argument('--cache', nargs='+', default=['cold', 'warm'],
+                        choices=['cold', 'warm'],
+                        help='Cache states; warm runs reuse the caches of '
+                             'the cold run before them.')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Frames are SIZE x SIZE pixels.')
+    parser.add_argument('-d', '--directory', default='scaling',
+                        help='Where to keep datasets and runs.')
+    parser.add_argument('-o', '--output', default='scaling.json',
+                        help='JSON results file.')
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    os.makedirs(directory, exist_ok=True)
+    print_header()
+    results = sweep(
+        directory, args.frames, args.workers, args.cache, args.size)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
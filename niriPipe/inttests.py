@@ -68,10 +68,12 @@ import os
 import logging
 import hashlib
 from pathlib import Path
+import niriPipe.utils.archive
 import niriPipe.utils.downloader
 from niriPipe.utils.finder import Finder
 from niriPipe.utils.reducer import Reducer
 import niriPipe.utils.customLogger
+from niriPipe.utils.customLogger import Lazy
 from niriPipe.utils.state import get_initial_state
 import astropy.table
 import shutil
@@ -96,13 +98,20 @@ def md5_of_dir(directory):
     return tmp_hash.hexdigest()
 
 
-def downloader_inttest():
+def _query(query, datasource):
+    if datasource:
+        return niriPipe.utils.archive.tap_query(datasource, query)
+    return Finder._do_query(query)
+
+
+def downloader_inttest(datasource=None):
     """
     Test by downloading all science data from GN-2019A-FT-108.
 
     Uses a hard-coded hash; liable to break if CADC files change.
 
-
+    datasource is the URL to use instead of the live CADC (e.g. a
+    niriPipe.utils.cassette.Cassette).
     """
     query = \
         "SELECT observationID, publisherID, productID " +\
@@ -115,7 +124,7 @@ def downloader_inttest():
         "AND proposal_id = 'GN-2019A-FT-108'"
 
     try:
-        table = Finder._do_query(query)
+        table = _query(query, datasource)
     except Exception:
         module_logger.exception("Problem getting table from CADC.")
         raise RuntimeError("Problem getting table from CADC.")
@@ -124,7 +133,8 @@ def downloader_inttest():
             'current_working_directory': os.getcwd(),
             'config': {
                 'DATARETRIEVAL': {
-                    'raw_data_path': 'rawData'
+                    'raw_data_path': 'rawData',
+                    'datasource': datasource or 'CADC'
                 }
             }
         }
@@ -148,7 +158,7 @@ def downloader_inttest():
             "than the expected value of '0d6ae285dcdb60904561aca79618afef'.")
 
 
-def finder_inttest():
+def finder_inttest(datasource=None):
     """
     Make sure the Finder class can find NIRI data.
     """
@@ -169,7 +179,10 @@ def finder_inttest():
                 'min_flats': '1',
                 'min_longdarks': '1',
                 'min_shortdarks': '1',
-                'max_tries': 30,
+                'max_tries': 30
+            },
+            'DATARETRIEVAL': {
+                'datasource': datasource or 'CADC'
             }
         },
         'current_stack': {
@@ -186,8 +199,8 @@ def finder_inttest():
     table = CADC_data_finder.run()
     table.sort(['productID'])
 
-    module_logger.debug("Resulting table:")
-    module_logger.debug('\n'+'\n'.join(table.pformat_all()))
+    module_logger.debug("Resulting table:\n%s", Lazy(
+        lambda: '\n'.join(table.pformat_all())))
 
     # Object frames
     desired_frames = \
@@ -244,6 +257,9 @@ def finder_inttest():
                 'min_longdarks': '1',
                 'min_shortdarks': '1',
                 'max_tries': 30
+            },
+            'DATARETRIEVAL': {
+                'datasource': datasource or 'CADC'
             }
         },
         'current_stack': {
@@ -259,8 +275,8 @@ def finder_inttest():
     CADC_data_finder = Finder(state=state)
     table = CADC_data_finder.run()
 
-    module_logger.debug("Resulting table:")
-    module_logger.debug('\n'+'\n'.join(table.pformat_all()))
+    module_logger.debug("Resulting table:\n%s", Lazy(
+        lambda: '\n'.join(table.pformat_all())))
 
     for frame in desired_frames:
         assert frame in table['productID'], "Frame {} not found.".format(frame)
@@ -270,7 +286,7 @@ def finder_inttest():
         "Desired {} frames, found {}.".format(len(desired_frames), len(table)))
 
 
-def run_inttest():
+def run_inttest(datasource=None):
     """
     Make sure reductions are working and making sense.
     """
@@ -290,6 +306,8 @@ def run_inttest():
     # Create a custom bad pixel mask, just to test all code paths.
     with open('custom_config.cfg', 'w') as f:
         f.write('[DATAFINDER]\nmin_shortdarks = 1\n')
+        if datasource:
+            f.write('[DATARETRIEVAL]\ndatasource = {}\n'.format(datasource))
     args.config = [os.path.join(os.getcwd(), 'custom_config.cfg')]
 
     products = niriPipe.niriReduce.run_main(args)
@@ -310,7 +328,7 @@ def run_inttest():
     module_logger.info("Run inttest suceeded!")
 
 
-def run_reduce_inttest():
+def run_reduce_inttest(datasource=None):
     """
     Do a test data reduction (subset of GN-2019A-FT-108-12)
 
@@ -320,9 +338,11 @@ def run_reduce_inttest():
     state = get_initial_state(
         obs_name=['GN-2019A-FT-108-12'], intent=['science'], bandpass='J')
     state['config']['DATAFINDER']['min_shortdarks'] = 1
+    if datasource:
+        state['config']['DATARETRIEVAL']['datasource'] = datasource
 
-    module_logger.debug("Initial state:")
-    module_logger.debug(json.dumps(state, sort_keys=True, indent=4))
+    module_logger.debug("Initial state:\n%s", Lazy(
+        json.dumps, state, sort_keys=True, indent=4))
 
     # Construct astropy table of required files
     table = astropy.table.Table([
@@ -1,96 +1,204 @@
 import argparse
-import niriPipe.inttests
+import contextlib
+import niriPipe.utils.batch
+import niriPipe.utils.diskbudget
+import niriPipe.utils.metrics
+import niriPipe.utils.profiling
 import niriPipe.utils.state
 import niriPipe.utils.customLogger
-import niriPipe.utils.downloader
-import niriPipe.utils.finder
-import niriPipe.utils.reducer
-import niriPipe.utils.tagger
-import niriPipe.utils.checker
+import niriPipe.utils.tracing
+import niriPipe.utils.worker
 import logging
 import json
+import os
+import sys
+import time
 
 
 module_logger = niriPipe.utils.customLogger.get_logger(__name__)
 
 
+def import_stages():
+    """
+    Import the pipeline stages.
+
+    They pull in astroquery, cadcdata, astrodata and DRAGONS, which take
+    seconds to import, so they're only imported by subcommands that run a
+    pipeline; --help, argument errors and 'submit' stay fast.
+    """
+    import niriPipe.utils.finder  # noqa: F401
+    import niriPipe.utils.downloader  # noqa: F401
+    import niriPipe.utils.reducer  # noqa: F401
+    import niriPipe.utils.tagger  # noqa: F401
+    import niriPipe.utils.checker  # noqa: F401
+
+
 def run_main(args):
     """
     Run a NIRI pipeline.
     """
-    if hasattr(args, 'verbose'):
+    if getattr(args, 'verbose', False):
         # Set niriPipe root logging level to DEBUG
         niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    niriPipe.utils.customLogger.set_format(
+        getattr(args, 'log_format', 'text'))
 
     module_logger.info("Starting NIRI pipeline.")
 
+    state = _initial_state(args)
+    profiler = niriPipe.utils.profiling.Profiler.from_environment()
+    if getattr(args, 'profile', None):
+        profiler = niriPipe.utils.profiling.Profiler(
+            directory=args.profile,
+            flamegraph=args.flamegraph or profiler.flamegraph)
+    if getattr(args, 'queue_logging', False):
+        niriPipe.utils.customLogger.start_queue_logging()
+    try:
+        return run_pipeline(state, profiler=profiler)
+    finally:
+        niriPipe.utils.customLogger.stop_queue_logging()
+
+
+def _initial_state(args):
+    """
+    Initial state for the stack given on the command line.
+    """
     # Get initial state
     if hasattr(args, 'config') and args.config:
         configfile = args.config
     else:
         configfile = None
-    state = niriPipe.utils.state.get_initial_state(
+    return niriPipe.utils.state.get_initial_state(
         obs_name=args.obsID,
         intent=args.intent,
         configfile=configfile,
         bandpass=args.bandpass
     )
-    module_logger.debug("Initial state:")
-    module_logger.debug(json.dumps(state, sort_keys=True, indent=4))
+
+
+def plan_main(args):
+    """
+    Plan a run without downloading or reducing anything; returns True if
+    the [DATAFINDER] requirements can be met.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+
+    import niriPipe.utils.planner
+    planner = niriPipe.utils.planner.Planner(_initial_state(args))
+    plan = planner.run()
+    planner.report(plan)
+    return plan['feasible']
+
+
+def run_pipeline(state, profiler=None):
+    """
+    Run the NIRI pipeline on one stack, given its initial state.
+
+    Each stage is profiled by profiler (a niriPipe.utils.profiling.Profiler;
+    by default, one set up from the environment), and traced to
+    [TRACING] trace_file if that is set. A snapshot of the metrics is
+    written to [METRICS] textfile at the end. With a [DISKBUDGET], the
+    stack's disk footprint is reserved before downloading and released at
+    the end.
+    """
+    import_stages()
+    if profiler is None:
+        profiler = niriPipe.utils.profiling.Profiler.from_environment()
+    niriPipe.utils.tracing.start_tracing(
+        state['config'].get('TRACING', {}).get('trace_file'))
+    profiler.start()
+    status = 'failed'
+    obs_name = state['current_stack'].get('obs_name')
+    try:
+        with niriPipe.utils.customLogger.log_context(stack=obs_name), \
+                niriPipe.utils.tracing.span(
+                    'pipeline', obs_name=obs_name):
+            products = _run_stages(state, profiler)
+        status = 'succeeded'
+        return products
+    finally:
+        niriPipe.utils.diskbudget.release(state)
+        profiler.finish()
+        niriPipe.utils.tracing.stop_tracing()
+        niriPipe.utils.metrics.STACKS.inc(status=status)
+        textfile = niriPipe.utils.metrics.from_state(state)
+        if textfile:
+            niriPipe.utils.metrics.REGISTRY.write_textfile(textfile)
+
+
+def _run_stages(state, profiler):
+    module_logger.debug("Initial state:\n%s", niriPipe.utils.customLogger.Lazy(
+        json.dumps, state, sort_keys=True, indent=4))
 
     # Create and run finder
     module_logger.info(
         "Starting data finder for observation {}".format(
             state['current_stack']['obs_name']))
-    try:
-        finder = niriPipe.utils.finder.Finder(state)
-        data_table = finder.run()
-    except Exception as e:
-        module_logger.critical("Datafinder failed!")
-        raise e
+    with _stage(profiler, 'finder') as span:
+        try:
+            finder = niriPipe.utils.finder.Finder(state)
+            data_table = finder.run()
+            span.set(rows=len(data_table))
+        except Exception as e:
+            module_logger.critical("Datafinder failed!")
+            raise e
     module_logger.info(
         "Finder succeeded; found {} files.".format(len(data_table)))
 
+    # Wait for room in the disk budget, if there is one.
+    niriPipe.utils.diskbudget.reserve(state, data_table)
+
     # Run downloader on found files
     module_logger.info("Starting downloader.")
-    try:
-        downloader = \
-            niriPipe.utils.downloader.Downloader(state=state, table=data_table)
-        downloader.download_query_cadc()
-    except Exception as e:
-        module_logger.critical("Downloader failed!")
-        raise e
+    with _stage(profiler, 'downloader'):
+        try:
+            downloader = niriPipe.utils.downloader.Downloader(
+                state=state, table=data_table)
+            downloader.download_query_cadc()
+        except Exception as e:
+            module_logger.critical("Downloader failed!")
+            raise e
     module_logger.info("Downloader succeeded.")
 
     # Setup and run Gemini DRAGONS.
     module_logger.info("Starting reducer.")
-    try:
-        reducer = niriPipe.utils.reducer.Reducer(state=state, table=data_table)
-        products = reducer.run()
-    except Exception as e:
-        logging.critical("Reducer failed!")
-        raise e
+    with _stage(profiler, 'reducer') as span:
+        try:
+            reducer = niriPipe.utils.reducer.Reducer(
+                state=state, table=data_table)
+            products = reducer.run()
+            span.set(products=sorted(
+                name for name, product in products.items() if product))
+        except Exception as e:
+            logging.critical("Reducer failed!")
+            raise e
     module_logger.info("Reducer succeeded.")
 
     # Add/modify metadata for CADC
     module_logger.info("Starting Tagger.")
-    try:
-        tagger = niriPipe.utils.tagger.Tagger(state=state, products=products)
-        products = tagger.run()
-    except Exception as e:
-        logging.critical("Tagger failed!")
-        raise e
+    with _stage(profiler, 'tagger'):
+        try:
+            tagger = niriPipe.utils.tagger.Tagger(
+                state=state, products=products,
+                ad_products=reducer.ad_products)
+            products = tagger.run()
+        except Exception as e:
+            logging.critical("Tagger failed!")
+            raise e
     module_logger.info("Tagger succeeded.")
 
     # Check to see if a "stack" was created.
     module_logger.info("Starting Checker.")
-    try:
-        checker = niriPipe.utils.checker.Checker(
-            products=products, state=state)
-        products = checker.run()
-    except Exception as e:
-        logging.critical("Checker failed!")
-        raise e
+    with _stage(profiler, 'checker'):
+        try:
+            checker = niriPipe.utils.checker.Checker(
+                products=products, state=state,
+                ad_products=reducer.ad_products)
+            products = checker.run()
+        except Exception as e:
+            logging.critical("Checker failed!")
+            raise e
     module_logger.info("Checker succeeded.")
 
     module_logger.info("Pipeline finished!")
@@ -98,6 +206,204 @@ def run_main(args):
     return products
 
 
+@contextlib.contextmanager
+def _stage(profiler, name):
+    """
+    Profile, time and trace one pipeline stage, tagging its log records
+    with the stage name; yields its span.
+    """
+    with profiler.stage(name), \
+            niriPipe.utils.metrics.STAGE_SECONDS.time(stage=name), \
+            niriPipe.utils.customLogger.log_context(stage=name), \
+            niriPipe.utils.tracing.span(name) as span:
+        yield span
+
+
+def batch_main(args):
+    """
+    Run the stacks in a manifest; returns True if all succeeded.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    niriPipe.utils.customLogger.set_format(args.log_format)
+    # Import once here, so the processes running stacks inherit the modules.
+    import_stages()
+
+    batch = niriPipe.utils.batch.Batch(
+        pipeline=run_pipeline,
+        stacks=niriPipe.utils.batch.read_manifest(args.manifest),
+        directory=args.directory,
+        processes=args.processes,
+        configfile=args.config[0] if args.config else None,
+        metrics_interval=args.metrics_interval,
+        queue_logging=args.queue_logging,
+        associate=args.associate
+    )
+    if args.queue_logging:
+        niriPipe.utils.customLogger.start_queue_logging()
+    try:
+        results = batch.run()
+    finally:
+        niriPipe.utils.customLogger.stop_queue_logging()
+    return all(result['succeeded'] for result in results)
+
+
+def worker_main(args):
+    """
+    Run queued stacks until drained.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    niriPipe.utils.customLogger.set_format(args.log_format)
+    # Import once here, so the processes running jobs inherit the modules.
+    import_stages()
+
+    worker = niriPipe.utils.worker.Worker(
+        pipeline=run_pipeline,
+        queue=niriPipe.utils.worker.JobQueue(args.queue),
+        directory=args.directory,
+        concurrency=args.concurrency,
+        configfile=args.config[0] if args.config else None,
+        poll_interval=args.poll_interval,
+        exit_when_empty=args.exit_when_empty,
+        metrics_interval=args.metrics_interval,
+        queue_logging=args.queue_logging
+    )
+    if args.queue_logging:
+        niriPipe.utils.customLogger.start_queue_logging()
+    try:
+        worker.run()
+    finally:
+        niriPipe.utils.customLogger.stop_queue_logging()
+
+
+def prefetch_main(args):
+    """
+    Prefetch a night's calibration frames (and calibrations) into the
+    shared caches; returns True if everything succeeded.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    niriPipe.utils.customLogger.set_format(args.log_format)
+    import niriPipe.utils.prefetch
+
+    directory = os.path.abspath(args.directory)
+    state = {
+        'current_working_directory': directory,
+        'config': niriPipe.utils.state.read_config(
+            configfile=args.config[0] if args.config else None)
+    }
+    # Use the caches a batch or worker in the same directory would.
+    niriPipe.utils.batch.use_caches(
+        state, niriPipe.utils.batch.shared_caches(directory))
+    summary = niriPipe.utils.prefetch.Prefetcher(
+        state, args.night, calibrations=args.calibrations).run()
+    return summary['succeeded']
+
+
+def submit_main(args, parser):
+    """
+    Add stacks to a worker's job queue.
+    """
+    if args.manifest:
+        if args.stack:
+            parser.error("Give either a stack or a manifest, not both.")
+        stacks = niriPipe.utils.batch.read_manifest(args.manifest)
+    elif len(args.stack) == 3:
+        stacks = [dict(zip(niriPipe.utils.batch.MANIFEST_COLUMNS,
+                           args.stack), config='')]
+    else:
+        parser.error("Give OBSID INTENT BANDPASS, or a manifest.")
+
+    queue = niriPipe.utils.worker.JobQueue(args.queue)
+    for stack in stacks:
+        config = stack['config'] or (args.config[0] if args.config else '')
+        job_id = queue.submit(
+            obsID=stack['obsID'],
+            intent=stack['intent'],
+            bandpass=stack['bandpass'],
+            config=os.path.abspath(config) if config else '')
+        module_logger.info("Queued {} as job {}.".format(
+            stack['obsID'], job_id))
+
+
+def serve_main(args):
+    """
+    Serve a catalog of local files like CADC, until interrupted.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    import niriPipe.utils.localcadc
+    server = niriPipe.utils.localcadc.LocalCadc(
+        niriPipe.utils.localcadc.read_catalog(args.catalog),
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+def synth_main(args):
+    """
+    Write a synthetic raw NIRI dataset.
+    """
+    if args.verbose:
+        niriPipe.utils.customLogger.set_level(logging.DEBUG)
+    import niriPipe.utils.synthetic
+    niriPipe.utils.synthetic.Generator(
+        args.directory,
+        shape=(args.size, args.size),
+        seed=args.seed
+    ).run(
+        obs_name=args.obs_name,
+        n_objects=args.objects,
+        n_flats=args.flats,
+        n_longdarks=args.longdarks,
+        n_shortdarks=args.shortdarks,
+        bandpass=args.bandpass,
+        exptime=args.exptime
+    )
+
+
+def test_main(args):
+    """
+    Run an integration test.
+    """
+    import niriPipe.inttests
+    if 'downloader' in args.testName:
+        test = niriPipe.inttests.downloader_inttest
+    elif 'finder' in args.testName:
+        test = niriPipe.inttests.finder_inttest
+    elif 'run' in args.testName:
+        test = niriPipe.inttests.run_inttest
+    elif 'reduce' in args.testName:
+        test = niriPipe.inttests.run_reduce_inttest
+    else:
+        raise ValueError("Invalid test name: {}".format(args.testName))
+
+    cassette = None
+    if args.record or args.replay:
+        import niriPipe.utils.cassette
+        cassette = niriPipe.utils.cassette.Cassette(
+            args.record or args.replay, record=bool(args.record)).start()
+    start = time.time()
+    try:
+        test(datasource=cassette.url if cassette else None)
+    finally:
+        if cassette:
+            cassette.stop()
+    module_logger.info("Test {} took {:.1f} s.".format(
+        args.testName[0], time.time() - start))
+
+
 def niri_reduce_main():
     """
     Primary NIRI data processing entry point.
@@ -133,25 +439,214 @@ def niri_reduce_main():
                             nargs=1, help='User provided config file.')
     parser_run.add_argument('-v', '--verbose', action='store_true',
                             help='Logs debug messages.')
+    parser_run.add_argument('--profile', type=str, nargs='?',
+                            const='niriPipe_profile', metavar='DIR',
+                            help='Profile each stage with cProfile, writing '
+                                 '.pstats files to DIR (default '
+                                 'niriPipe_profile). Also set by ${}.'.format(
+                                     niriPipe.utils.profiling.PROFILE_ENV))
+    parser_run.add_argument('--flamegraph', action='store_true',
+                            help='With --profile, also sample stacks for a '
+                                 'flame graph (flamegraph.folded). Also set '
+                                 'by ${}.'.format(
+                                     niriPipe.utils.profiling.FLAMEGRAPH_ENV))
+    parser_run.add_argument('--plan', action='store_true',
+                            help='Only find frames and report what the run '
+                                 'would download and reduce; exits non-zero '
+                                 'if requirements can\'t be met.')
+    parser_run.add_argument('--queue-logging', action='store_true',
+                            help='Write log messages from a background '
+                                 'thread, so logging never blocks.')
+    parser_run.add_argument('--log-format', type=str, default='text',
+                            choices=niriPipe.utils.customLogger.FORMATS,
+                            help='Log as text or as JSON lines tagged with '
+                                 'run, stack, stage and worker.')
+
+    parser_batch = subparsers.add_parser('batch')
+    parser_batch.add_argument('manifest', metavar='MANIFEST', type=str,
+                              help='CSV file of stacks to process, with '
+                                   'obsID, intent, bandpass and optional '
+                                   'config columns.')
+    parser_batch.add_argument('-c', '--config', type=str,
+                              nargs=1, help='User provided config file.')
+    parser_batch.add_argument('-j', '--processes', type=int, default=None,
+                              help='Number of stacks to run at once '
+                                   '(default: number of CPUs).')
+    parser_batch.add_argument('-d', '--directory', type=str, default='.',
+                              help='Batch directory; each stack runs in its '
+                                   'own subdirectory.')
+    parser_batch.add_argument('--metrics-interval', type=float, default=60,
+                              help='Seconds between metrics snapshots '
+                                   '(niriPipe.prom in the batch '
+                                   'directory).')
+    parser_batch.add_argument('--queue-logging', action='store_true',
+                              help='Send log messages from the stacks\' '
+                                   'processes to this one through a queue, '
+                                   'so logging never blocks them.')
+    parser_batch.add_argument('--associate', action='store_true',
+                              help='Find calibrations for all stacks at '
+                                   'once, and reduce each distinct '
+                                   'calibration set once before the '
+                                   'stacks run.')
+    parser_batch.add_argument('--log-format', type=str, default='text',
+                              choices=niriPipe.utils.customLogger.FORMATS,
+                              help='Log as text or as JSON lines tagged '
+                                   'with run, stack, stage and worker.')
+    parser_batch.add_argument('-v', '--verbose', action='store_true',
+                              help='Logs debug messages.')
+
+    parser_worker = subparsers.add_parser('worker')
+    parser_worker.add_argument('-q', '--queue', type=str,
+                               default='niriPipe_jobs.sqlite',
+                               help='Job queue database.')
+    parser_worker.add_argument('-c', '--config', type=str,
+                               nargs=1, help='User provided config file.')
+    parser_worker.add_argument('-j', '--concurrency', type=int, default=1,
+                               help='Number of stacks to run at once.')
+    parser_worker.add_argument('-d', '--directory', type=str, default='.',
+                               help='Worker directory; each job runs in '
+                                    'its own subdirectory.')
+    parser_worker.add_argument('--poll-interval', type=float, default=5,
+                               help='Seconds between checks for new jobs.')
+    parser_worker.add_argument('--exit-when-empty', action='store_true',
+                               help='Exit once the queue is empty.')
+    parser_worker.add_argument('--metrics-interval', type=float,
+                               default=60,
+                               help='Seconds between metrics snapshots '
+                                    '(niriPipe.prom in the worker '
+                                    'directory).')
+    parser_worker.add_argument('--queue-logging', action='store_true',
+                               help='Send log messages from the jobs\' '
+                                    'processes to this one through a '
+                                    'queue, so logging never blocks them.')
+    parser_worker.add_argument('--log-format', type=str, default='text',
+                               choices=niriPipe.utils.customLogger.FORMATS,
+                               help='Log as text or as JSON lines tagged '
+                                    'with run, stack, stage and worker.')
+    parser_worker.add_argument('-v', '--verbose', action='store_true',
+                               help='Logs debug messages.')
+
+    parser_prefetch = subparsers.add_parser('prefetch')
+    parser_prefetch.add_argument('--night', type=str, required=True,
+                                 metavar='YYYYMMDD',
+                                 help='UT date of the night to prefetch '
+                                      'flats and darks of.')
+    parser_prefetch.add_argument('-c', '--config', type=str,
+                                 nargs=1, help='User provided config file.')
+    parser_prefetch.add_argument('-d', '--directory', type=str, default='.',
+                                 help='Batch or worker directory whose '
+                                      'shared caches to fill, unless the '
+                                      'config sets them.')
+    parser_prefetch.add_argument('--calibrations', action='store_true',
+                                 help='Also reduce the night\'s darks and '
+                                      'flats into the calibration cache, '
+                                      'per observation (and camera, for '
+                                      'flats); sets over the max_* budgets '
+                                      'are skipped.')
+    parser_prefetch.add_argument('--log-format', type=str, default='text',
+                                 choices=niriPipe.utils.customLogger.FORMATS,
+                                 help='Log as text or as JSON lines tagged '
+                                      'with run, stack, stage and worker.')
+    parser_prefetch.add_argument('-v', '--verbose', action='store_true',
+                                 help='Logs debug messages.')
+
+    parser_submit = subparsers.add_parser('submit')
+    parser_submit.add_argument('stack', metavar='OBSID INTENT BANDPASS',
+                               type=str, nargs='*',
+                               help='A stack to queue, as for run.')
+    parser_submit.add_argument('-m', '--manifest', type=str,
+                               help='Queue all stacks in a batch manifest.')
+    parser_submit.add_argument('-q', '--queue', type=str,
+                               default='niriPipe_jobs.sqlite',
+                               help='Job queue database.')
+    parser_submit.add_argument('-c', '--config', type=str,
+                               nargs=1, help='Config file for the job(s).')
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('catalog', metavar='CATALOG', type=str,
+                              help='Table (e.g. ECSV) of files to serve, '
+                                   'with the columns Finder queries for and '
+                                   'a filename column.')
+    parser_serve.add_argument('--host', type=str, default='127.0.0.1',
+                              help='Address to listen on.')
+    parser_serve.add_argument('-p', '--port', type=int, default=8080,
+                              help='Port to listen on.')
+    parser_serve.add_argument('--latency', type=float, default=0,
+                              help='Seconds added to every request.')
+    parser_serve.add_argument('--bandwidth', type=float, default=None,
+                              help='Limit each download to this many MB/s.')
+    parser_serve.add_argument('--error-rate', type=float, default=0,
+                              help='Fraction of requests to fail with 503.')
+    parser_serve.add_argument('--seed', type=int, default=None,
+                              help='Seed for choosing requests to fail.')
+    parser_serve.add_argument('-v', '--verbose', action='store_true',
+                              help='Logs debug messages.')
+
+    parser_synth = subparsers.add_parser('synth')
+    parser_synth.add_argument('directory', metavar='DIRECTORY', type=str,
+                              help='Where to write frames and their '
+                                   'catalog (catalog.ecsv, for '
+                                   '\'niriPipe serve\').')
+    parser_synth.add_argument('--obs-name', type=str,
+                              default='GN-2019A-FT-108-12',
+                              help='Observation ID of the object frames.')
+    parser_synth.add_argument('--objects', type=int, default=10,
+                              help='Number of object frames.')
+    parser_synth.add_argument('--flats', type=int, default=10,
+                              help='Number of flats.')
+    parser_synth.add_argument('--longdarks', type=int, default=10,
+                              help='Number of darks with the object '
+                                   'exposure time.')
+    parser_synth.add_argument('--shortdarks', type=int, default=0,
+                              help='Number of 1 s darks.')
+    parser_synth.add_argument('--bandpass', type=str, default='J',
+                              help='Filter of the object frames and flats.')
+    parser_synth.add_argument('--exptime', type=float, default=20.0,
+                              help='Exposure time of the object frames.')
+    parser_synth.add_argument('--size', type=int, default=1024,
+                              help='Frames are SIZE x SIZE pixels.')
+    parser_synth.add_argument('--seed', type=int, default=0,
+                              help='Random seed.')
+    parser_synth.add_argument('-v', '--verbose', action='store_true',
+                              help='Logs debug messages.')
 
     parser_test = subparsers.add_parser('test')
     parser_test.add_argument('testName', metavar='TESTNAME', type=str, nargs=1,
                              choices=['downloader', 'finder', 'run', 'reduce'],
                              help='Str name of test to run.')
+    cassette_group = parser_test.add_mutually_exclusive_group()
+    cassette_group.add_argument('--record', type=str, default=None,
+                                metavar='DIR',
+                                help='Record CADC responses into the '
+                                     'cassette directory DIR (adding to '
+                                     'what it already holds).')
+    cassette_group.add_argument('--replay', type=str, default=None,
+                                metavar='DIR',
+                                help='Serve CADC responses from the '
+                                     'cassette directory DIR, offline.')
 
     args = parser.parse_args()
     if hasattr(args, 'testName'):
-        if 'downloader' in args.testName:
-            niriPipe.inttests.downloader_inttest()
-        elif 'finder' in args.testName:
-            niriPipe.inttests.finder_inttest()
-        elif 'run' in args.testName:
-            niriPipe.inttests.run_inttest()
-        elif 'reduce' in args.testName:
-            niriPipe.inttests.run_reduce_inttest()
-        else:
-            raise ValueError("Invalid test name: {}".format(args.testName))
+        test_main(args)
+    elif hasattr(args, 'catalog'):
+        serve_main(args)
+    elif hasattr(args, 'obs_name'):
+        synth_main(args)
+    elif hasattr(args, 'night'):
+        if not prefetch_main(args):
+            sys.exit(1)
     elif hasattr(args, 'obsID'):
-        run_main(args)
+        if args.plan:
+            if not plan_main(args):
+                sys.exit(1)
+        else:
+            run_main(args)
+    elif hasattr(args, 'stack'):
+        submit_main(args, parser_submit)
+    elif hasattr(args, 'concurrency'):
+        worker_main(args)
+    elif hasattr(args, 'manifest'):
+        if not batch_main(args):
+            sys.exit(1)
     else:
         parser.print_help()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Client for CADC-compatible services other than CADC itself.
+
+[DATARETRIEVAL] dataSource is either CADC (the live archive, through
+astroquery and cadcdata) or the base URL of a service with the same
+interface as the local stand-in (see niriPipe.utils.localcadc):
+
+    POST <url>/tap/sync         TAP synchronous ADQL query; a VOTable.
+    GET  <url>/datalink?ID=...  Data URLs of publisherIDs; a VOTable with
+                                ID, access_url and semantics columns.
+    GET  <url>/data/<file>      A file, with Content-MD5 and
+                                Content-Disposition headers; with
+                                ?fhead=true, its header text.
+"""
+import io
+import astropy.io.votable
+import requests
+
+# Most publisherIDs to resolve in one datalink request.
+DATALINK_BATCH = 100
+
+
+def service_url(state):
+    """
+    Base URL of the configured data source, or None for the live CADC.
+    """
+    # configparser lower cases option names.
+    source = state['config'].get('DATARETRIEVAL', {}).get(
+        'datasource', 'CADC')
+    if not source or source.upper() == 'CADC':
+        return None
+    return source.rstrip('/')
+
+
+def _votable(content):
+    return astropy.io.votable.parse_single_table(
+        io.BytesIO(content)).to_table()
+
+
+def tap_query(url, query, timeout=300):
+    """
+    Run an ADQL query; returns an astropy table.
+    """
+    r = requests.post(
+        url + '/tap/sync',
+        data={'REQUEST': 'doQuery', 'LANG': 'ADQL', 'QUERY': query},
+        timeout=timeout)
+    r.raise_for_status()
+    return _votable(r.content)
+
+
+def fetch_header(url, filename, timeout=60):
+    """
+    Header text of a file.
+    """
+    r = requests.get(
+        '{}/data/{}'.format(url, filename), params={'fhead': 'true'},
+        timeout=timeout)
+    r.raise_for_status()
+    return r.text
+
+
+def data_urls(url, table, timeout=60):
+    """
+    Data URLs of the files in a table with a publisherID column, in order.
+    """
+    ids = [str(x) for x in table['publisherID']]
+    found = {}
+    for i in range(0, len(ids), DATALINK_BATCH):
+        r = requests.get(
+            url + '/datalink', params={'ID': ids[i:i + DATALINK_BATCH]},
+            timeout=timeout)
+        r.raise_for_status()
+        for row in _votable(r.content):
+            if row['semantics'] == '#this':
+                found[row['ID']] = row['access_url']
+    missing = [x for x in ids if x not in found]
+    if missing:
+        raise ValueError("No data URL for {}".format(', '.join(missing)))
+    return [found[x] for x in ids]
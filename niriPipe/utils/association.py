@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Calibration association for a batch of stacks.
+
+Stacks from one night sharing a bandpass, camera and exposure time would
+each query CADC for the same flats and darks, and reduce the same
+calibrations. An Associator finds the object frames of every stack first,
+then indexes calibration frames with one query per frame type and
+bandpass (flats) or exposure time (long darks), over the time span of all
+stacks needing them. Each stack takes its calibration frames from the
+index, chosen as its Finder would choose them (time window, camera,
+segmentation, budget), and stacks with the same calibration frames and
+calibration config share one calibration set, to be reduced once.
+"""
+import hashlib
+import json
+import os
+import astropy.table
+import niriPipe.utils.cache
+import niriPipe.utils.customLogger
+import niriPipe.utils.finder
+import niriPipe.utils.prefetch
+
+
+def calibration_set_id(table, state):
+    """
+    Id of a set of calibration frames for a stack: a digest of their frame
+    types and product IDs, and of the stack's config that changes their
+    products (see niriPipe.utils.cache.product_config()). Stacks only
+    share a set if its calibrations are the ones they would make.
+    """
+    frames = sorted(
+        '{}:{}'.format(frame_type, product_id) for frame_type, product_id
+        in zip(table['niriPipe_type'], table['productID']))
+    config = json.dumps({
+        frame_type: niriPipe.utils.cache.product_config(state, frame_type)
+        for frame_type in set(table['niriPipe_type'])
+    }, sort_keys=True)
+    description = ' '.join(frames) + ' ' + config
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()[:12]
+
+
+def reduce_calibration_set(filename, state):
+    """
+    Reduce the calibration set in a table file in the working directory;
+    a pipeline for niriPipe.utils.batch.run_stack().
+    """
+    return niriPipe.utils.prefetch.reduce_calibrations(
+        state, astropy.table.Table.read(filename), os.getcwd())
+
+
+class CalibrationIndex:
+    """
+    Calibration frames of a batch, queried once per frame type and bandpass
+    or exposure time, and the file headers looked at.
+    """
+    def __init__(self):
+        self.finders = []
+        self.tables = {}
+        self.headers = {}
+
+    @staticmethod
+    def key(frame_type, stack):
+        """
+        What calibration frames of a type depend on, besides time.
+        """
+        if frame_type == 'flat':
+            return (frame_type, stack['bandpass'])
+        if frame_type == 'longdark':
+            return (frame_type, stack['exptime'])
+        return (frame_type,)
+
+    def add(self, finder):
+        """
+        Add the finder of a stack whose object frames are found.
+        """
+        self.finders.append(finder)
+
+    def frames(self, finder, frame_type):
+        """
+        Calibration frames of a type for a stack: those in its window.
+        """
+        key = self.key(frame_type, finder.state['current_stack'])
+        if key not in self.tables:
+            self.tables[key] = self._query(finder, frame_type, key)
+        table = self.tables[key]
+        # Windows are rounded as in the query.
+        start, end = [
+            float('{:.4f}'.format(x)) for x in finder._window(frame_type)]
+        return table[(table['time_bounds_lower'] >= start) &
+                     (table['time_bounds_lower'] <= end)]
+
+    def _query(self, finder, frame_type, key):
+        """
+        Query the frames for all stacks with the same key, over the span of
+        their windows.
+        """
+        windows = [
+            other._window(frame_type) for other in self.finders
+            if self.key(frame_type, other.state['current_stack']) == key
+        ]
+        query = finder._calibration_query(
+            frame_type,
+            min(start for start, end in windows),
+            max(end for start, end in windows))
+        return niriPipe.utils.finder.Finder._query_frames(
+            finder, query, frame_type)
+
+
+class AssociatingFinder(niriPipe.utils.finder.Finder):
+    """
+    Finds the data for one stack of a batch, taking calibration frames and
+    headers from a CalibrationIndex shared by the batch.
+    """
+    def __init__(self, state, index):
+        self.index = index
+        self.objects = None
+        super().__init__(state)
+
+    def _find_objects(self):
+        if self.objects is None:
+            self.objects = super()._find_objects()
+        return self.objects
+
+    def _query_frames(self, query, frame_type):
+        if frame_type == 'object':
+            return super()._query_frames(query, frame_type)
+        return self.index.frames(self, frame_type)
+
+    def _header(self, productID):
+        if productID not in self.index.headers:
+            self.index.headers[productID] = super()._header(productID)
+        return self.index.headers[productID]
+
+
+class Associator:
+    """
+    Associates calibrations with the stacks of a batch.
+
+    Parameters
+    ----------
+    states: list of dict
+        Initial state of each stack. Stack metadata is set in them as a
+        Finder would set it.
+    """
+    def __init__(self, states):
+        self.states = states
+        self.index = CalibrationIndex()
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+    def run(self):
+        """
+        Find the frames of all stacks; returns (stacks, sets).
+
+        stacks has a dict per state: 'table', the stack's frames as
+        Finder.run() would return them, and 'calibration_set', the id of
+        its calibration set; or 'error' and no table, if its frames
+        couldn't be found. sets maps calibration set ids to dicts of the
+        set's frames ('table') and its stacks ('stacks', indices into
+        stacks).
+        """
+        finders = [
+            AssociatingFinder(state, self.index) for state in self.states]
+        stacks = [
+            {'table': None, 'calibration_set': None, 'error': None}
+            for state in self.states
+        ]
+        # Calibration windows depend on the object frames of all stacks.
+        for finder, stack in zip(finders, stacks):
+            try:
+                finder._find_objects()
+                self.index.add(finder)
+            except Exception as e:
+                self._failed(finder, stack, e)
+
+        sets = {}
+        for i, (finder, stack) in enumerate(zip(finders, stacks)):
+            if stack['error']:
+                continue
+            try:
+                table = finder.run()
+            except Exception as e:
+                self._failed(finder, stack, e)
+                continue
+            calibrations = table[table['niriPipe_type'] != 'object']
+            set_id = calibration_set_id(calibrations, finder.state)
+            stack.update(table=table, calibration_set=set_id)
+            sets.setdefault(set_id, {'table': calibrations, 'stacks': []})
+            sets[set_id]['stacks'].append(i)
+
+        self.logger.info(
+            "Associated {} of {} stacks with {} calibration sets, "
+            "in {} calibration queries.".format(
+                len([s for s in stacks if not s['error']]), len(stacks),
+                len(sets), len(self.index.tables)))
+        return stacks, sets
+
+    def _failed(self, finder, stack, e):
+        self.logger.warning("Failed to associate {}: {}".format(
+            finder.state['current_stack']['obs_name'], e))
+        stack['error'] = '{}: {}'.format(type(e).__name__, e)
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Run many stacks from a manifest in a pool of processes.
+"""
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import csv
+import functools
+import json
+import logging
+import os
+import re
+import time
+import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.state
+
+
+# Caches (and the disk budget ledger) shared by all stacks in a batch,
+# unless the config sets them.
+SHARED_CACHES = [
+    ('DATAFINDER', 'header_cache', 'headers'),
+    ('DATARETRIEVAL', 'cache_path', 'rawData'),
+    ('REDUCTION', 'calibration_cache', 'calibrations'),
+    ('DISKBUDGET', 'ledger', 'diskbudget.sqlite'),
+]
+
+MANIFEST_COLUMNS = ['obsID', 'intent', 'bandpass']
+
+
+def shared_caches(directory):
+    """
+    SHARED_CACHES, as (section, option, path) under a batch directory.
+    """
+    return [
+        (section, option, os.path.join(directory, 'cache', name))
+        for section, option, name in SHARED_CACHES
+    ]
+
+
+def use_caches(state, caches):
+    """
+    Set state's cache options to caches (see shared_caches()), unless the
+    config already sets them.
+    """
+    for section, option, path in caches:
+        section_config = state['config'].setdefault(section, {})
+        if not section_config.get(option):
+            section_config[option] = path
+
+
+def read_manifest(filename):
+    """
+    Read stacks from a CSV manifest.
+
+    The first row names the columns: obsID, intent and bandpass, as for
+    'niriPipe run', plus an optional config column giving a config file
+    for that stack (relative to the manifest). Blank lines and lines
+    starting with # are skipped.
+    """
+    with open(filename, newline='') as f:
+        lines = [
+            line for line in f
+            if line.strip() and not line.lstrip().startswith('#')
+        ]
+    reader = csv.DictReader(lines, skipinitialspace=True)
+    fieldnames = reader.fieldnames or []
+    missing = [c for c in MANIFEST_COLUMNS if c not in fieldnames]
+    if missing:
+        raise ValueError("Manifest {} is missing columns: {}".format(
+            filename, ', '.join(missing)))
+    stacks = []
+    for row in reader:
+        stack = {key: (row.get(key) or '').strip()
+                 for key in MANIFEST_COLUMNS + ['config']}
+        if not all(stack[c] for c in MANIFEST_COLUMNS):
+            raise ValueError("Incomplete manifest row: {}".format(row))
+        if stack['config']:
+            stack['config'] = os.path.join(
+                os.path.dirname(os.path.abspath(filename)), stack['config'])
+        stacks.append(stack)
+    return stacks
+
+
+def stack_directory(stack):
+    """
+    Name of a stack's working directory.
+    """
+    return re.sub(r'[^\w.+-]+', '_', '{}_{}_{}'.format(
+        stack['obsID'], stack['intent'], stack['bandpass']))
+
+
+def stack_state(stack, configfile, caches):
+    """
+    Initial state of a stack, using configfile unless the stack names its
+    own, and caches (see use_caches()).
+    """
+    config = stack['config'] or configfile
+    state = niriPipe.utils.state.get_initial_state(
+        obs_name=[stack['obsID']],
+        intent=[stack['intent']],
+        configfile=[config] if config else None,
+        bandpass=[stack['bandpass']]
+    )
+    use_caches(state, caches)
+    return state
+
+
+def run_stack(pipeline, stack, directory, configfile, caches,
+              log_queue=None, log_context=None, association=None):
+    """
+    Run one stack in its own working directory; runs in a pool process.
+
+    Never raises; the result dict records success or the error, and the
+    stack's metrics (see pop_metrics()). With log_queue (the queue of a
+    niriPipe.utils.customLogger.LogAggregator), logging is queued and
+    sent to the aggregating process. log_context is the parent's log
+    context (run_id, worker), which records are tagged with along with
+    the stack. association gives the stack's frames, found ahead of time
+    (see Batch), to the Finder.
+    """
+    home = os.getcwd()
+    start = time.time()
+    result = dict(stack, directory=directory, succeeded=False, error=None,
+                  products=None)
+    logger = niriPipe.utils.customLogger.get_logger(__name__)
+    if log_queue is not None:
+        niriPipe.utils.customLogger.start_queue_logging(forward=log_queue)
+    handler = None
+    context = dict(log_context or {}, stack=stack['obsID'])
+    with niriPipe.utils.customLogger.log_context(**context):
+        # Pool processes are forked from the parent and run many stacks; only
+        # report this stack's metrics.
+        niriPipe.utils.metrics.REGISTRY.clear()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            os.chdir(directory)
+            # Each stack logs to its own file as well.
+            handler = logging.FileHandler('niriPipe.log')
+            handler.setFormatter(
+                niriPipe.utils.customLogger.make_formatter())
+            niriPipe.utils.customLogger.add_handler(handler)
+            state = stack_state(stack, configfile, caches)
+            if association:
+                state['current_stack']['association'] = association
+            result['products'] = pipeline(state)
+            result['succeeded'] = True
+        except Exception as e:
+            logger.error("Stack {} failed.".format(stack['obsID']),
+                         exc_info=True)
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            if handler is not None:
+                niriPipe.utils.customLogger.remove_handler(handler)
+                handler.close()
+            if log_queue is not None:
+                niriPipe.utils.customLogger.stop_queue_logging()
+            os.chdir(home)
+            result['wall_seconds'] = time.time() - start
+            result['metrics'] = niriPipe.utils.metrics.REGISTRY.dump()
+    return result
+
+
+@contextlib.contextmanager
+def log_aggregator(enabled):
+    """
+    Yields the queue of a running LogAggregator if enabled, else None.
+    """
+    if not enabled:
+        yield None
+        return
+    with niriPipe.utils.customLogger.LogAggregator() as aggregator:
+        yield aggregator.queue
+
+
+def pop_metrics(result):
+    """
+    Remove a stack's metrics from its run_stack() result, adding them to
+    this process's registry.
+    """
+    niriPipe.utils.metrics.REGISTRY.merge(result.pop('metrics', {}))
+
+
+class Batch:
+    """
+    Runs a manifest of stacks, several at a time.
+
+    Each stack runs in its own working directory under the batch
+    directory, in a separate process (DRAGONS changes global state, so
+    stacks can't share one). Interpreter and import startup is paid once
+    per pool process rather than once per stack, and all stacks share
+    header, download and calibration caches (and a disk budget ledger) in
+    the batch directory unless their config sets other ones.
+
+    With associate, the frames of all stacks are found up front by a
+    niriPipe.utils.association.Associator, which queries for calibration
+    frames once per bandpass or exposure time rather than once per stack.
+    Each distinct set of calibration frames is then reduced once, in
+    calibrations/<set id> in the batch directory, before the stacks run
+    and take their calibrations from the calibration cache. Stacks that
+    fail association find their own frames.
+
+    Parameters
+    ----------
+    pipeline: callable
+        Runs one stack given its initial state and returns its products;
+        must be picklable (a module-level function).
+    stacks: list of dict
+        Stacks to run, as returned by read_manifest().
+    directory: str
+        Batch directory.
+    processes: int
+        Number of stacks to run at once.
+    configfile: str
+        Config file for stacks that don't name their own.
+    metrics_interval: float
+        Seconds between snapshots of all stacks' metrics, written to
+        niriPipe.prom in the batch directory as stacks finish.
+    queue_logging: bool
+        Send the stacks' log records to this process through a queue,
+        rather than having each process write them to stderr.
+    associate: bool
+        Associate calibrations with all stacks at once, and reduce each
+        calibration set once.
+
+    If a pool process dies (e.g. the OOM killer takes a DRAGONS process),
+    the pool can't run anything more: the stacks it lost are run again in
+    a new pool, up to max_resubmits times each, then reported as failed.
+    """
+    report_name = 'batch_report.json'
+    metrics_name = 'niriPipe.prom'
+    max_resubmits = 2
+
+    def __init__(self, pipeline, stacks, directory='.', processes=None,
+                 configfile=None, metrics_interval=60, queue_logging=False,
+                 associate=False):
+        self.pipeline = pipeline
+        self.stacks = stacks
+        self.directory = os.path.abspath(directory)
+        self.processes = processes or os.cpu_count() or 1
+        self.configfile = os.path.abspath(configfile) if configfile \
+            else None
+        self.metrics = niriPipe.utils.metrics.PeriodicWriter(
+            niriPipe.utils.metrics.REGISTRY,
+            os.path.join(self.directory, self.metrics_name),
+            metrics_interval)
+        self.queue_logging = queue_logging
+        self.associate = associate
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+    def run(self):
+        """
+        Run all stacks and write a report; returns the per-stack results,
+        in manifest order.
+        """
+        caches = shared_caches(self.directory)
+        directories = [
+            os.path.join(self.directory, stack_directory(stack))
+            for stack in self.stacks
+        ]
+        if len(set(directories)) != len(directories):
+            raise ValueError("Manifest lists a stack more than once.")
+
+        associations = [None] * len(self.stacks)
+        calibration_sets = []
+        if self.associate:
+            associations, calibration_sets = self._associate(
+                caches, directories)
+
+        self.logger.info("Running {} stacks, {} at a time.".format(
+            len(self.stacks), self.processes))
+        results = [None] * len(self.stacks)
+
+        def done(i, result):
+            results[i] = result
+            self._log_result(result)
+            self.metrics.maybe_write()
+
+        with log_aggregator(self.queue_logging) as log_queue:
+            # Stacks take their calibrations from the cache, so those are
+            # all made first.
+            calibration_sets = self._reduce_calibration_sets(
+                calibration_sets, caches, log_queue)
+            self._run_in_pools(
+                [(self.pipeline, stack, directory, association)
+                 for stack, directory, association in zip(
+                    self.stacks, directories, associations)],
+                caches, log_queue, done)
+
+        self._write_report(results, calibration_sets)
+        self.metrics.write()
+        return results
+
+    def _associate(self, caches, directories):
+        """
+        Find the frames of all stacks, writing each stack's table to its
+        directory; returns each stack's association for run_stack() (None
+        if association failed), and the calibration sets to reduce.
+        """
+        # Pulls in the pipeline stages, which are slow to import.
+        import niriPipe.utils.association
+
+        states = [
+            stack_state(stack, self.configfile, caches)
+            for stack in self.stacks
+        ]
+        found, sets = niriPipe.utils.association.Associator(states).run()
+
+        associations = []
+        for state, stack, directory in zip(states, found, directories):
+            if stack['table'] is None:
+                associations.append(None)
+                continue
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, 'association.ecsv')
+            stack['table'].write(filename, overwrite=True)
+            current = state['current_stack']
+            associations.append({
+                'table': filename,
+                'exptime': float(current['exptime']),
+                'mjd_date': float(current['mjd_date']),
+                'proposal_id': str(current['proposal_id']),
+                'camera': str(current['camera']),
+            })
+
+        calibration_sets = []
+        for set_id, calibration_set in sorted(sets.items()):
+            if not len(calibration_set['table']):
+                continue
+            directory = os.path.join(self.directory, 'calibrations', set_id)
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, 'calibrations.ecsv')
+            calibration_set['table'].write(filename, overwrite=True)
+            calibration_sets.append({
+                'calibration_set': set_id,
+                'directory': directory,
+                'table': filename,
+                'stacks': [self.stacks[i] for i in calibration_set['stacks']],
+            })
+        return associations, calibration_sets
+
+    def _run_in_pools(self, calls, caches, log_queue, done):
+        """
+        Run run_stack() for each of calls, (pipeline, stack, directory,
+        association) tuples, in a process pool; done(i, result) is called
+        as each call finishes. Never raises for a call: calls lost with a
+        broken pool are run again in a new one (see max_resubmits), and
+        calls that can't run are given a failed result.
+        """
+        pending = list(range(len(calls)))
+        attempts = collections.Counter()
+        while pending:
+            lost = []
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes) as pool:
+                futures = {}
+                for i in pending:
+                    pipeline, stack, directory, association = calls[i]
+                    try:
+                        future = pool.submit(
+                            run_stack, pipeline, stack, directory,
+                            self.configfile, caches, log_queue,
+                            niriPipe.utils.customLogger.get_context(),
+                            association)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        lost.append(i)
+                        continue
+                    futures[future] = i
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    try:
+                        result = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        lost.append(i)
+                        continue
+                    except Exception as e:
+                        # run_stack() doesn't raise; the call couldn't be
+                        # sent to or back from the pool.
+                        result = self._failed_result(calls[i], e)
+                    pop_metrics(result)
+                    done(i, result)
+
+            pending = []
+            for i in sorted(lost):
+                attempts[i] += 1
+                if attempts[i] <= self.max_resubmits:
+                    pending.append(i)
+                else:
+                    done(i, self._failed_result(
+                        calls[i], concurrent.futures.process.BrokenProcessPool(
+                            "A pool process died {} times running it.".format(
+                                attempts[i]))))
+            if pending:
+                self.logger.warning(
+                    "A pool process died; running {} stacks again in a new "
+                    "pool.".format(len(pending)))
+
+    @staticmethod
+    def _failed_result(call, e):
+        """
+        A run_stack() result for a call that didn't run to completion.
+        """
+        pipeline, stack, directory, association = call
+        return dict(stack, directory=directory, succeeded=False,
+                    error='{}: {}'.format(type(e).__name__, e),
+                    products=None, wall_seconds=0.0)
+
+    def _reduce_calibration_sets(self, calibration_sets, caches, log_queue):
+        """
+        Reduce each calibration set into the calibration cache, with the
+        config of its first stack (the stacks of a set agree on the config
+        that changes calibrations); returns their results.
+        """
+        if not calibration_sets:
+            return []
+        import niriPipe.utils.association
+
+        results = []
+
+        def done(i, result):
+            calibration_set = calibration_sets[i]
+            stacks = [stack['obsID'] for stack in calibration_set['stacks']]
+            if result['succeeded']:
+                self.logger.info(
+                    "Calibration set {} for {} stacks made {} in "
+                    "{:.0f} s.".format(
+                        calibration_set['calibration_set'], len(stacks),
+                        ', '.join(result['products']),
+                        result['wall_seconds']))
+            else:
+                self.logger.error(
+                    "Calibration set {} for {} stacks failed: {}".format(
+                        calibration_set['calibration_set'], len(stacks),
+                        result['error']))
+            results.append({
+                'calibration_set': calibration_set['calibration_set'],
+                'directory': calibration_set['directory'],
+                'stacks': stacks,
+                'succeeded': result['succeeded'],
+                'error': result['error'],
+                'products': result['products'],
+                'wall_seconds': result['wall_seconds'],
+            })
+
+        self._run_in_pools(
+            [(functools.partial(
+                niriPipe.utils.association.reduce_calibration_set,
+                calibration_set['table']),
+              calibration_set['stacks'][0], calibration_set['directory'],
+              None)
+             for calibration_set in calibration_sets],
+            caches, log_queue, done)
+        return sorted(results, key=lambda x: x['calibration_set'])
+
+    def _log_result(self, result):
+        if result['succeeded']:
+            self.logger.info("Stack {} succeeded in {:.0f} s.".format(
+                result['obsID'], result['wall_seconds']))
+        else:
+            self.logger.error("Stack {} failed in {:.0f} s: {}".format(
+                result['obsID'], result['wall_seconds'], result['error']))
+
+    def _write_report(self, results, calibration_sets=()):
+        n_failed = len([r for r in results if not r['succeeded']])
+        filename = os.path.join(self.directory, self.report_name)
+        with open(filename, 'w') as f:
+            json.dump({
+                'stacks': len(results),
+                'succeeded': len(results) - n_failed,
+                'failed': n_failed,
+                'results': results,
+                'calibration_sets': list(calibration_sets),
+            }, f, indent=4)
+        self.logger.info(
+            "{} of {} stacks succeeded; report in {}.".format(
+                len(results) - n_failed, len(results), filename))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+File caches that can be shared between pipelines.
+
+Pipelines running at the same time (e.g. in a batch, see
+niriPipe.utils.batch) may share a cache directory, so entries are written
+atomically: to a hidden temporary file in the cache directory, then renamed
+into place. Readers only ever see complete entries.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import niriPipe.utils.customLogger
+import niriPipe.utils.state
+
+
+def from_state(state, section, option):
+    """
+    The FileCache configured by a path option in state, or None if the
+    option is missing or empty.
+    """
+    path = state['config'].get(section, {}).get(option, '')
+    if not path:
+        return None
+    return FileCache(path)
+
+
+def product_config(state, frame_type):
+    """
+    The configuration that changes a calibration product of frame_type,
+    as it is applied by the Reducer: how DRAGONS is run, whether darks are
+    subtracted and whether flats are prepared once for both the BPM and
+    the flat.
+    """
+    reduction = state['config']['REDUCTION']
+    datafinder = state['config']['DATAFINDER']
+    config = {
+        'in_memory': niriPipe.utils.state.to_bool(
+            reduction.get('in_memory', False)),
+    }
+    if frame_type != 'longdark':
+        config['do_dark'] = bool(int(datafinder['min_longdarks']))
+        config['share_prepared'] = all([
+            niriPipe.utils.state.to_bool(
+                reduction.get('share_prepared', False)),
+            int(datafinder['min_shortdarks']),
+            int(datafinder['min_flats'])])
+    return config
+
+
+def calibration_key(
+        frame_type, product_name, recipename, product_ids, calibrations,
+        config=None):
+    """
+    Calibration cache key: a digest of everything that goes into a
+    calibration product (see Reducer._make_product()), including the
+    product_config() it was made with.
+    """
+    description = json.dumps({
+        'frame_type': frame_type,
+        'product_name': product_name,
+        'recipename': recipename,
+        'config': config or {},
+        'inputs': sorted(str(x) for x in product_ids),
+        'calibrations': {
+            key: os.path.basename(value)
+            for key, value in calibrations.items() if value
+        },
+    }, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def calibration_filename(cache, key):
+    """
+    Original file name of a calibration in a calibration cache, or None if
+    it isn't cached.
+
+    Each calibration is cached as <key>.fits, plus <key>.json giving its
+    file name; the description is written last, so it only exists for
+    complete entries.
+    """
+    entry = cache.read(key + '.json')
+    if entry is None:
+        return None
+    return json.loads(entry.decode('utf-8'))['filename']
+
+
+class FileCache:
+    """
+    A directory of files, keyed by file name.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry(self, key):
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            raise ValueError("Invalid cache key: {}".format(key))
+        return os.path.join(self.path, key)
+
+    @contextlib.contextmanager
+    def _atomic(self, key):
+        """
+        Yield a temporary file name; on success, move it to the entry.
+        """
+        entry = self._entry(key)
+        fd, tmp = tempfile.mkstemp(prefix='.' + key, dir=self.path)
+        os.close(fd)
+        try:
+            yield tmp
+            os.replace(tmp, entry)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get(self, key):
+        """
+        Path of an entry, or None if it isn't cached.
+        """
+        entry = self._entry(key)
+        return entry if os.path.exists(entry) else None
+
+    def read(self, key):
+        """
+        Contents of an entry as bytes, or None if it isn't cached.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        with open(entry, 'rb') as f:
+            return f.read()
+
+    def write(self, key, data):
+        """
+        Store bytes as an entry.
+        """
+        with self._atomic(key) as tmp:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+
+    def put(self, key, filename):
+        """
+        Store a copy of a file as an entry.
+        """
+        with self._atomic(key) as tmp:
+            shutil.copyfile(filename, tmp)
+        self.logger.debug("Cached {} as {}.".format(filename, key))
+
+    def fetch(self, key, dest, link=False):
+        """
+        Copy an entry to dest and return dest, or None if it isn't cached.
+
+        With link, hard link instead where possible; only do that for
+        files nobody modifies in place.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if link:
+            try:
+                os.link(entry, dest)
+                return dest
+            except OSError:
+                # Different filesystems, or dest exists; copy instead.
+                pass
+        shutil.copyfile(entry, dest)
+        return dest
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Recorded CADC responses, for running the integration tests offline.
+
+A cassette is a directory holding what the Finder and Downloader got
+from an archive:
+
+    catalog.ecsv        publisherID and filename (under data/) of every
+                        downloaded file.
+    queries/<key>.xml   Result (VOTable) of each TAP query; <key> is the
+                        SHA-1 of the query with whitespace collapsed, and
+                        <key>.adql holds the query itself.
+    headers/<name>.hdr  Header text of each file whose header was fetched.
+    data/<file>         Downloaded files.
+
+A Cassette serves it like niriPipe.utils.localcadc.LocalCadc; point a
+pipeline at it with [DATARETRIEVAL] dataSource. When recording, anything
+not yet in the cassette is fetched from the source archive (the live CADC,
+or another CADC-compatible service) and saved before it is served. When
+replaying, anything missing is an error, so a replay never touches the
+network.
+"""
+import hashlib
+import os
+import re
+import shutil
+import astropy.io.votable
+import astropy.table
+from astroquery.cadc import Cadc
+import requests
+import niriPipe.utils.archive
+from niriPipe.utils.finder import Finder
+import niriPipe.utils.localcadc
+
+CATALOG_NAME = 'catalog.ecsv'
+
+
+def query_key(adql):
+    """
+    Name a query is recorded under.
+    """
+    return hashlib.sha1(
+        ' '.join(adql.split()).encode('utf-8')).hexdigest()
+
+
+class Cassette(niriPipe.utils.localcadc.LocalCadc):
+    """
+    Serves recorded archive responses, recording missing ones if asked to.
+
+    Parameters
+    ----------
+    directory: str
+        Cassette directory; created if recording.
+    record: bool
+        Fetch and save responses that aren't in the cassette yet, rather
+        than failing.
+    source: str
+        Base URL of the archive to record from; None for the live CADC.
+    **kwargs
+        Passed on to LocalCadc (host, port, latency, ...).
+    """
+    def __init__(self, directory, record=False, source=None, **kwargs):
+        self.directory = os.path.abspath(directory)
+        self.record = record
+        self.source = source
+        self._live_urls = {}
+        if record:
+            for sub in ('queries', 'headers', 'data'):
+                os.makedirs(os.path.join(self.directory, sub), exist_ok=True)
+        elif not os.path.isdir(self.directory):
+            raise FileNotFoundError(
+                "No cassette found at {}.".format(self.directory))
+        catalog_name = os.path.join(self.directory, CATALOG_NAME)
+        if os.path.exists(catalog_name):
+            catalog = niriPipe.utils.localcadc.read_catalog(catalog_name)
+        else:
+            # Nothing downloaded (yet).
+            catalog = astropy.table.Table(
+                names=['publisherID', 'filename'], dtype=[str, str])
+        super().__init__(catalog, **kwargs)
+
+    def tap(self, adql):
+        filename = os.path.join(
+            self.directory, 'queries', query_key(adql) + '.xml')
+        if os.path.exists(filename):
+            return astropy.io.votable.parse_single_table(filename).to_table()
+        if not self.record:
+            raise KeyError("Query not recorded: {}".format(adql))
+
+        self.logger.info("Recording query {}".format(query_key(adql)))
+        if self.source:
+            table = niriPipe.utils.archive.tap_query(self.source, adql)
+        else:
+            table = Finder._do_query(adql)
+        self._save(filename, niriPipe.utils.localcadc._votable_bytes(table))
+        self._save(filename[:-len('.xml')] + '.adql', adql.encode('utf-8'))
+        return table
+
+    def resolve(self, publisher_ids):
+        found = super().resolve(publisher_ids)
+        missing = [x for x in publisher_ids if x not in found]
+        if not (self.record and missing):
+            return found
+
+        table = astropy.table.Table([missing], names=['publisherID'])
+        if self.source:
+            urls = niriPipe.utils.archive.data_urls(self.source, table)
+        else:
+            urls = Cadc.get_data_urls(table)
+        with self._lock:
+            for publisher_id, url in zip(missing, urls):
+                name = _file_name(publisher_id)
+                self._live_urls[name] = (publisher_id, url)
+                found[publisher_id] = name
+        return found
+
+    def find(self, name):
+        filename = super().find(name)
+        if filename or not self.record:
+            return filename
+        with self._lock:
+            publisher_id, url = self._live_urls.get(name, (None, None))
+        if not url:
+            return None
+        return self._record_file(publisher_id, url)
+
+    def header(self, name):
+        filename = os.path.join(self.directory, 'headers', name + '.hdr')
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                return f.read()
+        if not self.record:
+            return super().header(name)
+
+        self.logger.info("Recording header of {}".format(name))
+        if self.source:
+            text = niriPipe.utils.archive.fetch_header(self.source, name)
+        else:
+            text = Finder._fetch_header(name)
+        self._save(filename, text.encode('utf-8'))
+        return text
+
+    def _record_file(self, publisher_id, url):
+        """
+        Download a file into the cassette, and add it to the catalog.
+        """
+        self.logger.info("Recording {}".format(publisher_id))
+        r = requests.get(url, stream=True, timeout=300)
+        r.raise_for_status()
+        found = re.findall(
+            'filename=(.+)', r.headers.get('Content-Disposition', ''))
+        basename = found[0].replace('"', '') if found else \
+            url.split('/')[-1].split('?')[0]
+        filename = os.path.join(self.directory, 'data', basename)
+        tmp = filename + '.part'
+        digest = hashlib.md5()
+        with open(tmp, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                digest.update(chunk)
+        checksum = r.headers.get('Content-MD5')
+        if checksum and checksum != digest.hexdigest():
+            os.remove(tmp)
+            raise RuntimeError("Checksum mismatch for {}.".format(basename))
+        shutil.move(tmp, filename)
+
+        with self._lock:
+            self.by_publisher_id[publisher_id] = filename
+            self.by_name[basename] = filename
+            self.by_name[_file_name(publisher_id)] = filename
+            pids = sorted(self.by_publisher_id)
+            self.catalog = astropy.table.Table(
+                [pids, [self.by_publisher_id[x] for x in pids]],
+                names=['publisherID', 'filename'])
+            catalog = self.catalog.copy()
+            catalog['filename'] = [
+                os.path.relpath(x, self.directory)
+                for x in catalog['filename']]
+            tmp = os.path.join(self.directory, '.' + CATALOG_NAME)
+            catalog.write(tmp, format='ascii.ecsv', overwrite=True)
+            os.replace(tmp, os.path.join(self.directory, CATALOG_NAME))
+        return filename
+
+    def _save(self, filename, content):
+        tmp = filename + '.part'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, filename)
+
+
+def _file_name(publisher_id):
+    # e.g. ivo://cadc.nrc.ca/GEMINI?GN-2019A-FT-108-12-001/N20190405S0111
+    return publisher_id.split('/')[-1]
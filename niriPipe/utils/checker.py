@@ -64,19 +64,30 @@
 #
 #
 # ***********************************************************************
+import concurrent.futures
 import astropy.io.fits as fits
 import os
+import niriPipe.utils.checksum
+import niriPipe.utils.datastats
 import niriPipe.utils.tagger
 import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.state
+import niriPipe.utils.tracing
 
 
 class Checker:
     """
     Checks that required products are present and well-formed.
     """
-    def __init__(self, products, state):
+    # Products whose data is a mask, with no DQ plane of their own.
+    mask_products = ('processed_bpm',)
+
+    def __init__(self, products, state, ad_products=None):
         self.products = products
         self.state = state
+        # Products the Tagger wrote from memory; check those headers as is.
+        self.ad_products = ad_products or {}
         self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
             self.__module__, self.__class__.__name__))
         self.keys = niriPipe.utils.tagger.Tagger.keys
@@ -86,6 +97,7 @@ class Checker:
         Check that required products are present, and do a quick check to make
         sure Tagger was run on them.
         """
+        to_scan = []
         for raw_key, product_key in self.keys:
             config_key = 'min_{}s'.format(raw_key)
             product_name = 'processed_{}'.format(product_key)
@@ -94,11 +106,15 @@ class Checker:
                 self.logger.debug("Checking {}".format(product_name))
                 self.logger.debug("Product file is {}".format(
                     self.products[product_name]))
-                if not Checker._check_metadata(
-                        self.products[product_name]):
-                    raise RuntimeError(
-                        "Malformed metadata in processed_{}".format(
-                            product_key))
+                try:
+                    self._check_product(product_name, product_key)
+                except Exception:
+                    niriPipe.utils.metrics.PRODUCTS_CHECKED.inc(
+                        check='metadata', result='failed')
+                    raise
+                niriPipe.utils.metrics.PRODUCTS_CHECKED.inc(
+                    check='metadata', result='passed')
+                to_scan.append(product_name)
                 self.logger.info(
                     "Output {} found: {}".format(
                         product_key,
@@ -114,11 +130,138 @@ class Checker:
                         "{} not required but {} exists on disk!".format(
                             product_name, self.products[product_name]))
 
+        if niriPipe.utils.state.to_bool(
+                self._config().get('deep_check', False)):
+            self._deep_check_all(to_scan)
+
         return self.products
 
+    def _check_product(self, product_name, product_key):
+        if product_name in self.ad_products:
+            well_formed = Checker._check_ad_metadata(
+                self.ad_products[product_name])
+        else:
+            well_formed = Checker._check_metadata(
+                self.products[product_name])
+        if not well_formed:
+            raise RuntimeError(
+                "Malformed metadata in processed_{}".format(product_key))
+        # Products written from memory had their checksums computed from
+        # the file just written; don't reopen them.
+        if self._verify_checksums() and \
+                product_name not in self.ad_products:
+            self._check_checksums(self.products[product_name])
+
+    def _config(self):
+        return self.state['config'].get('CHECKING', {})
+
+    def _deep_check_all(self, product_names):
+        """
+        Deep check products concurrently; raise listing all problems found.
+        """
+        max_workers = max(1, int(self._config().get('max_workers', 1)))
+        parent = niriPipe.utils.tracing.current_span()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(self._traced_deep_check, product_name, parent)
+                for product_name in product_names
+            ]
+            problems = []
+            for product_name, future in zip(product_names, futures):
+                problems.extend(
+                    '{}: {}'.format(product_name, problem)
+                    for problem in future.result())
+        if problems:
+            raise RuntimeError(
+                "Deep check failed: {}".format(' '.join(problems)))
+
+    def _traced_deep_check(self, product_name, parent):
+        with niriPipe.utils.tracing.span(
+                'deep_check', parent=parent,
+                product_name=product_name) as span:
+            problems = self._deep_check(
+                self.products[product_name],
+                mask=product_name in self.mask_products)
+            span.set(problems=len(problems))
+            niriPipe.utils.metrics.PRODUCTS_CHECKED.inc(
+                check='deep', result='failed' if problems else 'passed')
+            return problems
+
+    def _deep_check(self, file, mask=False):
+        """
+        Scan a product's data and check it against the [CHECKING]
+        thresholds. Products without a DQ extension fail too, as their
+        flagged fraction can't be checked, unless they are a mask: then
+        their SCI data is checked as a DQ plane. Returns a list of
+        problems.
+        """
+        config = self._config()
+        max_nan_fraction = float(config.get('max_nan_fraction', 1))
+        max_flagged_fraction = float(config.get('max_flagged_fraction', 1))
+        min_finite_range = config.get('min_finite_range', '')
+
+        problems = []
+        all_stats = niriPipe.utils.datastats.image_stats(file)
+        if not all_stats:
+            problems.append("No image data.")
+        for stats in all_stats:
+            ext = '{}[{}]'.format(stats['extname'], stats['extver'])
+            self.logger.debug("{} {}: {}".format(file, ext, stats))
+            if stats['truncated']:
+                problems.append("{} is truncated.".format(ext))
+                continue
+            if not stats['size']:
+                problems.append("{} has no data.".format(ext))
+                continue
+            if stats['extname'] == 'DQ' or (
+                    mask and stats['extname'] == 'SCI'):
+                flagged_fraction = stats['nonzero'] / stats['size']
+                if flagged_fraction > max_flagged_fraction:
+                    problems.append("{} flags {:.1%} of pixels.".format(
+                        ext, flagged_fraction))
+                continue
+            nan_fraction = stats['nan'] / stats['size']
+            if nan_fraction > max_nan_fraction:
+                problems.append("{} is {:.1%} NaN.".format(ext, nan_fraction))
+            if stats['extname'] != 'SCI':
+                continue
+            if not stats['finite']:
+                problems.append("{} has no finite values.".format(ext))
+            elif min_finite_range != '' and \
+                    stats['max'] - stats['min'] <= float(min_finite_range):
+                problems.append("{} finite range [{}, {}] too small.".format(
+                    ext, stats['min'], stats['max']))
+        if all_stats and not mask and not any(
+                stats['extname'] == 'DQ' for stats in all_stats):
+            problems.append("No DQ extension.")
+        return problems
+
+    def _verify_checksums(self):
+        return niriPipe.utils.state.to_bool(
+            self._config().get('verify_checksums', False))
+
+    def _check_checksums(self, file):
+        """
+        Verify CHECKSUM/DATASUM cards the Tagger wrote, if any.
+        """
+        problems = niriPipe.utils.checksum.verify(file)
+        if problems:
+            raise RuntimeError(
+                "Checksum verification failed for {}: {}".format(
+                    file, ' '.join(problems)))
+        self.logger.debug("Checksums verified for {}".format(file))
+
     @staticmethod
     def _check_metadata(file):
         """
         Do a quick check to make sure Tagger was run on products.
         """
         return (fits.getval(file, 'SOFTWARE', extname='PRIMARY') == 'niriPipe')
+
+    @staticmethod
+    def _check_ad_metadata(ad):
+        """
+        Same as _check_metadata, for a product still in memory.
+        """
+        return ad.phu.get('SOFTWARE') == 'niriPipe'
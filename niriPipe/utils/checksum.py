@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Streaming FITS CHECKSUM/DATASUM support.
+
+The FITS checksum convention sums each HDU as big-endian 32-bit words in
+ones' complement arithmetic. Here the sums are computed straight from a
+memory map of the file, a block at a time, so HDUs are never loaded into
+memory as a whole and data never goes through astropy's data loading.
+"""
+import datetime
+import numpy as np
+import astropy.io.fits as fits
+
+# Words summed per block; 2**20 32-bit words is 4 MiB.
+BLOCK_WORDS = 2 ** 20
+
+# Characters the ASCII encoding must avoid (punctuation between digits
+# and letters).
+_EXCLUDE = (
+    0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40,
+    0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60
+)
+
+
+def _fold(total):
+    """
+    Fold carries back into 32 bits (end-around carry).
+    """
+    while total >> 32:
+        total = (total & 0xFFFFFFFF) + (total >> 32)
+    return total
+
+
+def ones_complement_sum(words, block_words=BLOCK_WORDS):
+    """
+    32-bit ones' complement sum of an array of big-endian uint32 words.
+
+    Each block is summed vectorized into a uint64, which can't overflow
+    for blocks of up to 2**32 words.
+    """
+    total = 0
+    for start in range(0, len(words), block_words):
+        total += int(words[start:start + block_words].sum(dtype=np.uint64))
+    return _fold(total)
+
+
+def sum_bytes(buffer):
+    """
+    Ones' complement sum of a bytes object (e.g. a header).
+    """
+    return ones_complement_sum(np.frombuffer(buffer, dtype='>u4'))
+
+
+def encode(value):
+    """
+    Encode a 32-bit checksum as the 16 character FITS CHECKSUM string.
+    """
+    asc = [0] * 16
+    for i in range(4):
+        byte = (value >> (24 - 8 * i)) & 0xFF
+        quotient = byte // 4 + ord('0')
+        remainder = byte % 4
+        ch = [quotient + remainder, quotient, quotient, quotient]
+        check = True
+        while check:
+            check = False
+            for j in (0, 2):
+                if ch[j] in _EXCLUDE or ch[j + 1] in _EXCLUDE:
+                    ch[j] += 1
+                    ch[j + 1] -= 1
+                    check = True
+        for j in range(4):
+            asc[4 * j + i] = ch[j]
+    # Rotate right by one character.
+    return ''.join(chr(asc[(i + 15) % 16]) for i in range(16))
+
+
+def _file_words(filename):
+    """
+    Memory map a whole FITS file as big-endian 32-bit words.
+
+    FITS files are a whole number of 2880 byte blocks, so a file that
+    isn't a whole number of words is truncated; numpy raises ValueError.
+    """
+    return np.memmap(filename, dtype='>u4', mode='r')
+
+
+def _region_sum(words, start, size):
+    """
+    Ones' complement sum of size bytes of the file from byte start.
+    """
+    return ones_complement_sum(words[start // 4:(start + size) // 4])
+
+
+def data_sums(hdul):
+    """
+    DATASUM of every HDU of an open HDUList, read from its file on disk.
+    """
+    words = _file_words(hdul.filename())
+    sums = []
+    for i in range(len(hdul)):
+        info = hdul.fileinfo(i)
+        sums.append(_region_sum(words, info['datLoc'], info['datSpan']))
+    del words
+    return sums
+
+
+def add_checksums(hdul):
+    """
+    Set CHECKSUM and DATASUM in every HDU of an HDUList opened in update
+    mode, before it is flushed.
+
+    The data sums come from the file as it is on disk (data units aren't
+    changed by header updates); header sums from the headers as astropy
+    will write them.
+    """
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S')
+    for hdu, datasum in zip(hdul, data_sums(hdul)):
+        header = hdu.header
+        header.set(
+            'CHECKSUM', '0' * 16,
+            'HDU checksum updated {}'.format(timestamp))
+        header.set(
+            'DATASUM', str(datasum),
+            'data unit checksum updated {}'.format(timestamp))
+        header_sum = sum_bytes(header.tostring().encode('ascii'))
+        header['CHECKSUM'] = encode(
+            ~_fold(header_sum + datasum) & 0xFFFFFFFF)
+
+
+def verify(filename):
+    """
+    Check CHECKSUM and DATASUM of every HDU of a file that has them.
+
+    Returns a list of problems, empty if everything matches. HDUs without
+    the cards are skipped.
+    """
+    problems = []
+    with fits.open(filename, memmap=True) as hdul:
+        words = _file_words(filename)
+        for i, hdu in enumerate(hdul):
+            if 'CHECKSUM' not in hdu.header or 'DATASUM' not in hdu.header:
+                continue
+            info = hdul.fileinfo(i)
+            datasum = _region_sum(words, info['datLoc'], info['datSpan'])
+            header_sum = _region_sum(
+                words, info['hdrLoc'], info['datLoc'] - info['hdrLoc'])
+            if str(datasum) != str(hdu.header['DATASUM']).strip():
+                problems.append("HDU {}: DATASUM mismatch.".format(i))
+            if _fold(header_sum + datasum) != 0xFFFFFFFF:
+                problems.append("HDU {}: CHECKSUM mismatch.".format(i))
+        del words
+    return problems
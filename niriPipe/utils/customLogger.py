@@ -1,4 +1,12 @@
+import contextlib
+import copy
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import uuid
 """
 We need niriPipe to have a base 'niriPipe' logger that doesn't
 inherit from the true root logger (because other modules seem
@@ -15,9 +23,8 @@ def _create_root_logger():
         niriPipe_root_logger.propagate = False
         niriPipe_root_logger.setLevel(logging.INFO)
         ch = logging.StreamHandler()
-        formatter = logging.Formatter(
-            '%(asctime)s %(name)s %(levelname)s %(message)s')
-        ch.setFormatter(formatter)
+        ch.setFormatter(make_formatter())
+        ch.addFilter(_context_filter)
         niriPipe_root_logger.addHandler(ch)
 
     return niriPipe_root_logger
@@ -35,4 +42,273 @@ def enable_propagation():
     niriPipe_root_logger.propagate = True
 
 
+TEXT_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+FORMATS = ('text', 'json')
+# Attributes added to every niriPipe log record; see log_context().
+CONTEXT_FIELDS = ('run_id', 'stack', 'stage', 'worker')
+_format = 'text'
+_context = dict.fromkeys(CONTEXT_FIELDS)
+_context['run_id'] = uuid.uuid4().hex[:12]
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines, with the log context (run_id, stack,
+    stage and worker), so lines from concurrent stacks can be told apart.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            entry[field] = getattr(record, field, None)
+        entry['process'] = record.processName
+        entry['pid'] = record.process
+        entry['thread'] = record.threadName
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def make_formatter():
+    """
+    A formatter in the current format (see set_format()).
+    """
+    if _format == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def set_format(name):
+    """
+    Log as 'text' (the default) or 'json' lines.
+    """
+    global _format
+    if name not in FORMATS:
+        raise ValueError("Unknown log format: {}".format(name))
+    _format = name
+    for handler in niriPipe_root_logger.handlers + _queued_handlers:
+        if not isinstance(handler, logging.handlers.QueueHandler):
+            handler.setFormatter(make_formatter())
+
+
+def get_context():
+    return dict(_context)
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Set log context fields (see CONTEXT_FIELDS) for the body of the with
+    statement.
+
+    The context is process wide rather than per thread, as each process
+    works on one stack at a time; threads started within the body share it.
+    """
+    unknown = set(fields) - set(CONTEXT_FIELDS)
+    if unknown:
+        raise ValueError("Unknown log context fields: {}".format(
+            ', '.join(sorted(unknown))))
+    saved = dict(_context)
+    _context.update(fields)
+    try:
+        yield
+    finally:
+        _context.update(saved)
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Adds the log context to records reaching the niriPipe handlers.
+
+    Records from other processes (see LogAggregator) already carry their
+    own context, and keep it.
+    """
+    def filter(self, record):
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, _context[field])
+        return True
+
+
+_context_filter = _ContextFilter()
+
+
+class Lazy:
+    """
+    A log message argument computed only if the message is logged, for
+    expensive DEBUG output:
+
+        logger.debug("State:\n%s", Lazy(json.dumps, state, indent=4))
+    """
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self._value = None
+
+    def __str__(self):
+        # Computed once, however many handlers format the record.
+        if self._value is None:
+            self._value = str(self.function(*self.args, **self.kwargs))
+        return self._value
+
+
 niriPipe_root_logger = _create_root_logger()
+
+
+class _Dispatcher:
+    """
+    Hands records from other processes to the logger they were logged to.
+    """
+    def handle(self, record):
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records with their exception formatted into exc_text, rather
+    than appended to the message, so formatters on the other side of the
+    queue (e.g. JsonFormatter) still see it apart from the message.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+_exc_formatter = logging.Formatter()
+_listener = None
+_listener_pid = None
+_queued_handlers = []
+
+
+def start_queue_logging(forward=None):
+    """
+    Route niriPipe logging through a queue, so logging calls never block
+    on stderr or slow (e.g. shared filesystem) log files; a background
+    thread does the writing.
+
+    The handlers of the niriPipe logger are moved behind the queue. With
+    forward (the queue of a LogAggregator in another process), records are
+    sent to that process instead. Call stop_queue_logging() before the
+    process exits, so no records are lost.
+    """
+    global _listener, _listener_pid
+    if _listener_pid not in (None, os.getpid()):
+        # Inherited from the parent of a forked process, whose listener
+        # thread isn't running here; start from the parent's handlers.
+        _restore_handlers()
+        _listener = _listener_pid = None
+    stop_queue_logging()
+
+    _queued_handlers[:] = niriPipe_root_logger.handlers
+    for handler in _queued_handlers:
+        niriPipe_root_logger.removeHandler(handler)
+    handlers = [_QueueHandler(forward)] if forward \
+        else list(_queued_handlers)
+    records = queue.Queue()
+    queue_handler = _QueueHandler(records)
+    # The context is added before queueing, while it's still current.
+    queue_handler.addFilter(_context_filter)
+    niriPipe_root_logger.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    _listener_pid = os.getpid()
+    _listener.start()
+
+
+def stop_queue_logging():
+    """
+    Write out queued records, and log synchronously again.
+    """
+    global _listener
+    if _listener is None or _listener_pid != os.getpid():
+        return
+    _listener.stop()
+    _listener = None
+    _restore_handlers()
+
+
+def _restore_handlers():
+    for handler in list(niriPipe_root_logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            niriPipe_root_logger.removeHandler(handler)
+    for handler in _queued_handlers:
+        niriPipe_root_logger.addHandler(handler)
+    del _queued_handlers[:]
+
+
+def add_handler(handler):
+    """
+    Add a handler to the niriPipe logger, behind the queue if queue
+    logging is on.
+    """
+    handler.addFilter(_context_filter)
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.handlers = _listener.handlers + (handler,)
+    else:
+        niriPipe_root_logger.addHandler(handler)
+
+
+def remove_handler(handler):
+    """
+    Remove a handler added by add_handler(), once it has handled every
+    record logged so far.
+    """
+    if _listener is not None and _listener_pid == os.getpid():
+        # Restarting the listener drains the queue.
+        _listener.stop()
+        _listener.handlers = tuple(
+            h for h in _listener.handlers if h is not handler)
+        _listener.start()
+    else:
+        niriPipe_root_logger.removeHandler(handler)
+
+
+class LogAggregator:
+    """
+    Collects the log records of other (e.g. pool) processes, logging them
+    in this one.
+
+    The other processes call start_queue_logging(forward=aggregator.queue);
+    the queue can be pickled, e.g. to pass it to pool tasks. Records are
+    handed to the logger they were logged to, so they end up wherever this
+    process's logging goes (through its own queue, if queue logging is on
+    here too).
+    """
+    def __init__(self):
+        self._manager = None
+        self._listener = None
+        self.queue = None
+
+    def start(self):
+        self._manager = multiprocessing.Manager()
+        self.queue = self._manager.Queue()
+        self._listener = logging.handlers.QueueListener(
+            self.queue, _Dispatcher())
+        self._listener.start()
+        return self
+
+    def stop(self):
+        self._listener.stop()
+        self._manager.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Memory-bounded statistics of FITS image data.
+
+Data units are memory mapped straight from the file and reduced a block at
+a time, so a product of any size is scanned with a fixed amount of memory.
+"""
+import os
+import numpy as np
+import astropy.io.fits as fits
+
+# Elements reduced per block; 2**22 float64 elements is 32 MiB.
+BLOCK_ELEMENTS = 2 ** 22
+
+_BITPIX = {
+    8: np.dtype('u1'),
+    16: np.dtype('>i2'),
+    32: np.dtype('>i4'),
+    64: np.dtype('>i8'),
+    -32: np.dtype('>f4'),
+    -64: np.dtype('>f8'),
+}
+
+
+def _n_elements(header):
+    naxis = header.get('NAXIS', 0)
+    if not naxis:
+        return 0
+    return int(np.prod([header['NAXIS{}'.format(i + 1)]
+                        for i in range(naxis)]))
+
+
+def _block_stats(stats, block, bscale, bzero):
+    """
+    Fold one block of stored values into stats.
+    """
+    if bscale != 1 or bzero != 0:
+        block = block.astype(np.float64) * bscale + bzero
+    if block.dtype.kind == 'f':
+        finite = np.isfinite(block)
+        n_finite = int(np.count_nonzero(finite))
+        stats['nan'] += int(np.count_nonzero(np.isnan(block)))
+        if n_finite:
+            block_min = np.where(finite, block, np.inf).min()
+            block_max = np.where(finite, block, -np.inf).max()
+    else:
+        n_finite = block.size
+        if n_finite:
+            block_min, block_max = block.min(), block.max()
+    stats['finite'] += n_finite
+    if n_finite:
+        stats['min'] = float(block_min) if stats['min'] is None \
+            else min(stats['min'], float(block_min))
+        stats['max'] = float(block_max) if stats['max'] is None \
+            else max(stats['max'], float(block_max))
+    stats['nonzero'] += int(np.count_nonzero(block))
+
+
+def image_stats(filename, block_elements=BLOCK_ELEMENTS):
+    """
+    Statistics of every image HDU with data (and every named one without).
+
+    Returns a list of dicts with extname, extver, size (number of
+    elements), truncated, nan (NaN count), finite (finite count), min and
+    max (of finite values, None if there are none) and nonzero (count of
+    non-zero values, e.g. flagged DQ pixels).
+    """
+    file_size = os.path.getsize(filename)
+    results = []
+    with fits.open(filename, memmap=True) as hdul:
+        for i, hdu in enumerate(hdul):
+            header = hdu.header
+            if i and header.get('XTENSION') != 'IMAGE':
+                continue
+            size = _n_elements(header)
+            if not size and 'EXTNAME' not in header:
+                continue
+            stats = {
+                'extname': header.get('EXTNAME', 'PRIMARY'),
+                'extver': header.get('EXTVER', 1),
+                'size': size,
+                'truncated': False,
+                'nan': 0,
+                'finite': 0,
+                'min': None,
+                'max': None,
+                'nonzero': 0,
+            }
+            results.append(stats)
+            if not size:
+                continue
+
+            dtype = _BITPIX[header['BITPIX']]
+            offset = hdul.fileinfo(i)['datLoc']
+            if offset + size * dtype.itemsize > file_size:
+                stats['truncated'] = True
+                continue
+            data = np.memmap(filename, dtype=dtype, mode='r',
+                             offset=offset, shape=(size,))
+            bscale = header.get('BSCALE', 1)
+            bzero = header.get('BZERO', 0)
+            for start in range(0, size, block_elements):
+                _block_stats(
+                    stats, data[start:start + block_elements], bscale, bzero)
+            del data
+    return results
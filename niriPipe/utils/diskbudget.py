@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Disk budget shared by concurrent runs.
+
+Stacks reserve their estimated disk footprint in a ledger (an SQLite
+database, so runs in other processes see each other's reservations)
+before downloading anything. A reservation that would take the total over
+the budget waits, first come first served, until others are released; a
+stack that wouldn't fit on its own is refused. Reservations shrink as the
+Reducer deletes raw frames it no longer needs (see [DISKBUDGET] cleanup),
+and are released when the stack finishes.
+
+The shared caches (see niriPipe.utils.batch.SHARED_CACHES) aren't part of
+the budget: frames linked in from the download cache take no extra space
+in a stack's directory, and the caches themselves grow outside any
+reservation.
+"""
+import os
+import socket
+import sqlite3
+import time
+import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.state
+
+
+class DiskBudgetExceeded(RuntimeError):
+    """
+    A reservation can't be (or wasn't, in time) granted.
+    """
+
+
+def from_state(state):
+    """
+    The DiskBudget configured in [DISKBUDGET], or None if there is no
+    ledger or budget.
+    """
+    config = state['config'].get('DISKBUDGET', {})
+    budget_gb = float(config.get('budget_gb', 0) or 0)
+    if not config.get('ledger') or budget_gb <= 0:
+        return None
+    return DiskBudget(
+        config['ledger'], budget_gb * 1e9,
+        wait=niriPipe.utils.state.to_bool(config.get('wait', True)),
+        wait_timeout=float(config.get('wait_timeout', 0) or 0),
+        poll_interval=float(config.get('poll_interval', 10)))
+
+
+def estimate(state, table):
+    """
+    Rough disk footprint in bytes of reducing the frames in table: the raw
+    frames ([DISKBUDGET] frame_mb each) plus DRAGONS intermediates and
+    products (intermediate_ratio times the raw frames).
+    """
+    config = state['config'].get('DISKBUDGET', {})
+    frame_bytes = float(config.get('frame_mb', 4.2)) * 1e6
+    ratio = float(config.get('intermediate_ratio', 2))
+    return int(len(table) * frame_bytes * (1 + ratio))
+
+
+class DiskBudget:
+    """
+    A ledger of disk space reservations against a budget.
+
+    Parameters
+    ----------
+    path: str
+        SQLite database of reservations, shared by all runs on the budget.
+    budget: float
+        Bytes all granted reservations may add up to.
+    wait: bool
+        Wait for room when a reservation doesn't fit, rather than raising
+        DiskBudgetExceeded.
+    wait_timeout: float
+        Seconds to wait before giving up; 0 to wait as long as it takes.
+    poll_interval: float
+        Seconds between checks for room while waiting.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            host TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            created REAL
+        )
+    """
+
+    def __init__(self, path, budget, wait=True, wait_timeout=0,
+                 poll_interval=10):
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        self.wait = wait
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(self.schema)
+
+    def _connect(self):
+        # As for niriPipe.utils.worker.JobQueue, a connection per operation.
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def reserve(self, owner, n_bytes):
+        """
+        Reserve n_bytes for owner (e.g. a stack name), waiting for room if
+        need be; returns the reservation id.
+        """
+        if n_bytes > self.budget:
+            raise DiskBudgetExceeded(
+                "{} needs {:.1f} GB, more than the whole budget of "
+                "{:.1f} GB.".format(owner, n_bytes / 1e9, self.budget / 1e9))
+
+        with self._connect() as connection:
+            reservation = connection.execute(
+                "INSERT INTO reservations (owner, bytes, host, pid, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (owner, int(n_bytes), socket.gethostname(), os.getpid(),
+                 time.time())).lastrowid
+
+        start = time.time()
+        logged = False
+        try:
+            while not self._try_grant(reservation, n_bytes):
+                waited = time.time() - start
+                if not self.wait or (
+                        self.wait_timeout and waited >= self.wait_timeout):
+                    raise DiskBudgetExceeded(
+                        "No room in the disk budget for {} ({:.1f} GB); "
+                        "{:.1f} of {:.1f} GB reserved.".format(
+                            owner, n_bytes / 1e9, self.reserved() / 1e9,
+                            self.budget / 1e9))
+                if not logged:
+                    self.logger.info(
+                        "Waiting for {:.1f} GB of disk budget for {}; "
+                        "{:.1f} of {:.1f} GB reserved.".format(
+                            n_bytes / 1e9, owner, self.reserved() / 1e9,
+                            self.budget / 1e9))
+                    logged = True
+                time.sleep(self.poll_interval)
+        except BaseException:
+            self.release(reservation)
+            raise
+        niriPipe.utils.metrics.DISK_BUDGET_WAIT_SECONDS.observe(
+            time.time() - start)
+        self.logger.info("Reserved {:.1f} GB of disk budget for {}.".format(
+            n_bytes / 1e9, owner))
+        return reservation
+
+    def _try_grant(self, reservation, n_bytes):
+        """
+        Grant a waiting reservation if it fits and nothing has been waiting
+        longer.
+        """
+        self.recover()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            reserved = connection.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM reservations "
+                "WHERE status = 'granted'").fetchone()[0]
+            earlier = connection.execute(
+                "SELECT COUNT(*) FROM reservations "
+                "WHERE status = 'waiting' AND id < ?",
+                (reservation,)).fetchone()[0]
+            granted = not earlier and reserved + n_bytes <= self.budget
+            if granted:
+                connection.execute(
+                    "UPDATE reservations SET status = 'granted' "
+                    "WHERE id = ?", (reservation,))
+            connection.commit()
+        finally:
+            connection.close()
+        return granted
+
+    def shrink(self, reservation, n_bytes):
+        """
+        Give back n_bytes of a reservation, e.g. after deleting files.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE reservations SET bytes = MAX(0, bytes - ?) "
+                "WHERE id = ?", (int(n_bytes), reservation))
+
+    def release(self, reservation):
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM reservations WHERE id = ?", (reservation,))
+
+    def reserved(self):
+        """
+        Bytes currently granted.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM reservations "
+                "WHERE status = 'granted'").fetchone()[0]
+
+    def reservations(self):
+        """
+        All reservations, oldest first.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT * FROM reservations ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def recover(self):
+        """
+        Drop reservations of processes on this host that have died (e.g.
+        were killed); returns how many.
+        """
+        host = socket.gethostname()
+        dead = [
+            row['id'] for row in self.reservations()
+            if row['host'] == host and not _alive(row['pid'])
+        ]
+        if dead:
+            with self._connect() as connection:
+                connection.executemany(
+                    "DELETE FROM reservations WHERE id = ?",
+                    [(x,) for x in dead])
+            self.logger.warning(
+                "Dropped {} disk reservations of dead processes.".format(
+                    len(dead)))
+        return len(dead)
+
+
+def _alive(pid):
+    if pid <= 0:
+        # os.kill() would signal process groups.
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's process.
+        pass
+    return True
+
+
+def reserve(state, table):
+    """
+    Reserve the footprint of reducing table in the configured disk budget,
+    if there is one; the reservation is kept in state.
+    """
+    budget = from_state(state)
+    if budget:
+        state['disk_reservation'] = budget.reserve(
+            state['current_stack']['obs_name'], estimate(state, table))
+
+
+def shrink(state, n_bytes):
+    """
+    Give back n_bytes of state's reservation, if it has one.
+    """
+    budget = from_state(state)
+    if budget and state.get('disk_reservation'):
+        budget.shrink(state['disk_reservation'], n_bytes)
+
+
+def release(state):
+    """
+    Release state's reservation, if it has one.
+    """
+    budget = from_state(state)
+    reservation = state.pop('disk_reservation', None)
+    if budget and reservation:
+        budget.release(reservation)
@@ -71,9 +71,13 @@ import re
 import hashlib
 import shutil
 import glob
-import astrodata
-import gemini_instruments  # noqa: F401
+import random
+import time
+import niriPipe.utils.archive
+import niriPipe.utils.cache
 import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.tracing
 
 
 class Downloader:
@@ -124,8 +128,26 @@ class Downloader:
             self.logger.error("No productID column found in input table.")
             raise e
 
+        # Frames in the shared download cache don't need fetching again.
+        cache = niriPipe.utils.cache.from_state(
+            self.state, 'DATARETRIEVAL', 'cache_path')
+        table = self.table
+        if cache:
+            missing = [
+                i for i, pid in enumerate(pids)
+                if not self._from_cache(cache, pid)
+            ]
+            table = self.table[missing]
+            pids = [pids[i] for i in missing]
+            if not pids:
+                return
+
         try:
-            urls = Cadc.get_data_urls(self.table)
+            url = niriPipe.utils.archive.service_url(self.state)
+            if url:
+                urls = niriPipe.utils.archive.data_urls(url, table)
+            else:
+                urls = Cadc.get_data_urls(table)
         except Exception as e:
             self.logger.error(
                 "Problem getting data urls; did the input table " +
@@ -134,21 +156,81 @@ class Downloader:
             raise e
 
         for url, pid in zip(urls, pids):
-            try:
-                filename = self._get_file(url)
-                self.logger.info("Downloaded {}".format(filename))
-            except Exception as e:
-                self.logger.error(
-                    "Frame {} failed to download.".format(pid),
-                    exc_info=True
-                )
-                raise e
+            with niriPipe.utils.tracing.span(
+                    'download', product_id=pid, cached=False) as span:
+                try:
+                    with niriPipe.utils.metrics.DOWNLOAD_SECONDS.time():
+                        filename = self._get_file(url)
+                    self.logger.info("Downloaded {}".format(filename))
+                    path = os.path.join(self.download_path, filename)
+                    span.set(bytes=os.path.getsize(path))
+                    niriPipe.utils.metrics.FRAMES_DOWNLOADED.inc()
+                    niriPipe.utils.metrics.DOWNLOADED_BYTES.inc(
+                        os.path.getsize(path))
+                    if cache:
+                        cache.put(filename, path)
+                except Exception as e:
+                    self.logger.error(
+                        "Frame {} failed to download.".format(pid),
+                        exc_info=True
+                    )
+                    raise e
+
+    def _from_cache(self, cache, pid):
+        """
+        Link a cached frame into the download directory; False if the frame
+        isn't cached.
+
+        Raw frames are never modified in place, so hard links are safe.
+        """
+        filename = pid + '.fits'
+        path = os.path.join(self.download_path, filename)
+        cached = cache.fetch(filename, path, link=True)
+        niriPipe.utils.metrics.CACHE_REQUESTS.inc(
+            cache='rawData', result='hit' if cached else 'miss')
+        if not cached:
+            return False
+        self.logger.info("Using cached {}".format(filename))
+        with niriPipe.utils.tracing.span(
+                'download', product_id=pid, cached=True,
+                bytes=os.path.getsize(path)):
+            pass
+        return True
 
     def _get_file(self, url):
         """
         Gets a file from the specified url and returns the filename.
+
+        Failed requests (e.g. 503 Service Unavailable) are retried up to
+        [DATARETRIEVAL] max_tries times in all, with exponential backoff
+        from retry_delay seconds, jittered so concurrent downloads don't
+        retry in step; error responses are never written out.
         """
-        r = requests.get(url, stream=True)
+        config = self.state['config']['DATARETRIEVAL']
+        max_tries = int(config.get('max_tries', 5))
+        retry_delay = float(config.get('retry_delay', 1))
+        for n_tries in range(1, max_tries + 1):
+            r = None
+            try:
+                r = requests.get(url, stream=True)
+                r.raise_for_status()
+                break
+            except requests.RequestException as e:
+                # Give the connection back to the pool before waiting.
+                if r is not None:
+                    r.close()
+                if n_tries == max_tries:
+                    self.logger.error("Giving up on {} after {} tries.".format(
+                        url, n_tries))
+                    raise e
+                self.logger.warning(
+                    "Retrying download of {} ({}); attempt {}.".format(
+                        url, e, n_tries))
+                span = niriPipe.utils.tracing.current_span()
+                if span:
+                    span.increment('retries')
+                delay = retry_delay * 2 ** (n_tries - 1)
+                time.sleep(random.uniform(delay / 2, delay))
         # Parse out filename from header
         try:
             filename = re.findall(
@@ -164,7 +246,8 @@ class Downloader:
 
         # Write the fits file to the current directory, verifying the md5
         # hash as we go. Store partial results in a temporary file.
-        self._write_with_temp_file(r, filename)
+        with r:
+            self._write_with_temp_file(r, filename)
 
         return filename
 
@@ -227,6 +310,10 @@ class Downloader:
         """
         Returns UT date from fits file.
         """
+        # astrodata (and the instrument definitions it needs to read NIRI
+        # files) are slow to import and only needed here.
+        import astrodata
+        import gemini_instruments  # noqa: F401
         return astrodata.open(fits_file).ut_date()
 
     def _find_fits(self, path):
@@ -70,16 +70,28 @@ import re
 import io
 from cadcutils import net
 from cadcdata import CadcDataClient
+import niriPipe.utils.archive
+import niriPipe.utils.cache
 import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.tracing
 
 
 class Finder:
     """
     Finds all data for a given NIRI stack.
     """
+    # Calibration frames are searched for within this many days of the
+    # object frames.
+    windows = {'flat': 14, 'longdark': 14, 'shortdark': 7}
 
-    def __init__(self, state):
+    def __init__(self, state, strict=True):
         self.state = state
+        # Unless strict, missing frames are recorded in self.shortfalls
+        # (frame type: (required, found)) instead of raising, so a plan can
+        # report every shortfall at once.
+        self.strict = strict
+        self.shortfalls = {}
         self.logger = niriPipe.utils.customLogger.get_logger(
             '{}.{}'.format(
                 self.__module__, self.__class__.__name__))
@@ -110,6 +122,8 @@ class Finder:
             "AND Observation.instrument_name = 'NIRI' " + \
             "AND Plane.dataProductType = 'image' "
         self.query_suffix = "ORDER BY observationID"
+        # Observation name part of an observationID; see _segment().
+        self.obs_name_pattern = re.compile(r'.+?(?=-\d\d\d$)')
 
     def run(self):
         """
@@ -122,15 +136,36 @@ class Finder:
         calibrations. NIRI needs flat field frames, long darks (darks with
         the same integration time as science frames), and optional short darks
         (1 second darks used to generate a bad pixel mask).
+
+        Stacks of a batch associated ahead of time (see
+        niriPipe.utils.association) have their frames already.
         """
+        association = self.state['current_stack'].get('association')
+        if association:
+            return self._from_association(association)
 
         return astropy.table.vstack([
             self._mark_as('object', self._find_objects()),
-            self._mark_as('flat', self._segment(self._find_flats())),
-            self._mark_as('longdark', self._segment(self._find_longdarks())),
-            self._mark_as('shortdark', self._segment(self._find_shortdarks()))
+            self._mark_as('flat', self._budget(
+                'flat', self._segment(self._find_flats()))),
+            self._mark_as('longdark', self._budget(
+                'longdark', self._segment(self._find_longdarks()))),
+            self._mark_as('shortdark', self._budget(
+                'shortdark', self._segment(self._find_shortdarks())))
         ])
 
+    def _from_association(self, association):
+        """
+        Frames of the current stack found by an Associator, and the stack
+        metadata _find_objects() would set.
+        """
+        for key in ['exptime', 'mjd_date', 'proposal_id', 'camera']:
+            self.state['current_stack'][key] = association[key]
+        table = astropy.table.Table.read(association['table'])
+        self.logger.info("Using {} associated frames from {}.".format(
+            len(table), association['table']))
+        return table
+
     def _log_basic_constraints(self):
         """
         Log constraints that must be provided for the program to work.
@@ -150,6 +185,13 @@ class Finder:
         self.logger.debug("Min required shortdark frames: {}".format(
             self.state['config']['DATAFINDER']['min_shortdarks']))
 
+        for frame_type in ['flat', 'longdark', 'shortdark']:
+            budget = self.state['config']['DATAFINDER'].get(
+                'max_{}s'.format(frame_type))
+            if budget and int(budget):
+                self.logger.debug("Max allowed {} frames: {}".format(
+                    frame_type, budget))
+
     def _find_objects(self):
         """
         Find OBJECT frames and set metadata used to find calibrations.
@@ -193,15 +235,7 @@ class Finder:
         NIRI has three cameras and (I think) we need to make sure the camera
         used in flats matches the camera used for the object frames.
         """
-        flat_query = self.query_prefix + \
-            "AND Observation.type = 'FLAT' " + \
-            "AND Plane.time_bounds_lower >= '{:.4f}' ".format(
-                 self.state['current_stack']['mjd_date'] - 14) + \
-            "AND Plane.time_bounds_lower <= '{:.4f}' ".format(
-                 self.state['current_stack']['mjd_date'] + 14) + \
-            "AND Plane.energy_bandpassName = '{}' ".format(
-                self.state['current_stack']['bandpass']) + \
-            self.query_suffix
+        flat_query = self._calibration_query('flat', *self._window('flat'))
 
         flat_table = self._find_frames(flat_query, 'flat')
 
@@ -237,15 +271,8 @@ class Finder:
 
         Long darks are darks with the same integration time as object frames.
         """
-        longdark_query = self.query_prefix + \
-            "AND Observation.type = 'DARK' " + \
-            "AND Plane.time_bounds_lower >= '{:.4f}' ".format(
-                 self.state['current_stack']['mjd_date'] - 14) + \
-            "AND Plane.time_bounds_lower <= '{:.4f}' ".format(
-                 self.state['current_stack']['mjd_date'] + 14) + \
-            "AND Plane.time_exposure = '{}' ".format(
-                self.state['current_stack']['exptime']) + \
-            self.query_suffix
+        longdark_query = self._calibration_query(
+            'longdark', *self._window('longdark'))
 
         return self._find_frames(longdark_query, 'longdark')
 
@@ -255,18 +282,43 @@ class Finder:
 
         Used to create a "fresh" bad pixel mask.
         """
-        shortdark_query = self.query_prefix + \
-            "AND Observation.type = 'DARK' " + \
-            "AND Plane.time_bounds_lower >= '{:.4f}' ".format(
-                self.state['current_stack']['mjd_date'] - 7) + \
-            "AND Plane.time_bounds_lower <= '{:.4f}' ".format(
-                self.state['current_stack']['mjd_date'] + 7) + \
-            "AND Plane.time_exposure >= '0.99' " + \
-            "AND Plane.time_exposure <= '1.01' " + \
-            self.query_suffix
+        shortdark_query = self._calibration_query(
+            'shortdark', *self._window('shortdark'))
 
         return self._find_frames(shortdark_query, 'shortdark')
 
+    def _window(self, frame_type):
+        """
+        MJD range to search for calibration frames of a type in.
+        """
+        mjd_date = self.state['current_stack']['mjd_date']
+        return (mjd_date - self.windows[frame_type],
+                mjd_date + self.windows[frame_type])
+
+    def _calibration_query(self, frame_type, start, end):
+        """
+        Query for calibration frames of a type matching the current stack,
+        starting between MJDs start and end.
+        """
+        if frame_type == 'flat':
+            constraints = \
+                "AND Plane.energy_bandpassName = '{}' ".format(
+                    self.state['current_stack']['bandpass'])
+        elif frame_type == 'longdark':
+            constraints = "AND Plane.time_exposure = '{}' ".format(
+                self.state['current_stack']['exptime'])
+        else:
+            constraints = \
+                "AND Plane.time_exposure >= '0.99' " + \
+                "AND Plane.time_exposure <= '1.01' "
+        return self.query_prefix + \
+            "AND Observation.type = '{}' ".format(
+                'FLAT' if frame_type == 'flat' else 'DARK') + \
+            "AND Plane.time_bounds_lower >= '{:.4f}' ".format(start) + \
+            "AND Plane.time_bounds_lower <= '{:.4f}' ".format(end) + \
+            constraints + \
+            self.query_suffix
+
     def _find_frames(self, query, frame_type):
         """
         Do the heavy lifting of finding frames from CADC.
@@ -285,12 +337,7 @@ class Finder:
             return astropy.table.Table(
                 names=self.min_columns,
                 dtype=self.col_dtypes)
-        self.logger.debug("{} query: \n{}".format(frame_type, query))
-        try:
-            table = self._do_query_retry_wrapper(query, 1)
-        except Exception as e:
-            self.logger.critical("{} query failed.".format(frame_type))
-            raise e
+        table = self._query_frames(query, frame_type)
 
         self._check_sufficient_frames(
             key=key, frame_type=frame_type, table=table)
@@ -298,6 +345,25 @@ class Finder:
         self.logger.info("Found {} {} frames.".format(len(table), frame_type))
         return table
 
+    def _query_frames(self, query, frame_type):
+        """
+        Run a query for frames of a type, with retries, tracing and metrics.
+        """
+        self.logger.debug("{} query: \n{}".format(frame_type, query))
+        with niriPipe.utils.tracing.span(
+                'tap_query', frame_type=frame_type, retries=0) as span:
+            try:
+                with niriPipe.utils.metrics.TAP_QUERY_SECONDS.time(
+                        frame_type=frame_type):
+                    table = self._do_query_retry_wrapper(query, 1)
+            except Exception as e:
+                self.logger.critical("{} query failed.".format(frame_type))
+                raise e
+            span.set(rows=len(table) if table else 0)
+        niriPipe.utils.metrics.FRAMES_FOUND.inc(
+            len(table) if table else 0, frame_type=frame_type)
+        return table
+
     def _do_query_retry_wrapper(self, query, n_tries):
         """
         Recursive wrapper to retry failed queries.
@@ -306,11 +372,24 @@ class Finder:
             raise RuntimeError("Max retries exceeded!")
         else:
             try:
-                return Finder._do_query(query)
+                return self._query(query)
             except Exception:
                 self.logger.warning("Retrying query; attempt {}.".format(
                     n_tries))
-                self._do_query_retry_wrapper(query, n_tries+1)
+                niriPipe.utils.metrics.TAP_QUERY_RETRIES.inc()
+                span = niriPipe.utils.tracing.current_span()
+                if span:
+                    span.increment('retries')
+                return self._do_query_retry_wrapper(query, n_tries+1)
+
+    def _query(self, query):
+        """
+        Query the configured data source ([DATARETRIEVAL] dataSource).
+        """
+        url = niriPipe.utils.archive.service_url(self.state)
+        if url:
+            return niriPipe.utils.archive.tap_query(url, query)
+        return Finder._do_query(query)
 
     @staticmethod
     def _do_query(query):  # pragma: no cover
@@ -326,18 +405,24 @@ class Finder:
     def _check_sufficient_frames(self, key, frame_type, table):
         """
         Make sure a table has sufficient number of frames of a given
-        type, else raise a RuntimeError.
+        type, else raise a RuntimeError (or record a shortfall, if not
+        strict).
         """
         if ((not table) and int(self.state['config']['DATAFINDER'][key])) or \
                 (len(table) < int(self.state['config']['DATAFINDER'][key])):
 
             table_length = 0 if not table else len(table)
-            raise RuntimeError("Required {} {} frames; found {}.".format(
+            message = "Required {} {} frames; found {}.".format(
                 self.state['config']['DATAFINDER'][key],
                 frame_type,
-                table_length))
-
-    def _metadata_from_header(self, productID, card):  # pragma: no cover
+                table_length)
+            if self.strict:
+                raise RuntimeError(message)
+            self.logger.warning(message)
+            self.shortfalls[frame_type] = (
+                int(self.state['config']['DATAFINDER'][key]), table_length)
+
+    def _metadata_from_header(self, productID, card):
         """
         Use cadc-data to get metadata not findable by tap.
 
@@ -346,17 +431,54 @@ class Finder:
         There are probably better ways to do this, but the intention is to
         minimize the use of this method.
         """
+        contents = self._header(productID)
+        if card == 'CAMERA':
+            pattern = re.compile(r'(?<=CAMERA  \= \')[^\s]*')
+            return pattern.search(contents).group()
+        else:
+            raise ValueError("Card {} not implemented.".format(card))
+
+    def _header(self, productID):
+        """
+        Header text of a file, from the header cache if one is configured
+        ([DATAFINDER] header_cache).
+        """
+        cache = niriPipe.utils.cache.from_state(
+            self.state, 'DATAFINDER', 'header_cache')
+        key = productID + '.hdr'
+        with niriPipe.utils.tracing.span(
+                'header_fetch', product_id=productID, cached=False) as span:
+            if cache:
+                contents = cache.read(key)
+                niriPipe.utils.metrics.CACHE_REQUESTS.inc(
+                    cache='headers',
+                    result='miss' if contents is None else 'hit')
+                if contents is not None:
+                    self.logger.debug("Using cached header of {}.".format(
+                        productID))
+                    span.set(cached=True, bytes=len(contents))
+                    return contents.decode('utf-8')
+            url = niriPipe.utils.archive.service_url(self.state)
+            if url:
+                contents = niriPipe.utils.archive.fetch_header(url, productID)
+            else:
+                contents = Finder._fetch_header(productID)
+            span.set(bytes=len(contents))
+            if cache:
+                cache.write(key, contents.encode('utf-8'))
+            return contents
+
+    @staticmethod
+    def _fetch_header(productID):  # pragma: no cover
+        """
+        Get the header text of a file from CADC.
+        """
         anonSubject = net.Subject()
         client = CadcDataClient(anonSubject)
         with io.BytesIO() as f:
             f.name = None
             client.get_file('GEM', productID, f, fhead=True)
-            contents = f.getvalue().decode('utf-8')
-            if card == 'CAMERA':
-                pattern = re.compile(r'(?<=CAMERA  \= \')[^\s]*')
-                return pattern.search(contents).group()
-            else:
-                raise ValueError("Card {} not implemented.".format(card))
+            return f.getvalue().decode('utf-8')
 
     def _segment(self, in_table):
         """
@@ -388,8 +510,7 @@ class Finder:
         #   ivo://cadc.nrc.ca/GEMINI?GN-CAL20190406-8-004/N20190406S0115
         # Results:
         # GN-CAL20190404-10, GN-2019A-FT-108-12, GN-CAL20190406-8
-        pattern = re.compile(
-            r'.+?(?=-\d\d\d$)')
+        pattern = self.obs_name_pattern
 
         new_column = []
         for item in in_table['observationID']:
@@ -432,6 +553,57 @@ class Finder:
             "Segmentation finished with {} frames.".format(len(out_table)))
         return out_table
 
+    def _budget(self, frame_type, in_table):
+        """
+        Cap the number of frames of a type to 'max_<frame_type>s'.
+
+        Complete observations are preferred: observations are taken whole
+        in order of how close they are in time to the object frames, and
+        only the last one taken is cut down to its frames closest in time.
+        A missing or zero budget means no limit.
+        """
+        key = 'max_{}s'.format(frame_type)
+        budget = int(self.state['config']['DATAFINDER'].get(key, 0))
+        if not budget or len(in_table) <= budget:
+            return in_table
+
+        min_key = 'min_{}s'.format(frame_type)
+        if budget < int(self.state['config']['DATAFINDER'][min_key]):
+            raise ValueError("{} ({}) is smaller than {} ({}).".format(
+                key, budget,
+                min_key, self.state['config']['DATAFINDER'][min_key]))
+
+        mjd_date = self.state['current_stack']['mjd_date']
+        times = list(in_table['time_bounds_lower'])
+
+        # Group rows by observation; rows with an observationID we can't
+        # parse are treated as observations of their own.
+        observations = {}
+        for i, item in enumerate(in_table['observationID']):
+            if isinstance(item, bytes):  # pragma: no cover
+                item = item.decode('utf-8')
+            match = self.obs_name_pattern.search(item)
+            name = match.group() if match else item
+            observations.setdefault(name, []).append(i)
+
+        def obs_delta(name):
+            obs_times = [times[i] for i in observations[name]]
+            return abs((max(obs_times) + min(obs_times)) / 2 - mjd_date)
+
+        selected = []
+        for name in sorted(observations, key=obs_delta):
+            rows = sorted(
+                observations[name], key=lambda i: abs(times[i] - mjd_date))
+            selected.extend(rows[:budget - len(selected)])
+            if len(selected) == budget:
+                break
+
+        out_table = in_table[sorted(selected)]
+        self.logger.info(
+            "Kept {} of {} {} frames within budget.".format(
+                len(out_table), len(in_table), frame_type))
+        return out_table
+
     def _mark_as(self, in_type, table):
         """
         Add a column (niriPipe_type) to all entries of table.
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+A local stand-in for the CADC services niriPipe uses, for offline tests
+and reproducible throughput measurements.
+
+It serves the interface described in niriPipe.utils.archive from a
+catalog of local files: an astropy table (e.g. ECSV) with the columns
+Finder queries for, plus a filename column (relative to the catalog).
+Point a pipeline at it by setting [DATARETRIEVAL] dataSource to its URL.
+
+Only the ADQL Finder builds is understood: conditions "<column> <op>
+'<value>'" (op one of =, <=, >= or LIKE) joined by AND, and ORDER BY one
+column. Conditions on columns the catalog doesn't have are ignored.
+
+Latency (added to every request), bandwidth (of file downloads) and
+errors (a fraction of requests answered with 503) can be injected to test
+retries and concurrency.
+"""
+import hashlib
+import http.server
+import io
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+import astropy.io.fits as fits
+import astropy.io.votable
+import astropy.table
+import niriPipe.utils.customLogger
+
+CONDITION = re.compile(
+    r"(?:\w+\.)?(\w+)\s*(>=|<=|=|LIKE)\s*'([^']*)'", re.IGNORECASE)
+SELECT = re.compile(r'^\s*SELECT\s+(.+?)\s+FROM\s', re.IGNORECASE | re.DOTALL)
+ORDER_BY = re.compile(r'ORDER\s+BY\s+(?:\w+\.)?(\w+)', re.IGNORECASE)
+CHUNK_BYTES = 64 * 1024
+
+
+def read_catalog(filename):
+    """
+    Read a catalog, making its filenames absolute.
+    """
+    catalog = astropy.table.Table.read(filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    catalog['filename'] = [
+        os.path.join(directory, str(x)) for x in catalog['filename']]
+    return catalog
+
+
+def query(catalog, adql):
+    """
+    Rows of catalog matching an ADQL query, as Finder builds them.
+    """
+    mask = [True] * len(catalog)
+    where = re.split(r'\sWHERE\s', adql, maxsplit=1, flags=re.IGNORECASE)
+    for column, op, value in CONDITION.findall(
+            where[1] if len(where) > 1 else ''):
+        if column not in catalog.colnames:
+            continue
+        mask = [
+            keep and _matches(row_value, op.upper(), value)
+            for keep, row_value in zip(mask, catalog[column])
+        ]
+    result = catalog[mask]
+
+    order = ORDER_BY.search(adql)
+    if order and order.group(1) in result.colnames and len(result):
+        result.sort(order.group(1))
+
+    columns = SELECT.search(adql)
+    if columns and columns.group(1).strip() != '*':
+        result = result[[
+            name.strip().split('.')[-1]
+            for name in columns.group(1).split(',')]]
+    return result
+
+
+def _matches(row_value, op, value):
+    if op == 'LIKE':
+        pattern = '.*'.join(re.escape(part) for part in value.split('%'))
+        return re.fullmatch(pattern.replace('_', '.'), str(row_value)) \
+            is not None
+    if not isinstance(row_value, str):
+        value = float(value)
+    if op == '=':
+        return row_value == value
+    if op == '<=':
+        return row_value <= value
+    return row_value >= value
+
+
+def _votable_bytes(table):
+    # CADC declares publisherID variable length, so astropy reads it as an
+    # object column; do the same (astropy can't write empty object columns).
+    if 'publisherID' in table.colnames and len(table):
+        table = table.copy(copy_data=False)
+        table['publisherID'] = table['publisherID'].astype(object)
+    f = io.BytesIO()
+    astropy.io.votable.from_table(table).to_xml(f)
+    return f.getvalue()
+
+
+def header_text(filename):
+    """
+    Header text of every HDU of a file, as the CADC fhead option gives it.
+    """
+    with fits.open(filename) as hdul:
+        return ''.join(
+            hdu.header.tostring(sep='\n', endcard=True, padding=False) +
+            '\n' for hdu in hdul)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        self.server.localcadc.logger.debug(format % args)
+
+    def do_GET(self):
+        self._handle(body=True)
+
+    def do_HEAD(self):
+        self._handle(body=False)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._handle(body=True, form=urllib.parse.parse_qs(
+            self.rfile.read(length).decode('utf-8')))
+
+    def _handle(self, body, form=None):
+        localcadc = self.server.localcadc
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        params.update(form or {})
+        time.sleep(localcadc.latency)
+        if localcadc._count_request():
+            return self._send(503, b'Injected error.\n', 'text/plain', body)
+        try:
+            if url.path == '/tap/sync':
+                self._tap(params, body)
+            elif url.path == '/datalink':
+                self._datalink(params, body)
+            elif url.path.startswith('/data/'):
+                self._data(urllib.parse.unquote(url.path[len('/data/'):]),
+                           params, body)
+            else:
+                self._send(404, b'Not found.\n', 'text/plain', body)
+        except Exception as e:
+            localcadc.logger.error("Request {} failed.".format(self.path),
+                                   exc_info=True)
+            self._send(500, '{}\n'.format(e).encode('utf-8'), 'text/plain',
+                       body)
+
+    def _send(self, status, content, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def _tap(self, params, body):
+        result = self.server.localcadc.tap(params['QUERY'][0])
+        self._send(200, _votable_bytes(result), 'application/x-votable+xml',
+                   body)
+
+    def _datalink(self, params, body):
+        localcadc = self.server.localcadc
+        base = 'http://{}'.format(self.headers['Host'])
+        ids, urls = [], []
+        for publisher_id, name in localcadc.resolve(
+                params.get('ID', [])).items():
+            ids.append(publisher_id)
+            urls.append('{}/data/{}'.format(base, urllib.parse.quote(name)))
+        table = astropy.table.Table(
+            [ids, urls, ['#this'] * len(ids)],
+            names=['ID', 'access_url', 'semantics'], dtype=[str, str, str])
+        self._send(200, _votable_bytes(table), 'application/x-votable+xml',
+                   body)
+
+    def _data(self, name, params, body):
+        localcadc = self.server.localcadc
+        if params.get('fhead', ['false'])[0].lower() == 'true':
+            text = localcadc.header(name)
+            if text is None:
+                return self._send(404, b'Not found.\n', 'text/plain', body)
+            return self._send(200, text.encode('utf-8'), 'text/plain', body)
+        filename = localcadc.find(name)
+        if not filename:
+            return self._send(404, b'Not found.\n', 'text/plain', body)
+
+        size = os.path.getsize(filename)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/fits')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Content-MD5', localcadc.md5(filename))
+        self.send_header('Content-Disposition', 'inline; filename="{}"'.format(
+            os.path.basename(filename)))
+        self.end_headers()
+        if not body:
+            return
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                if localcadc.bandwidth:
+                    time.sleep(len(chunk) / localcadc.bandwidth)
+                self.wfile.write(chunk)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class LocalCadc:
+    """
+    Serves a catalog of local files like CADC does.
+
+    Parameters
+    ----------
+    catalog: :obj:`astropy.table.Table`
+        Files to serve; see read_catalog().
+    host, port: str, int
+        Address to listen on; port 0 picks a free port (see url).
+    latency: float
+        Seconds added to every request.
+    bandwidth: float
+        Bytes per second each file download is limited to; None for no
+        limit.
+    error_rate: float
+        Fraction of requests answered with 503 Service Unavailable.
+    seed: int
+        Seed for choosing which requests fail, for repeatable runs.
+    """
+    def __init__(self, catalog, host='127.0.0.1', port=0, latency=0,
+                 bandwidth=None, error_rate=0, seed=None):
+        self.catalog = catalog
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        self.by_publisher_id = {
+            str(row['publisherID']): row['filename'] for row in catalog}
+        self.by_name = {
+            os.path.basename(str(f)): str(f) for f in catalog['filename']}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._md5 = {}
+        self._thread = None
+        self.server = _Server((host, port), _Handler)
+        self.server.localcadc = self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def tap(self, adql):
+        """
+        Result of an ADQL query, as an astropy table.
+        """
+        return query(self.catalog, adql)
+
+    def resolve(self, publisher_ids):
+        """
+        Names (under /data/) of the files with the given publisherIDs,
+        keyed by publisherID; unknown publisherIDs are left out.
+        """
+        return {
+            publisher_id: os.path.basename(self.by_publisher_id[publisher_id])
+            for publisher_id in publisher_ids
+            if publisher_id in self.by_publisher_id
+        }
+
+    def find(self, name):
+        """
+        Path of the file served as name (with or without .fits), or None.
+        """
+        return self.by_name.get(name) or self.by_name.get(name + '.fits')
+
+    def header(self, name):
+        """
+        Header text of the file served as name, or None.
+        """
+        filename = self.find(name)
+        return header_text(filename) if filename else None
+
+    def md5(self, filename):
+        """
+        MD5 hex digest of a file, computed once.
+
+        Files are hashed outside the lock, so concurrent requests for other
+        files aren't held up; two requests for the same cold file may both
+        hash it.
+        """
+        with self._lock:
+            if filename in self._md5:
+                return self._md5[filename]
+        digest = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        with self._lock:
+            return self._md5.setdefault(filename, digest.hexdigest())
+
+    def _count_request(self):
+        """
+        Count a request; True if it should fail.
+        """
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def serve_forever(self):
+        self.logger.info("Serving {} files at {}".format(
+            len(self.catalog), self.url))
+        self.server.serve_forever()
+
+    def start(self):
+        """
+        Serve from a background thread.
+        """
+        self._thread = threading.Thread(
+            target=self.serve_forever, name='LocalCadc', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Pipeline metrics, written as Prometheus text format snapshots.
+
+Stages update the module-level metrics below in REGISTRY; a snapshot is
+written to [METRICS] textfile at the end of each run, and periodically by
+batches and workers (see niriPipe.utils.batch). Snapshots are written
+atomically, so they can be collected by the node exporter's textfile
+collector.
+"""
+import bisect
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+
+# Seconds; from a quick header fetch to a long DRAGONS reduction.
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Metric:
+    """
+    A metric with values per combination of label values.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), lock=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = lock or threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} takes labels {}, not {}.".format(
+                self.name, list(self.labelnames), sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, _escape(value))
+            for name, value in pairs) + '}'
+
+
+class Counter(Metric):
+    """
+    A count that only goes up.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _merge(self, key, value):
+        self.values[key] = self.values.get(key, 0) + value
+
+    def _samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, self._labels(key), value)
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in buckets, plus their sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), lock=None,
+                 buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value_dict = self.values.setdefault(key, self._empty())
+            value_dict['buckets'][
+                bisect.bisect_left(self.buckets, value)] += 1
+            value_dict['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the body of the with statement.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _empty(self):
+        # One count per bucket, plus the +Inf bucket.
+        return {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+
+    def _merge(self, key, value):
+        value_dict = self.values.setdefault(key, self._empty())
+        value_dict['buckets'] = [
+            a + b for a, b in zip(value_dict['buckets'], value['buckets'])]
+        value_dict['sum'] += value['sum']
+
+    def _samples(self):
+        for key, value in sorted(self.values.items()):
+            cumulative = 0
+            bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, value['buckets']):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, self._labels(key, [('le', bound)]),
+                    cumulative)
+            yield '{}_sum{} {}'.format(
+                self.name, self._labels(key), value['sum'])
+            yield '{}_count{} {}'.format(
+                self.name, self._labels(key), cumulative)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+class Registry:
+    """
+    A set of metrics.
+
+    Pipelines run by batches and workers run in other processes; they
+    send their registry's dump() back to be merge()d into the parent's.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(
+                    name, *args, lock=self._lock, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DURATION_BUCKETS):
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def clear(self):
+        """
+        Reset all values.
+        """
+        with self._lock:
+            for metric in self.metrics.values():
+                metric.values = {}
+
+    def dump(self):
+        """
+        All values, as something picklable (and JSON serializable).
+        """
+        with self._lock:
+            return {
+                name: [[list(key), value]
+                       for key, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+
+    def merge(self, dump):
+        """
+        Add values from another registry's dump(); metrics this registry
+        doesn't have are ignored.
+        """
+        with self._lock:
+            for name, values in dump.items():
+                if name in self.metrics:
+                    for key, value in values:
+                        self.metrics[name]._merge(tuple(key), value)
+
+    def to_text(self):
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self.metrics.items()):
+                lines.append('# HELP {} {}'.format(
+                    name, metric.documentation))
+                lines.append('# TYPE {} {}'.format(name, metric.type))
+                lines.extend(metric._samples())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        """
+        Write a snapshot of all metrics to filename, atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(
+            prefix='.' + os.path.basename(filename), dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.to_text())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class PeriodicWriter:
+    """
+    Writes registry snapshots to filename, at most every interval seconds
+    (see maybe_write()), for long-running batches and workers.
+    """
+    def __init__(self, registry, filename, interval=60):
+        self.registry = registry
+        self.filename = filename
+        self.interval = interval
+        self.last_write = None
+
+    def maybe_write(self):
+        if self.last_write is None or \
+                time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.registry.write_textfile(self.filename)
+        self.last_write = time.monotonic()
+
+
+REGISTRY = Registry()
+
+STACKS = REGISTRY.counter(
+    'niripipe_stacks_total', 'Stacks run, by outcome.', ['status'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'niripipe_stage_duration_seconds', 'Time taken by pipeline stages.',
+    ['stage'])
+TAP_QUERY_SECONDS = REGISTRY.histogram(
+    'niripipe_tap_query_duration_seconds',
+    'Latency of CADC TAP queries, including retries.', ['frame_type'])
+TAP_QUERY_RETRIES = REGISTRY.counter(
+    'niripipe_tap_query_retries_total', 'Retried CADC TAP queries.')
+FRAMES_FOUND = REGISTRY.counter(
+    'niripipe_frames_found_total', 'Frames found by CADC TAP queries.',
+    ['frame_type'])
+CACHE_REQUESTS = REGISTRY.counter(
+    'niripipe_cache_requests_total',
+    'Shared cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result'])
+FRAMES_DOWNLOADED = REGISTRY.counter(
+    'niripipe_frames_downloaded_total', 'Frames downloaded from CADC.')
+DOWNLOADED_BYTES = REGISTRY.counter(
+    'niripipe_downloaded_bytes_total', 'Bytes downloaded from CADC.')
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'niripipe_download_duration_seconds',
+    'Time taken to download each frame.')
+PRODUCT_SECONDS = REGISTRY.histogram(
+    'niripipe_dragons_product_duration_seconds',
+    'Time taken by DRAGONS to make each product.', ['frame_type'])
+PRODUCTS_TAGGED = REGISTRY.counter(
+    'niripipe_products_tagged_total', 'Products tagged with CADC metadata.')
+PRODUCTS_CHECKED = REGISTRY.counter(
+    'niripipe_products_checked_total',
+    'Products checked, by check (metadata or deep) and result (passed or '
+    'failed).', ['check', 'result'])
+DISK_BUDGET_WAIT_SECONDS = REGISTRY.histogram(
+    'niripipe_disk_budget_wait_seconds',
+    'Time stacks waited for room in the disk budget.')
+FREED_BYTES = REGISTRY.counter(
+    'niripipe_freed_bytes_total',
+    'Bytes of raw frames deleted once no longer needed.')
+
+
+def from_state(state):
+    """
+    Metrics snapshot file configured in state ([METRICS] textfile), or
+    None if it's missing or empty.
+    """
+    return state['config'].get('METRICS', {}).get('textfile') or None
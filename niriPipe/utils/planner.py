@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Dry-run planning: what a run would download and reduce, without doing it.
+"""
+import concurrent.futures
+import json
+import os
+import requests
+from astroquery.cadc import Cadc
+import niriPipe.utils.archive
+import niriPipe.utils.cache
+import niriPipe.utils.customLogger
+import niriPipe.utils.finder
+
+
+# Calibration products in the order the Reducer makes them, as (product
+# name, frame type deciding whether it's made, frame types of its inputs,
+# recipe name); see Reducer._make_dark() etc.
+CALIBRATIONS = [
+    ('processed_dark', 'longdark', ['longdark'], None),
+    ('processed_bpm', 'shortdark', ['flat', 'shortdark'], 'makeProcessedBPM'),
+    ('processed_flat', 'flat', ['flat'], None),
+]
+STACK = ('processed_stack', 'object', ['object'], None)
+FRAME_TYPES = ['object', 'flat', 'longdark', 'shortdark']
+
+
+class Planner:
+    """
+    Plans a run: finds frames like a run would, then reports how many of
+    each type there are, how many bytes would be downloaded, what is
+    already cached, which calibrations could be reused and roughly how long
+    the run would take. Nothing is downloaded or reduced.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        self.config = self.state['config'].get('PLANNING', {})
+
+    def run(self):
+        """
+        Make the plan and return it as a dict; plan['feasible'] is False if
+        the [DATAFINDER] min_* requirements can't be met.
+        """
+        plan = {
+            'obs_name': self.state['current_stack']['obs_name'],
+            'feasible': False,
+            'error': None,
+        }
+        finder = niriPipe.utils.finder.Finder(self.state, strict=False)
+        try:
+            table = finder.run()
+        except Exception as e:
+            self.logger.error("Finder failed.", exc_info=True)
+            plan['error'] = '{}: {}'.format(type(e).__name__, e)
+            return plan
+
+        plan['feasible'] = not finder.shortfalls
+        plan['shortfalls'] = {
+            frame_type: {'required': required, 'found': found}
+            for frame_type, (required, found) in finder.shortfalls.items()
+        }
+
+        cached = [self._is_cached(pid) for pid in table['productID']]
+        to_fetch = [i for i, c in enumerate(cached) if not c]
+        sizes = dict(zip(to_fetch, self._content_lengths(table[to_fetch])))
+
+        plan['frames'] = {}
+        for frame_type in FRAME_TYPES:
+            rows = [i for i, t in enumerate(table['niriPipe_type'])
+                    if t == frame_type]
+            plan['frames'][frame_type] = {
+                'required': int(self.state['config']['DATAFINDER'][
+                    'min_{}s'.format(frame_type)]),
+                'found': len(rows),
+                'cached': len([i for i in rows if cached[i]]),
+                'bytes': sum(sizes.get(i) or 0 for i in rows),
+            }
+        plan['bytes_to_transfer'] = sum(s or 0 for s in sizes.values())
+        plan['frames_of_unknown_size'] = len(
+            [s for s in sizes.values() if s is None])
+        plan['reusable_calibrations'] = self._reusable_calibrations(table)
+        plan['estimate'] = self._estimate(
+            table, plan['bytes_to_transfer'], plan['reusable_calibrations'])
+        return plan
+
+    def report(self, plan):
+        """
+        Log a plan, and write it as JSON to [PLANNING] plan_report if set.
+        """
+        self.logger.info("Plan for {}:".format(plan['obs_name']))
+        for frame_type, frames in plan.get('frames', {}).items():
+            self.logger.info(
+                "  {}: {} frames found ({} required), {} cached, "
+                "{:.1f} MB to download.".format(
+                    frame_type, frames['found'], frames['required'],
+                    frames['cached'], frames['bytes'] / 1e6))
+        if plan.get('frames_of_unknown_size'):
+            self.logger.warning("  Sizes of {} frames unknown.".format(
+                plan['frames_of_unknown_size']))
+        for product_name, filename in plan.get(
+                'reusable_calibrations', {}).items():
+            self.logger.info("  Reusable {}: {}".format(
+                product_name, filename))
+        if 'estimate' in plan:
+            self.logger.info(
+                "  Estimated runtime: {:.0f} s ({:.0f} s download, "
+                "{:.0f} s reduction).".format(
+                    plan['estimate']['total_seconds'],
+                    plan['estimate']['download_seconds'],
+                    plan['estimate']['reduction_seconds']))
+        if plan['feasible']:
+            self.logger.info("  Requirements met.")
+        elif plan['error']:
+            self.logger.error("  Planning failed: {}".format(plan['error']))
+        else:
+            for frame_type, shortfall in plan['shortfalls'].items():
+                self.logger.error(
+                    "  Required {} {} frames; found {}.".format(
+                        shortfall['required'], frame_type,
+                        shortfall['found']))
+
+        filename = self.config.get('plan_report', '')
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(plan, f, indent=4)
+            self.logger.debug("Wrote plan to {}.".format(filename))
+
+    def _is_cached(self, pid):
+        """
+        Whether a frame is already downloaded or in the download cache.
+        """
+        filename = pid + '.fits'
+        if os.path.exists(os.path.join(
+                self.state['current_working_directory'],
+                self.state['config']['DATARETRIEVAL']['raw_data_path'],
+                filename)):
+            return True
+        cache = niriPipe.utils.cache.from_state(
+            self.state, 'DATARETRIEVAL', 'cache_path')
+        return bool(cache and cache.get(filename))
+
+    def _content_lengths(self, table):
+        """
+        Archive content length of each frame in table (None if unknown).
+        """
+        if not len(table):
+            return []
+        urls = self._data_urls(table)
+        max_workers = max(1, int(self.config.get('max_connections', 8)))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as pool:
+            return list(pool.map(Planner._content_length, urls))
+
+    def _data_urls(self, table):  # pragma: no cover
+        url = niriPipe.utils.archive.service_url(self.state)
+        if url:
+            return niriPipe.utils.archive.data_urls(url, table)
+        return Cadc.get_data_urls(table)
+
+    @staticmethod
+    def _content_length(url):  # pragma: no cover
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=60)
+            r.raise_for_status()
+            return int(r.headers['Content-Length'])
+        except Exception:
+            return None
+
+    def _reusable_calibrations(self, table):
+        """
+        Calibrations the Reducer would take from the calibration cache, by
+        product name.
+        """
+        reusable = {}
+        cache = niriPipe.utils.cache.from_state(
+            self.state, 'REDUCTION', 'calibration_cache')
+        if not cache:
+            return reusable
+        for product_name, frame_type, input_types, recipename in \
+                CALIBRATIONS:
+            if not int(self.state['config']['DATAFINDER'][
+                    'min_{}s'.format(frame_type)]):
+                continue
+            key = niriPipe.utils.cache.calibration_key(
+                frame_type, product_name, recipename,
+                self._product_ids(table, input_types), reusable,
+                niriPipe.utils.cache.product_config(self.state, frame_type))
+            filename = niriPipe.utils.cache.calibration_filename(cache, key)
+            if filename is None:
+                # Later calibrations are made from this one, so they
+                # can't be reused either.
+                break
+            reusable[product_name] = filename
+        return reusable
+
+    @staticmethod
+    def _product_ids(table, frame_types):
+        return [row['productID'] for row in table
+                if row['niriPipe_type'] in frame_types]
+
+    def _estimate(self, table, n_bytes, reusable):
+        """
+        Rough runtime estimate in seconds.
+
+        Download time comes from [PLANNING] download_mb_per_s. Reduction
+        time is the number of input frames of each product to make times
+        the seconds per frame of that type in a previous timing report
+        ([PLANNING] timing_history), or [PLANNING] seconds_per_frame.
+        """
+        download_seconds = n_bytes / (
+            float(self.config.get('download_mb_per_s', 20)) * 1e6)
+        per_frame = self._seconds_per_frame()
+        reduction_seconds = 0
+        for product_name, frame_type, input_types, recipename in \
+                CALIBRATIONS + [STACK]:
+            if product_name in reusable or not int(
+                    self.state['config']['DATAFINDER'][
+                        'min_{}s'.format(frame_type)]):
+                continue
+            reduction_seconds += \
+                len(self._product_ids(table, input_types)) * \
+                per_frame.get(frame_type, per_frame[None])
+        return {
+            'download_seconds': download_seconds,
+            'reduction_seconds': reduction_seconds,
+            'total_seconds': download_seconds + reduction_seconds,
+        }
+
+    def _seconds_per_frame(self):
+        """
+        Seconds per input frame by frame type; None is the default.
+        """
+        per_frame = {None: float(self.config.get('seconds_per_frame', 10))}
+        filename = self.config.get('timing_history', '')
+        if not filename:
+            return per_frame
+        with open(filename) as f:
+            report = json.load(f)
+        totals = {}
+        for product in report['products']:
+            if product.get('succeeded', True) and product.get('n_inputs'):
+                seconds, n = totals.get(product['frame_type'], (0, 0))
+                totals[product['frame_type']] = (
+                    seconds + product['wall_seconds'],
+                    n + product['n_inputs'])
+        for frame_type, (seconds, n) in totals.items():
+            per_frame[frame_type] = seconds / n
+        return per_frame
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Nightly calibration prefetching.
+
+Finds all NIRI FLAT and DARK frames of a night and downloads them into the
+shared download cache ([DATARETRIEVAL] cache_path), so the science runs
+that follow only download their object frames. Optionally, the night's
+calibrations are reduced into the shared calibration cache
+([REDUCTION] calibration_cache) too: a processed dark per dark
+observation, and a processed flat (and bad pixel mask, with
+[DATAFINDER] min_shortdarks) per flat observation with each of those
+darks. Runs whose Finder picks the same frames reuse them; flats are
+grouped by camera as the Finder does, and sets over the [DATAFINDER] max_*
+budgets are skipped, as runs would never pick all of their frames.
+"""
+import copy
+import datetime
+import os
+import shutil
+import astropy.table
+import niriPipe.utils.customLogger
+import niriPipe.utils.downloader
+import niriPipe.utils.finder
+
+
+MJD_EPOCH = datetime.datetime(1858, 11, 17)
+
+
+def night_bounds(night):
+    """
+    MJD range of a night given as YYYYMMDD.
+
+    NIRI is at Gemini North, where a night falls within one UT date.
+    """
+    try:
+        date = datetime.datetime.strptime(night, '%Y%m%d')
+    except (TypeError, ValueError):
+        raise ValueError("Night should be YYYYMMDD, not {}.".format(night))
+    start = (date - MJD_EPOCH).days
+    return start, start + 1
+
+
+def reduce_calibrations(state, table, directory):
+    """
+    Reduce a set of calibration frames (a Finder table without object
+    frames) in directory, into the calibration cache; returns the names of
+    the products made.
+
+    Products are made as for a stack with these calibrations: [DATAFINDER]
+    min_* of frame types not in the set are taken as 0.
+    """
+    # Only imported when needed, as DRAGONS is slow to import.
+    import niriPipe.utils.reducer
+
+    state = copy.deepcopy(state)
+    state['current_working_directory'] = directory
+    config = state['config']['DATAFINDER']
+    config['min_objects'] = '0'
+    for frame_type in ['flat', 'longdark', 'shortdark']:
+        if frame_type not in table['niriPipe_type']:
+            config['min_{}s'.format(frame_type)] = '0'
+
+    home = os.getcwd()
+    os.chdir(directory)
+    try:
+        niriPipe.utils.downloader.Downloader(
+            table=table, state=state).download_query_cadc()
+        products = niriPipe.utils.reducer.Reducer(
+            state=state, table=table).run()
+    finally:
+        os.chdir(home)
+    return sorted(name for name, product in products.items() if product)
+
+
+class NightFinder(niriPipe.utils.finder.Finder):
+    """
+    Finds all NIRI calibration frames of a night.
+
+    Frames are marked as flat, longdark or shortdark (darks of about 1 s;
+    see Finder._find_shortdarks()).
+    """
+    def __init__(self, state, night):
+        self.night = night
+        super().__init__(state)
+
+    def run(self):
+        start, end = night_bounds(self.night)
+        flats = self._find_night_frames('FLAT', start, end)
+        darks = self._find_night_frames('DARK', start, end)
+        short = (darks['time_exposure'] >= 0.99) & \
+            (darks['time_exposure'] <= 1.01)
+        return astropy.table.vstack([
+            self._mark_as('flat', flats),
+            self._mark_as('longdark', darks[~short]),
+            self._mark_as('shortdark', darks[short])
+        ])
+
+    def _log_basic_constraints(self):
+        self.logger.debug("Night: {}".format(self.night))
+
+    def _find_night_frames(self, obstype, start, end):
+        query = self.query_prefix + \
+            "AND Observation.type = '{}' ".format(obstype) + \
+            "AND Plane.time_bounds_lower >= '{:.4f}' ".format(start) + \
+            "AND Plane.time_bounds_lower <= '{:.4f}' ".format(end) + \
+            self.query_suffix
+        frame_type = obstype.lower()
+        table = self._query_frames(query, frame_type)
+        self.logger.info("Found {} {} frames on {}.".format(
+            len(table), frame_type, self.night))
+        return table
+
+
+class Prefetcher:
+    """
+    Prefetches the calibration frames of a night.
+
+    Frames are downloaded, and calibrations reduced, in a working directory
+    (prefetch_<night> in state['current_working_directory']), which is
+    removed unless something failed.
+
+    Parameters
+    ----------
+    state: dict
+        Pipeline state without a current stack; needs a download cache,
+        and with calibrations, a calibration cache.
+    night: str
+        UT date of the night, as YYYYMMDD.
+    calibrations: bool
+        Also reduce the night's calibrations.
+    """
+    def __init__(self, state, night, calibrations=False):
+        night_bounds(night)
+        self.state = state
+        self.night = night
+        self.calibrations = calibrations
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        if not state['config']['DATARETRIEVAL'].get('cache_path'):
+            raise ValueError(
+                "Prefetching needs a download cache "
+                "([DATARETRIEVAL] cache_path).")
+        if calibrations and not state['config']['REDUCTION'].get(
+                'calibration_cache'):
+            raise ValueError(
+                "Prefetching calibrations needs a calibration cache "
+                "([REDUCTION] calibration_cache).")
+        self.directory = os.path.join(
+            state['current_working_directory'], 'prefetch_' + night)
+        self.finder = None
+
+    def run(self):
+        """
+        Prefetch the night; returns a summary dict, with 'succeeded' False
+        if any calibration failed.
+        """
+        if os.path.exists(self.directory):
+            self.logger.warning("Removing {} left by a previous run.".format(
+                self.directory))
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        self.finder = NightFinder(self.state, self.night)
+        table = self.finder.run()
+        summary = {
+            'night': self.night,
+            'frames': {
+                frame_type: int((table['niriPipe_type'] == frame_type).sum())
+                for frame_type in ['flat', 'longdark', 'shortdark']
+            },
+            'calibrations': [],
+            'failed': [],
+        }
+        if len(table):
+            niriPipe.utils.downloader.Downloader(
+                table=table, state=self._state(self.directory)
+            ).download_query_cadc()
+        self.logger.info("Prefetched {} frames of {}.".format(
+            len(table), self.night))
+
+        if self.calibrations and len(table):
+            for name, calibration_set in self._calibration_sets(table):
+                try:
+                    products = self._reduce(name, calibration_set)
+                except Exception as e:
+                    self.logger.error(
+                        "Failed to reduce {}.".format(name), exc_info=True)
+                    summary['failed'].append({
+                        'set': name,
+                        'error': '{}: {}'.format(type(e).__name__, e)})
+                else:
+                    self.logger.info("Reduced {}: {}".format(
+                        name, ', '.join(products)))
+                    summary['calibrations'].append({
+                        'set': name, 'products': products})
+
+        summary['succeeded'] = not summary['failed']
+        if summary['succeeded']:
+            shutil.rmtree(self.directory)
+        else:
+            self.logger.warning("Kept {} for inspection.".format(
+                self.directory))
+        return summary
+
+    def _state(self, directory):
+        """
+        A copy of state, working in directory.
+        """
+        state = copy.deepcopy(self.state)
+        state['current_working_directory'] = directory
+        return state
+
+    def _observations(self, table, frame_type):
+        """
+        Rows of a frame type, grouped by observation name in time order.
+        """
+        observations = {}
+        for i, row in enumerate(table):
+            if row['niriPipe_type'] != frame_type:
+                continue
+            item = row['observationID']
+            if isinstance(item, bytes):  # pragma: no cover
+                item = item.decode('utf-8')
+            match = self.finder.obs_name_pattern.search(item)
+            name = match.group() if match else item
+            observations.setdefault(name, []).append(i)
+        return sorted(
+            [(name, table[rows]) for name, rows in observations.items()],
+            key=lambda x: min(x[1]['time_bounds_lower']))
+
+    def _calibration_sets(self, table):
+        """
+        Sets of frames to reduce together, as (name, table).
+
+        Each set is what a run would find if the set's observations were
+        the ones closest to its object frames: a dark observation on its
+        own, then the flats of each flat observation and camera with each
+        dark observation (unless [DATAFINDER] min_longdarks is 0) and, with
+        min_shortdarks, the short dark observation closest to the flats.
+
+        Runs cut frames over their [DATAFINDER] max_* budget down to those
+        closest to their own object frames, so sets with more frames of a
+        type than its budget would never be reused, and are skipped.
+        """
+        config = self.state['config']['DATAFINDER']
+        darks = self._observations(table, 'longdark')
+        shortdarks = self._observations(table, 'shortdark')
+        if not int(config['min_longdarks']):
+            darks = [None]
+        elif not darks:
+            self.logger.warning(
+                "No long darks on {}, so no flats can be reduced.".format(
+                    self.night))
+
+        sets = [[dark] for dark in darks if dark]
+        for flat in self._by_camera(self._observations(table, 'flat')):
+            shortdark = None
+            if int(config['min_shortdarks']):
+                if not shortdarks:
+                    self.logger.warning(
+                        "No short darks on {} for {}; skipping it.".format(
+                            self.night, flat[0]))
+                    continue
+                flat_time = sum(flat[1]['time_bounds_lower']) / len(flat[1])
+                shortdark = min(shortdarks, key=lambda x: abs(
+                    sum(x[1]['time_bounds_lower']) / len(x[1]) - flat_time))
+            for dark in darks:
+                sets.append([x for x in (dark, shortdark, flat) if x])
+
+        sets = [
+            ('+'.join(name for name, rows in observations),
+             astropy.table.vstack([rows for name, rows in observations]))
+            for observations in sets
+        ]
+        return [(name, rows) for name, rows in sets
+                if self._within_budget(name, rows)]
+
+    def _by_camera(self, observations):
+        """
+        Split flat observations by camera, as runs only use flats taken
+        with the camera of their object frames. Observations with flats
+        from several cameras are named <observation>_<camera>.
+        """
+        split = []
+        for name, rows in observations:
+            try:
+                cameras = [
+                    self.finder._metadata_from_header(
+                        product_id + '.fits', 'CAMERA')
+                    for product_id in rows['productID']]
+            except Exception:
+                self.logger.warning(
+                    "Failed to get the cameras of {}.".format(name))
+                split.append((name, rows))
+                continue
+            for camera in sorted(set(cameras)):
+                mask = [x == camera for x in cameras]
+                if len(set(cameras)) > 1:
+                    split.append(('{}_{}'.format(name, camera), rows[mask]))
+                else:
+                    split.append((name, rows[mask]))
+        return split
+
+    def _within_budget(self, name, table):
+        """
+        Whether a set has no more frames of each type than its [DATAFINDER]
+        max_* budget (0 being no limit).
+        """
+        config = self.state['config']['DATAFINDER']
+        for frame_type in sorted(set(table['niriPipe_type'])):
+            budget = int(config.get('max_{}s'.format(frame_type), 0))
+            count = int((table['niriPipe_type'] == frame_type).sum())
+            if budget and count > budget:
+                self.logger.warning(
+                    "Skipping {}: {} {} frames, over max_{}s ({}).".format(
+                        name, count, frame_type, frame_type, budget))
+                return False
+        return True
+
+    def _reduce(self, name, table):
+        """
+        Reduce a set of calibration frames, into the calibration cache;
+        returns the names of the products made.
+        """
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory)
+        return reduce_calibrations(self.state, table, directory)
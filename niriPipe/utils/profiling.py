@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Per-stage profiling of a pipeline run.
+
+Each stage is profiled with cProfile into its own .pstats file, and all of
+them are merged into merged.pstats; look at them with e.g.
+python -m pstats, snakeviz or gprof2dot. Threads a stage starts (e.g. the
+Tagger's and Checker's thread pools) are profiled too, and merged into the
+stage's file once they finish. Optionally, the whole run is also sampled
+into a folded-stacks file (flamegraph.folded) that flamegraph.pl or
+speedscope turn into a flame graph, with a root frame per thread.
+"""
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import niriPipe.utils.customLogger
+import niriPipe.utils.state
+
+# Environment equivalents of 'niriPipe run --profile DIR --flamegraph'.
+PROFILE_ENV = 'NIRIPIPE_PROFILE'
+FLAMEGRAPH_ENV = 'NIRIPIPE_FLAMEGRAPH'
+
+
+class StackSampler:
+    """
+    Samples the stacks of all threads (or of thread_id only) at a fixed
+    interval from a background thread, counting identical stacks. Stacks
+    start with the name of their thread.
+    """
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or \
+                        self.thread_id not in (None, thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, filename):
+        """
+        Write samples in folded-stacks format: 'frame;frame;frame count'.
+        """
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('{} {}\n'.format(stack, count))
+        return filename
+
+
+class Profiler:
+    """
+    Profiles pipeline stages; does nothing if directory is None.
+    """
+    def __init__(self, directory=None, flamegraph=False):
+        self.directory = os.path.abspath(directory) if directory else None
+        self.flamegraph = flamegraph
+        self.stats_files = []
+        self.sampler = None
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Profiler set up by NIRIPIPE_PROFILE (directory) and
+        NIRIPIPE_FLAMEGRAPH (boolean).
+        """
+        return cls(
+            directory=os.environ.get(PROFILE_ENV) or None,
+            flamegraph=niriPipe.utils.state.to_bool(
+                os.environ.get(FLAMEGRAPH_ENV) or False))
+
+    def start(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger.info("Profiling stages to {}".format(self.directory))
+        if self.flamegraph:
+            self.sampler = StackSampler()
+            self.sampler.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Profile the body of the with statement as stage name.
+
+        Threads started in the body are profiled from their start; those
+        still running when it ends are left out.
+        """
+        if not self.directory:
+            yield
+            return
+        profile = cProfile.Profile()
+        threads = []
+
+        def profile_thread(frame, event, arg):
+            # Called once in each new thread; enabling its own profiler
+            # replaces this hook.
+            thread_profile = cProfile.Profile()
+            try:
+                thread_profile.enable()
+            except ValueError:
+                # Python 3.12+ profiles every thread with the stage's
+                # profiler, and allows only one.
+                sys.setprofile(None)
+                return
+            threads.append((threading.current_thread(), thread_profile))
+
+        threading.setprofile(profile_thread)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(profile)
+            for thread, thread_profile in threads:
+                if thread.is_alive():
+                    self.logger.debug(
+                        "Not profiling {}, still running.".format(
+                            thread.name))
+                else:
+                    stats.add(thread_profile)
+            filename = os.path.join(self.directory, '{}.pstats'.format(name))
+            stats.dump_stats(filename)
+            self.stats_files.append(filename)
+            self.logger.debug("Wrote {}".format(filename))
+
+    def finish(self):
+        """
+        Merge the stage profiles and write the flame graph samples.
+        """
+        if not self.directory:
+            return
+        if self.stats_files:
+            filename = os.path.join(self.directory, 'merged.pstats')
+            pstats.Stats(*self.stats_files).dump_stats(filename)
+            self.logger.info("Wrote {}".format(filename))
+        if self.sampler:
+            self.sampler.stop()
+            filename = self.sampler.write(
+                os.path.join(self.directory, 'flamegraph.folded'))
+            self.logger.info("Wrote {}".format(filename))
+            self.sampler = None
@@ -64,12 +64,27 @@
 #
 #
 # ***********************************************************************
-import astrodata  # noqa: F401
+import astrodata
+import recipe_system.mappers.primitiveMapper
+import recipe_system.mappers.recipeMapper
 import recipe_system.reduction.coreReduce
+import recipe_system.utils.errors
 import recipe_system.utils.reduce_utils
 import gempy.utils
+import contextlib
+import copy
+import json
 import os
+import shutil
+import tempfile
+import niriPipe.utils.cache
 import niriPipe.utils.customLogger
+import niriPipe.utils.diskbudget
+import niriPipe.utils.metrics
+import niriPipe.utils.state
+import niriPipe.utils.tagger
+import niriPipe.utils.timing
+import niriPipe.utils.tracing
 
 
 def raiseIfError(msg):
@@ -118,6 +133,12 @@ class Reducer:
             'processed_flat': None,
             'processed_stack': None
         }
+        # Timing reports of each product made, in order.
+        self.timings = []
+        # Prepared frames shared between recipes, by productID.
+        self.intermediates = {}
+        # In in-memory mode, products not yet written to disk (AstroData).
+        self.ad_products = {}
 
     def run(self):
         """
@@ -129,10 +150,22 @@ class Reducer:
         if len(self.table) == 0:
             return self.products
 
-        self._make_dark()
-        self._make_bpm()
-        self._make_flat()
-        self._make_object_stack()
+        try:
+            self._make_dark()
+            self._drop_raw('longdark')
+            self._prepare_flats()
+            self._make_bpm()
+            self._drop_raw('shortdark')
+            self._make_flat()
+            self._drop_intermediates()
+            self._drop_raw('flat')
+            self._make_object_stack()
+            self._drop_raw('object')
+        finally:
+            # Don't leave shared intermediates behind if a product failed.
+            self._drop_intermediates()
+            # Write whatever was timed, even if a product failed.
+            self._write_timing_report()
 
         return self.products
 
@@ -163,6 +196,84 @@ class Reducer:
             product_name='processed_dark'
         )
 
+    @raiseIfError('Failed to prepare flat frames.')
+    def _prepare_flats(self):
+        """
+        Run 'prepare' once on flats used by both the BPM and flat recipes.
+
+        Flats go into both the bad pixel mask and the processed flat, and
+        each recipe would otherwise read and prepare the raw flats again.
+        With [REDUCTION] share_prepared on, the prepared flats are made
+        once and used as inputs to both recipes (DRAGONS skips 'prepare'
+        for frames that already went through it). Later steps like addDQ
+        can't be shared, as the flat recipe's addDQ uses the new BPM.
+        """
+        if not all([
+                niriPipe.utils.state.to_bool(
+                    self.state['config']['REDUCTION'].get(
+                        'share_prepared', False)),
+                int(self.state['config']['DATAFINDER']['min_shortdarks']),
+                int(self.state['config']['DATAFINDER']['min_flats'])]):
+            return
+
+        product_ids = list(
+            self.table[self.table['niriPipe_type'] == 'flat']['productID'])
+        outputs = self._make_product(
+            frame_type='flat',
+            mask=(self.table['niriPipe_type'] == 'flat'),
+            product_name='prepared_flat',
+            recipename='prepare',
+            intermediate=True
+        )
+
+        for product_id in product_ids:
+            for output in outputs:
+                # In in-memory mode, outputs are AstroData objects.
+                name = output if isinstance(output, str) else output.filename
+                if os.path.basename(name).startswith(product_id + '_'):
+                    self.intermediates[product_id] = output
+        self.logger.info("Prepared {} flat frames for sharing.".format(
+            len(self.intermediates)))
+
+    def _drop_intermediates(self):
+        """
+        Remove shared intermediates once all products using them are made.
+        """
+        for product_id, path in self.intermediates.items():
+            if isinstance(path, str) and os.path.exists(path):
+                self.logger.debug("Removing intermediate {}.".format(path))
+                os.remove(path)
+        self.intermediates = {}
+
+    def _drop_raw(self, frame_type):
+        """
+        Remove raw frames of a type once all products using them are made,
+        if [DISKBUDGET] cleanup is on, giving their space back to the disk
+        budget.
+
+        Frames linked in from the download cache stay in the cache, so
+        removing their links frees nothing and isn't counted.
+        """
+        if not niriPipe.utils.state.to_bool(
+                self.state['config'].get('DISKBUDGET', {}).get(
+                    'cleanup', False)):
+            return
+        prefix = self.state['config']['DATARETRIEVAL']['raw_data_path']
+        freed = 0
+        for product_id in self.table[
+                self.table['niriPipe_type'] == frame_type]['productID']:
+            path = os.path.join(prefix, product_id + '.fits')
+            if os.path.exists(path):
+                stat = os.stat(path)
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+                os.remove(path)
+        if freed:
+            self.logger.debug("Removed raw {} frames ({:.1f} MB).".format(
+                frame_type, freed / 1e6))
+            niriPipe.utils.metrics.FREED_BYTES.inc(freed)
+            niriPipe.utils.diskbudget.shrink(self.state, freed)
+
     @raiseIfError('Failed to make processed bad pixel mask.')
     def _make_bpm(self):
         """
@@ -199,15 +310,18 @@ class Reducer:
         )
 
     def _make_product(
-            self, frame_type, mask, product_name, recipename=None
-            ):
+            self, frame_type, mask, product_name, recipename=None,
+            intermediate=False):
         """
         Does the work of creating a product.
+
+        Returns the list of DRAGONS outputs. Unless intermediate is set,
+        the first output is stored as self.products[product_name].
         """
         if not int(self.state['config']['DATAFINDER']['min_{}s'.format(
                 frame_type)]):
             self.logger.debug("Skipping creation of {}.".format(product_name))
-            return None
+            return []
         self.logger.debug("Starting creation of {}.".format(product_name))
 
         input_frames = self.table[mask]
@@ -224,42 +338,324 @@ class Reducer:
         # too annoying to implement and test for the gain right now. #techdebt
         prefix = self.state['config']['DATARETRIEVAL']['raw_data_path']
         paths = [
-                            os.path.join(prefix, x + '.fits')
+                            self.intermediates.get(
+                                x, os.path.join(prefix, x + '.fits'))
                             for x in input_frames['productID']
         ]
 
-        dragons_reduce = recipe_system.reduction.coreReduce.Reduce()
-        dragons_reduce.files.extend(paths)
+        home = os.getcwd()
+        calibrations = dict(self.products)
+
+        # Calibrations made from the same inputs are reused from the shared
+        # calibration cache, if there is one. Stacks are never reused.
+        cache = None
+        if not intermediate and product_name != 'processed_stack':
+            cache = niriPipe.utils.cache.from_state(
+                self.state, 'REDUCTION', 'calibration_cache')
+        if cache:
+            cache_key = niriPipe.utils.cache.calibration_key(
+                frame_type, product_name, recipename,
+                input_frames['productID'], calibrations,
+                niriPipe.utils.cache.product_config(self.state, frame_type))
+            cached = self._from_calibration_cache(cache, cache_key)
+            niriPipe.utils.metrics.CACHE_REQUESTS.inc(
+                cache='calibrations', result='hit' if cached else 'miss')
+            if cached:
+                self.logger.info("Using cached {}: {}".format(
+                    product_name, cached))
+                self.products[product_name] = cached
+                with niriPipe.utils.tracing.span(
+                        'dragons_product', product_name=product_name,
+                        frame_type=frame_type, n_inputs=len(paths),
+                        recipename=recipename, cached=True):
+                    pass
+                return [cached]
+
+        with self._scratch() as scratch_dir:
+            if scratch_dir:
+                paths = self._stage(
+                    [os.path.join(home, path) if isinstance(path, str)
+                     else path for path in paths],
+                    scratch_dir)
+                # Calibrations stay where they are, but DRAGONS now runs
+                # somewhere else.
+                calibrations = {
+                    key: os.path.join(home, value) if value else value
+                    for key, value in calibrations.items()
+                }
+
+            with niriPipe.utils.tracing.span(
+                    'dragons_product', product_name=product_name,
+                    frame_type=frame_type, n_inputs=len(paths),
+                    recipename=recipename, cached=False) as span, \
+                    niriPipe.utils.metrics.PRODUCT_SECONDS.time(
+                        frame_type=frame_type):
+                outputs = self._run_dragons(
+                    paths=paths,
+                    frame_type=frame_type,
+                    product_name=product_name,
+                    calibrations=calibrations,
+                    recipename=recipename
+                )
+                span.set(n_outputs=len(outputs))
+
+            if self._in_memory():
+                if not intermediate:
+                    outputs = self._keep_product(
+                        product_name, frame_type, outputs,
+                        dest_dir=home if scratch_dir else None)
+            elif scratch_dir:
+                outputs = self._unstage(
+                    outputs, home, reserve=not intermediate)
+            elif not intermediate:
+                niriPipe.utils.tagger.Tagger.reserve_file_cards(outputs[0])
+
+        self.logger.debug("Finished creation of {}.".format(product_name))
+
+        if cache:
+            self._to_calibration_cache(cache, cache_key, outputs[0])
+        if not intermediate:
+            self.products[product_name] = outputs[0]
+        return outputs
+
+    def _from_calibration_cache(self, cache, key):
+        """
+        Copy a cached calibration to the working directory under its
+        original name and return that name, or None if it isn't cached.
+
+        Products are tagged in place later, so they're copied, not linked.
+        """
+        filename = niriPipe.utils.cache.calibration_filename(cache, key)
+        if filename is None:
+            return None
+        return cache.fetch(key + '.fits', filename)
+
+    def _to_calibration_cache(self, cache, key, filename):
+        # See niriPipe.utils.cache.calibration_filename().
+        cache.put(key + '.fits', filename)
+        cache.write(key + '.json', json.dumps(
+            {'filename': os.path.basename(filename)}).encode('utf-8'))
 
+    def _run_dragons(
+            self, paths, frame_type, product_name, calibrations,
+            recipename=None):
+        """
+        Run DRAGONS on paths and return the list of outputs.
+
+        Outputs are the filenames DRAGONS wrote to the working directory,
+        or, in in-memory mode, AstroData objects (see _run_in_process).
+        """
         if recipename:
             self.logger.debug("Using provided recipe: {}".format(recipename))
-            dragons_reduce.recipename = recipename
+
+        uparms, ucals = self._dragons_parameters(
+            frame_type, calibrations,
+            files=[path for path in paths if isinstance(path, str)])
+
+        # Start up DRAGONS
+        timer = niriPipe.utils.timing.ProductTimer(product_name)
+        try:
+            with timer:
+                if self._in_memory():
+                    outputs = self._run_in_process(
+                        paths, recipename, uparms, ucals)
+                else:
+                    dragons_reduce = \
+                        recipe_system.reduction.coreReduce.Reduce()
+                    dragons_reduce.files.extend(paths)
+                    if recipename:
+                        dragons_reduce.recipename = recipename
+                    dragons_reduce.uparms = uparms
+                    if ucals is not None:
+                        dragons_reduce.ucals = ucals
+                    dragons_reduce.runr()
+                    outputs = dragons_reduce.output_filenames
+        finally:
+            timer.report['frame_type'] = frame_type
+            timer.report['n_inputs'] = len(paths)
+            timer.report['recipename'] = recipename
+            self.timings.append(timer.report)
+
+        self.logger.info(
+            "Made {} in {:.1f}s (cpu {:.1f}s, peak RSS {:.0f} MB).".format(
+                product_name,
+                timer.report['wall_seconds'],
+                timer.report['cpu_seconds'],
+                timer.report['peak_rss_mb']))
+
+        return outputs
+
+    def _dragons_parameters(self, frame_type, calibrations, files):
+        """
+        Return the (uparms, ucals) to give DRAGONS for a product.
+        """
+        uparms = []
 
         # Use custom bad pixel mask if provided
-        if self.products['processed_bpm']:
+        if calibrations.get('processed_bpm'):
             self.logger.debug("Using provided bad pixel mask: {}".format(
                     self.products['processed_bpm']))
-            dragons_reduce.uparms = \
-                [('addDQ:user_bpm', self.products['processed_bpm'])]
+            uparms.append(('addDQ:user_bpm', calibrations['processed_bpm']))
 
         # Dark correction can be optional
         if int(self.state['config']['DATAFINDER']['min_longdarks']) == 0:
             self.logger.debug("Turning off dark correction.")
-            dragons_reduce.uparms.append(('darkCorrect:do_dark', False))
+            uparms.append(('darkCorrect:do_dark', False))
 
         # Provide calibrations manually to DRAGONS for object frames
+        ucals = None
         if frame_type == 'object':
-            dragons_reduce.ucals = \
-                recipe_system.utils.reduce_utils.normalize_ucals(
-                    dragons_reduce.files, Reducer._pretty_string(
-                        self.products))
+            ucals = recipe_system.utils.reduce_utils.normalize_ucals(
+                files, Reducer._pretty_string(calibrations))
 
-        # Start up DRAGONS
-        dragons_reduce.runr()
+        return uparms, ucals
 
-        self.logger.debug("Finished creation of {}.".format(product_name))
+    def _in_memory(self):
+        """
+        True if DRAGONS should be driven in-process on AstroData objects.
+        """
+        return niriPipe.utils.state.to_bool(
+            self.state['config']['REDUCTION'].get('in_memory', False))
+
+    def _run_in_process(self, inputs, recipename, uparms, ucals):
+        """
+        Run a recipe through the DRAGONS mappers instead of coreReduce.
+
+        Does what 'reduce' does, minus writing the outputs: inputs may be
+        filenames or AstroData objects already in memory (which are copied,
+        as primitives modify their inputs), and the AstroData objects of
+        the main output stream are returned. As with 'reduce', recipename
+        may also be the name of a single primitive.
+        """
+        adinputs = [
+            copy.deepcopy(x) if isinstance(x, astrodata.AstroData)
+            else astrodata.open(x)
+            for x in inputs
+        ]
+        recipename = recipename or '_default'
+
+        pm = recipe_system.mappers.primitiveMapper.PrimitiveMapper(
+            adinputs, mode='sq', drpkg='geminidr', recipename=recipename,
+            usercals=ucals, uparms=uparms, upload=None)
+        p = pm.get_applicable_primitives()
+
+        rm = recipe_system.mappers.recipeMapper.RecipeMapper(
+            adinputs, mode='sq', drpkg='geminidr', recipename=recipename)
+        try:
+            recipe = rm.get_applicable_recipe()
+        except recipe_system.utils.errors.RecipeNotFound:
+            self.logger.debug(
+                "Running {} as a primitive.".format(recipename))
+            getattr(p, recipename)()
+        else:
+            recipe(p)
+
+        return p.streams['main']
+
+    def _keep_product(self, product_name, frame_type, ads, dest_dir=None):
+        """
+        Store an in-memory product and return its filename in a list.
 
-        self.products[product_name] = dragons_reduce.output_filenames[0]
+        Calibrations are written straight away, as later recipes read them
+        from disk. The stack stays in memory (self.ad_products) until the
+        Tagger writes it, with its keywords, in one go.
+        """
+        ad = ads[0]
+        filename = os.path.basename(ad.filename)
+        if dest_dir:
+            filename = os.path.join(dest_dir, filename)
+
+        if frame_type == 'object':
+            self.logger.debug(
+                "Keeping {} in memory until tagged.".format(product_name))
+            self.ad_products[product_name] = ad
+        else:
+            niriPipe.utils.tagger.Tagger.reserve_cards(ad.phu)
+            ad.write(filename, overwrite=True)
+            self.logger.debug("Wrote {}.".format(filename))
+
+        return [filename]
+
+    @contextlib.contextmanager
+    def _scratch(self):
+        """
+        Run the enclosed reduction in a scratch directory, if configured.
+
+        DRAGONS writes its intermediates to the working directory. When
+        [REDUCTION] scratch_path is set (e.g. to a tmpfs or local NVMe
+        mount), a fresh directory is made under it and used as the working
+        directory instead. Yields that directory, or None when scratch
+        staging is off. The directory is always removed afterwards, and
+        the original working directory restored.
+        """
+        scratch_path = self.state['config']['REDUCTION'].get('scratch_path')
+        if not scratch_path:
+            yield None
+            return
+
+        scratch_path = os.path.abspath(scratch_path)
+        os.makedirs(scratch_path, exist_ok=True)
+        scratch_dir = tempfile.mkdtemp(prefix='niriPipe-', dir=scratch_path)
+        home = os.getcwd()
+        self.logger.debug("Staging reduction in {}.".format(scratch_dir))
+        try:
+            os.chdir(scratch_dir)
+            yield scratch_dir
+        finally:
+            os.chdir(home)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            self.logger.debug(
+                "Removed scratch directory {}.".format(scratch_dir))
+
+    def _stage(self, paths, scratch_dir):
+        """
+        Copy input frames into scratch_dir and return their new paths.
+        """
+        staged = []
+        for path in paths:
+            if not isinstance(path, str):
+                # Already in memory.
+                staged.append(path)
+                continue
+            dest = os.path.join(scratch_dir, os.path.basename(path))
+            shutil.copy2(path, dest)
+            staged.append(dest)
+        self.logger.debug("Staged {} frames to {}.".format(
+            len(staged), scratch_dir))
+        return staged
+
+    def _unstage(self, outputs, dest_dir, reserve=False):
+        """
+        Move reduction outputs from scratch back to dest_dir.
+
+        With reserve, the product (the first output) gets room for the
+        Tagger's cards on the way (see Tagger.reserve_file_cards()).
+        """
+        unstaged = []
+        for i, output in enumerate(outputs):
+            dest = os.path.join(dest_dir, os.path.basename(output))
+            if reserve and i == 0:
+                niriPipe.utils.tagger.Tagger.reserve_file_cards(output, dest)
+            else:
+                shutil.move(output, dest)
+            self.logger.debug("Copied back {}.".format(dest))
+            unstaged.append(dest)
+        return unstaged
+
+    def _write_timing_report(self):
+        """
+        Write per-product (and per-primitive) timings as JSON.
+
+        The report goes in the working directory, alongside the products.
+        """
+        filename = self.state['config']['REDUCTION'].get('timing_report')
+        if not filename or not self.timings:
+            return None
+        niriPipe.utils.timing.write_report(
+            filename, self.timings,
+            obs_name=self.state['current_stack'].get('obs_name'))
+        self.logger.info("Wrote reduction timing report {}.".format(filename))
+        return filename
 
     @staticmethod
     def _pretty_string(product_dict):
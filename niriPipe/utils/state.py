@@ -1,6 +1,10 @@
 import os
 import configparser
-import pkg_resources
+
+
+# Config files shipped with the package (see package_data in setup.cfg).
+CFG_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cfg')
 
 
 def get_initial_state(obs_name=None, intent=None, configfile=None, bandpass=None):
@@ -24,27 +28,48 @@ def get_initial_state(obs_name=None, intent=None, configfile=None, bandpass=None
         raise ValueError("Insufficient metadata provided for stack.")
 
     # Read config from a file.
-    # User provided config is most important, and overrides everything.
-    #   - Read basic defaults from 'default_config.cfg'
-    #   - If it's a standard not science stack, override with defaults from
-    #     'default_config_calibration.cfg'
-    #   - Finally, if a user provides a config file, override from that.
+    state['config'] = read_config(
+        configfile=configfile[0] if configfile else None,
+        calibration=bool(intent and intent[0] == 'calibration'))
+
+    return state
+
+
+def read_config(configfile=None, calibration=False):
+    """
+    Read the pipeline config, as a dict of sections.
+
+    User provided config is most important, and overrides everything.
+      - Read basic defaults from 'default_config.cfg'
+      - If it's for a standard not science stack (calibration), override
+        with defaults from 'default_config_calibration.cfg'
+      - Finally, if a user provides a config file, override from that.
+    """
     config = configparser.ConfigParser()
 
     # Read basic default config.
-    config.read(pkg_resources.resource_filename(
-            'niriPipe',
-            os.path.join('cfg', 'default_config.cfg')))
+    config.read(os.path.join(CFG_DIR, 'default_config.cfg'))
 
     # Standard star stacks need a few tweaks.
-    if intent and intent[0] == 'calibration':
-        config.read(pkg_resources.resource_filename(
-            'niriPipe',
-            os.path.join('cfg', 'default_config_calibration.cfg')))
+    if calibration:
+        config.read(os.path.join(CFG_DIR, 'default_config_calibration.cfg'))
 
     # Finally, override with user-provided configuration.
     if configfile:
-        config.read(configfile[0])
-    state['config'] = {s: dict(config[s]) for s in config.sections()}
+        config.read(configfile)
+    return {s: dict(config[s]) for s in config.sections()}
 
-    return state
+
+def to_bool(value):
+    """
+    Interpret a config value as a boolean.
+
+    Config values are strings when read from a file ('True', 'no', '1',
+    ...), but may already be booleans when state is built in code.
+    """
+    if isinstance(value, bool):
+        return value
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[str(value).lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: {}".format(value))
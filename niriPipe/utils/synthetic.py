@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Synthetic raw NIRI datasets, for testing and benchmarking at scale
+without archive access.
+
+Frames look like raw NIRI frames to the pipeline: a single image HDU
+with the usual Gemini/NIRI header keywords, containing bias, dark
+current, hot pixels, flat field structure, stars (in object frames),
+Poisson and read noise. Generator.run() writes a stack's object frames
+and the flats and darks to go with them, and a Finder-style catalog of
+them that niriPipe.utils.localcadc can serve.
+"""
+import datetime
+import os
+import numpy as np
+import astropy.io.fits as fits
+import astropy.table
+import niriPipe.utils.customLogger
+
+# Finder's columns, plus the file name (see niriPipe.utils.localcadc).
+CATALOG_COLUMNS = [
+    'publisherID', 'productID', 'energy_bandpassName', 'time_bounds_lower',
+    'time_exposure', 'type', 'intent', 'proposal_id', 'observationID',
+    'filename'
+]
+CATALOG_NAME = 'catalog.ecsv'
+
+MJD_EPOCH = datetime.datetime(1858, 11, 17)
+# Seconds between the starts of consecutive frames, beyond the exposure.
+OVERHEAD = 15.0
+
+
+def mjd_to_datetime(mjd):
+    return MJD_EPOCH + datetime.timedelta(days=mjd)
+
+
+class Generator:
+    """
+    Writes synthetic raw NIRI frames.
+
+    Parameters
+    ----------
+    directory: str
+        Where to write frames and the catalog.
+    shape: tuple
+        Frame shape; NIRI's detector is 1024x1024.
+    seed: int
+        Random seed; the same seed gives the same dataset.
+    bias: float
+        Bias level, in ADU.
+    dark_current: float
+        ADU per second.
+    read_noise: float
+        ADU.
+    hot_pixel_fraction: float
+        Fraction of pixels with a high dark current; the same pixels in
+        every frame.
+    n_stars: int
+        Stars in each object frame.
+    """
+    def __init__(self, directory, shape=(1024, 1024), seed=0, bias=0.0,
+                 dark_current=0.25, read_noise=12.0, hot_pixel_fraction=1e-3,
+                 n_stars=40):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.rng = np.random.default_rng(seed)
+        self.bias = bias
+        self.dark_current = dark_current
+        self.read_noise = read_noise
+        self.n_stars = n_stars
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+        # Detector properties, fixed for the whole dataset.
+        n_hot = int(round(hot_pixel_fraction * np.prod(self.shape)))
+        self.hot_pixels = (
+            self.rng.integers(0, self.shape[0], n_hot),
+            self.rng.integers(0, self.shape[1], n_hot))
+        self.hot_current = self.rng.uniform(20, 200, n_hot)
+        self.flat_field = self._flat_field()
+        self.stars = self._stars()
+        self.frame_numbers = {}
+
+    def _flat_field(self):
+        """
+        Pixel response: a large scale gradient and vignetting, times
+        pixel to pixel variations; mean 1.
+        """
+        y, x = np.indices(self.shape, dtype=np.float32)
+        y /= self.shape[0]
+        x /= self.shape[1]
+        r2 = (x - 0.5) ** 2 + (y - 0.5) ** 2
+        flat = (1 + 0.1 * (x - 0.5) - 0.05 * (y - 0.5)) * (1 - 0.4 * r2)
+        flat *= self.rng.normal(1, 0.02, self.shape).astype(np.float32)
+        return (flat / flat.mean()).astype(np.float32)
+
+    def _stars(self):
+        """
+        Star positions (in the undithered frame), fluxes and PSF width.
+        """
+        return {
+            'y': self.rng.uniform(0, self.shape[0], self.n_stars),
+            'x': self.rng.uniform(0, self.shape[1], self.n_stars),
+            'flux': 10 ** self.rng.uniform(3, 5.5, self.n_stars),
+            'sigma': 1.5,
+        }
+
+    def _add_stars(self, image, exptime, offset):
+        sigma = self.stars['sigma']
+        half = int(4 * sigma) + 1
+        stamp_y, stamp_x = np.mgrid[-half:half + 1, -half:half + 1]
+        for y, x, flux in zip(self.stars['y'] + offset[0],
+                              self.stars['x'] + offset[1],
+                              self.stars['flux']):
+            iy, ix = int(round(y)), int(round(x))
+            psf = np.exp(-((stamp_y + iy - y) ** 2 + (stamp_x + ix - x) ** 2)
+                         / (2 * sigma ** 2))
+            psf *= flux * exptime / psf.sum()
+            y0, y1 = max(iy - half, 0), min(iy + half + 1, self.shape[0])
+            x0, x1 = max(ix - half, 0), min(ix + half + 1, self.shape[1])
+            if y0 < y1 and x0 < x1:
+                image[y0:y1, x0:x1] += psf[
+                    y0 - (iy - half):y1 - (iy - half),
+                    x0 - (ix - half):x1 - (ix - half)]
+
+    def image(self, obstype, exptime, offset=(0, 0), sky=0.0, lamp=0.0):
+        """
+        Pixel data of one frame, in ADU.
+
+        sky and lamp are illumination in ADU per second (before the flat
+        field).
+        """
+        signal = np.full(self.shape, sky + lamp, dtype=np.float32) * exptime
+        if obstype == 'OBJECT':
+            self._add_stars(signal, exptime, offset)
+        signal *= self.flat_field
+        signal += self.dark_current * exptime
+        signal[self.hot_pixels] += self.hot_current * exptime
+        image = self.rng.poisson(np.clip(signal, 0, None)).astype(np.float32)
+        image += self.rng.normal(
+            self.bias, self.read_noise, self.shape).astype(np.float32)
+        return image
+
+    def header(self, obstype, obs_id, obs_name, exptime, bandpass, camera,
+               mjd):
+        """
+        Raw NIRI primary header of one frame.
+        """
+        program = obs_name.rsplit('-', 1)[0]
+        start = mjd_to_datetime(mjd)
+        header = fits.Header()
+        header['INSTRUME'] = 'NIRI'
+        header['TELESCOP'] = 'Gemini-North'
+        header['OBSERVAT'] = 'Gemini-North'
+        header['OBSTYPE'] = (obstype, 'Observation type')
+        header['OBSCLASS'] = 'science' if obstype == 'OBJECT' \
+            else 'dayCal'
+        header['GEMPRGID'] = (program, 'Gemini programme ID')
+        header['OBSID'] = (obs_name, 'Observation ID')
+        header['DATALAB'] = (obs_id, 'DHS data label')
+        header['OBJECT'] = {'OBJECT': 'Synthetic field', 'FLAT': 'GCALflat',
+                            'DARK': 'Dark'}[obstype]
+        header['DATE-OBS'] = start.strftime('%Y-%m-%d')
+        header['TIME-OBS'] = start.strftime('%H:%M:%S.%f')[:-3]
+        header['UT'] = header['TIME-OBS']
+        header['MJD-OBS'] = (mjd, 'MJD of start of observation')
+        header['EXPTIME'] = (exptime, 'Exposure time (s)')
+        header['COADDS'] = 1
+        header['LNRS'] = 1
+        header['NDAVGS'] = 16
+        header['CAMERA'] = (camera, 'Camera')
+        header['FILTER1'] = 'blank' if obstype == 'DARK' else 'open'
+        header['FILTER2'] = bandpass
+        header['FILTER3'] = 'open'
+        header['RA'] = 150.0
+        header['DEC'] = 2.0
+        if obstype == 'FLAT':
+            header['GCALLAMP'] = 'IRhigh'
+            header['GCALSHUT'] = 'OPEN'
+        return header
+
+    def _product_id(self, mjd):
+        night = mjd_to_datetime(mjd).strftime('%Y%m%d')
+        number = self.frame_numbers.get(night, 0) + 1
+        self.frame_numbers[night] = number
+        return 'N{}S{:04d}'.format(night, number)
+
+    def observation(self, obstype, obs_name, n_frames, exptime, bandpass,
+                    camera, mjd):
+        """
+        Write an observation's frames; returns their catalog rows.
+        """
+        rows = []
+        for i in range(n_frames):
+            frame_mjd = mjd + i * (exptime + OVERHEAD) / 86400
+            obs_id = '{}-{:03d}'.format(obs_name, i + 1)
+            product_id = self._product_id(frame_mjd)
+            # Object frames are dithered in a 3x3 pattern.
+            offset = (10 * (i % 3 - 1), 10 * (i // 3 % 3 - 1))
+            data = self.image(
+                obstype, exptime, offset=offset,
+                sky=50.0 if obstype == 'OBJECT' else 0.0,
+                lamp=1000.0 if obstype == 'FLAT' else 0.0)
+            filename = product_id + '.fits'
+            fits.PrimaryHDU(data, header=self.header(
+                obstype, obs_id, obs_name, exptime, bandpass, camera,
+                frame_mjd)).writeto(
+                    os.path.join(self.directory, filename), overwrite=True)
+            rows.append((
+                'ivo://cadc.nrc.ca/GEMINI?{}/{}'.format(obs_id, product_id),
+                product_id, bandpass, frame_mjd, exptime, obstype,
+                'science' if obstype == 'OBJECT' else 'calibration',
+                obs_name.rsplit('-', 1)[0], obs_id, filename))
+        return rows
+
+    def run(self, obs_name='GN-2019A-FT-108-12', n_objects=10, n_flats=10,
+            n_longdarks=10, n_shortdarks=0, bandpass='J', exptime=20.0,
+            camera='f6', mjd=58578.25):
+        """
+        Write a stack's object frames and calibrations, and a catalog of
+        them (catalog.ecsv); returns the catalog.
+
+        Flats are taken the night before, darks the night after.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        night = mjd_to_datetime(mjd - 1).strftime('%Y%m%d')
+        rows = self.observation(
+            'OBJECT', obs_name, n_objects, exptime, bandpass, camera, mjd)
+        rows += self.observation(
+            'FLAT', 'GN-CAL{}-10'.format(night), n_flats, 5.0, bandpass,
+            camera, mjd - 1)
+        night = mjd_to_datetime(mjd + 1).strftime('%Y%m%d')
+        rows += self.observation(
+            'DARK', 'GN-CAL{}-8'.format(night), n_longdarks, exptime,
+            bandpass, camera, mjd + 1)
+        rows += self.observation(
+            'DARK', 'GN-CAL{}-9'.format(night), n_shortdarks, 1.0,
+            bandpass, camera, mjd + 1.1)
+
+        catalog = astropy.table.Table(
+            rows=rows, names=CATALOG_COLUMNS) if rows else \
+            astropy.table.Table(names=CATALOG_COLUMNS)
+        catalog.write(os.path.join(self.directory, CATALOG_NAME),
+                      overwrite=True)
+        self.logger.info("Wrote {} frames to {}.".format(
+            len(rows), self.directory))
+        return catalog
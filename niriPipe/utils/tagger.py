@@ -64,9 +64,22 @@
 #
 #
 # ***********************************************************************
+import concurrent.futures
 import os
+import shutil
+import tempfile
 import astropy.io.fits as fits
+import niriPipe.utils.checksum
 import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.state
+import niriPipe.utils.tracing
+
+
+# FITS files are made of 2880 byte blocks of 36 80-character header cards.
+CARD_SIZE = 80
+CARDS_PER_BLOCK = 36
+BLOCK_SIZE = CARD_SIZE * CARDS_PER_BLOCK
 
 
 class Tagger:
@@ -79,63 +92,194 @@ class Tagger:
             ('longdark', 'dark'),
             ('shortdark', 'bpm')
     ]
+    # Blank header cards to leave in products, so tagging them later
+    # doesn't outgrow the header (see reserve_cards() and
+    # reserve_file_cards()).
+    reserved_cards = 8
 
-    def __init__(self, products, state):
+    def __init__(self, products, state, ad_products=None):
         self.products = products
         self.state = state
+        # Products still in memory (AstroData), to be written once tagged.
+        self.ad_products = ad_products or {}
         self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
             self.__module__, self.__class__.__name__))
 
     def run(self):
+        to_tag = []
         for raw_key, product_key in self.keys:
             config_key = 'min_{}s'.format(raw_key)
             product_name = 'processed_{}'.format(product_key)
 
             if int(self.state['config']['DATAFINDER'][config_key]):
-                # Add product-specific keywords
-                if self.products['processed_bpm']:
-                    self.set_header_keyword(
-                        filename=self.products[product_name],
-                        keyword='BPMIMG',
-                        value=os.path.basename(self.products['processed_bpm']),
-                        extname='PRIMARY',
-                        comment='Bad pixel mask used'
-                    )
-
-                # Add generic metadata keywords
-                self.set_header_keyword(
-                    filename=self.products[product_name],
-                    keyword='SOFTWARE',
-                    value='niriPipe',
-                    extname='PRIMARY',
-                    comment='Data reduction software name'
-                )
-                self.set_header_keyword(
-                    filename=self.products[product_name],
-                    keyword='SOFT_VER',
-                    value='0.1',
-                    extname='PRIMARY',
-                    comment='Data reduction software version'
-                )
-                self.set_header_keyword(
-                    filename=self.products[product_name],
-                    keyword='SOFT_DOI',
-                    value='10.5281/zenodo.4729003',
-                    extname='PRIMARY',
-                    comment='Data reduction software DOI'
-                )
+                to_tag.append(product_name)
             else:
                 self.logger.debug("Skipping tagging of {}.".format(
                     product_name))
 
+        # Products are separate files, so tag them concurrently.
+        cards = self._cards()
+        parent = niriPipe.utils.tracing.current_span()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_workers()) as pool:
+            futures = [
+                pool.submit(self._tag, product_name, cards, parent)
+                for product_name in to_tag
+            ]
+            for future in futures:
+                future.result()
+
         return self.products
 
-    def set_header_keyword(self, filename, keyword, value, extname, comment):
+    def _tag(self, product_name, cards, parent=None):
+        """
+        Add all cards to one product.
+        """
+        with niriPipe.utils.tracing.span(
+                'fits_update', parent=parent, product_name=product_name,
+                n_cards=len(cards),
+                in_memory=product_name in self.ad_products):
+            if product_name in self.ad_products:
+                self.tag_in_memory(
+                    ad=self.ad_products[product_name],
+                    filename=self.products[product_name],
+                    cards=cards
+                )
+            else:
+                self.set_header_keywords(
+                    filename=self.products[product_name],
+                    cards=cards,
+                    extname='PRIMARY'
+                )
+        niriPipe.utils.metrics.PRODUCTS_TAGGED.inc()
+
+    def _max_workers(self):
+        return max(1, int(
+            self.state['config'].get('TAGGING', {}).get('max_workers', 1)))
+
+    def _checksum(self):
+        return niriPipe.utils.state.to_bool(
+            self.state['config'].get('TAGGING', {}).get('checksum', False))
+
+    def _cards(self):
         """
-        Stub to make testing easier.
+        Header cards to add to each product, as (keyword, value, comment).
         """
-        self.logger.info(
-            "Setting {} in {} to {}.".format(keyword, filename, value))
-        fits.setval(
-                filename, keyword, value=value,
-                extname=extname, comment=comment)
+        cards = []
+        # Add product-specific keywords
+        if self.products['processed_bpm']:
+            cards.append((
+                'BPMIMG',
+                os.path.basename(self.products['processed_bpm']),
+                'Bad pixel mask used'))
+
+        # Add generic metadata keywords
+        cards.extend([
+            ('SOFTWARE', 'niriPipe', 'Data reduction software name'),
+            ('SOFT_VER', '0.1', 'Data reduction software version'),
+            ('SOFT_DOI', '10.5281/zenodo.4729003',
+                'Data reduction software DOI')
+        ])
+        return cards
+
+    def tag_in_memory(self, ad, filename, cards):
+        """
+        Add cards to an in-memory product, then write it out once.
+        """
+        for keyword, value, comment in cards:
+            self.logger.info(
+                "Setting {} in {} to {}.".format(keyword, filename, value))
+            ad.phu.set(keyword, value, comment)
+        ad.write(filename, overwrite=True)
+        self.logger.debug("Wrote {}.".format(filename))
+        if self._checksum():
+            # Headers only; data units are summed from the file just
+            # written.
+            with fits.open(filename, mode='update') as hdul:
+                self._add_checksums(hdul)
+
+    def set_header_keywords(self, filename, cards, extname):
+        """
+        Set all cards in one header, opening the file only once.
+
+        The header is updated in place as long as the new cards fit in its
+        existing blocks (or replace blank cards left there, see
+        reserve_cards()); otherwise astropy has to rewrite the whole file.
+        CHECKSUM/DATASUM, if enabled, are added in the same update.
+        """
+        for keyword, value, comment in cards:
+            self.logger.info(
+                "Setting {} in {} to {}.".format(keyword, filename, value))
+        with fits.open(filename, mode='update') as hdul:
+            header = hdul[extname].header
+            for keyword, value, comment in cards:
+                header.set(keyword, value, comment)
+            if self._checksum():
+                self._add_checksums(hdul)
+
+    def _add_checksums(self, hdul):
+        self.logger.debug("Adding checksums to {}.".format(hdul.filename()))
+        niriPipe.utils.checksum.add_checksums(hdul)
+
+    @classmethod
+    def reserve_cards(cls, header, n_cards=None):
+        """
+        Append blank cards to a header about to be written.
+
+        astropy fills trailing blank cards before growing a header, so
+        these let the Tagger add its cards later without a file rewrite.
+        """
+        for i in range(cls.reserved_cards if n_cards is None else n_cards):
+            header.add_blank()
+        return header
+
+    @classmethod
+    def reserve_file_cards(cls, filename, dest=None, n_cards=None):
+        """
+        Make room for blank cards in the primary header of a FITS file
+        someone else (DRAGONS) wrote, moving it to dest if given.
+
+        Blank cards before END and the padding after it are free space
+        already; only if there's less than n_cards of it is the header
+        rewritten, with the data copied as is. When moving the file, that
+        happens in the same pass as the copy. Returns the file's name.
+        """
+        n_cards = cls.reserved_cards if n_cards is None else n_cards
+        dest = dest or filename
+        with open(filename, 'rb') as f:
+            cards = []
+            while not cards or cards[-1][:8] != b'END     ':
+                block = f.read(BLOCK_SIZE)
+                if len(block) < BLOCK_SIZE:
+                    raise ValueError(
+                        "No primary header END card in {}.".format(filename))
+                for i in range(0, BLOCK_SIZE, CARD_SIZE):
+                    cards.append(block[i:i + CARD_SIZE])
+                    if cards[-1][:8] == b'END     ':
+                        break
+            end = len(cards) - 1
+            free = -len(cards) % CARDS_PER_BLOCK
+            while end - 1 >= 0 and not cards[end - 1].strip():
+                end -= 1
+                free += 1
+            if free >= n_cards:
+                if dest != filename:
+                    shutil.move(filename, dest)
+                return dest
+
+            # The file is read up to the end of the header.
+            cards[-1:] = [b' ' * CARD_SIZE] * n_cards + cards[-1:]
+            cards.extend([b' ' * CARD_SIZE] * (-len(cards) % CARDS_PER_BLOCK))
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(dest)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    out.write(b''.join(cards))
+                    shutil.copyfileobj(f, out)
+                os.replace(tmp, dest)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        if dest != filename:
+            os.remove(filename)
+        return dest
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+from unittest.mock import patch
+import pytest
+import copy
+import json
+import os
+import astropy.io.fits as fits
+import astropy.table
+import numpy as np
+from niriPipe.utils.association import Associator
+from niriPipe.utils.batch import Batch
+from niriPipe.utils.finder import Finder
+from niriPipe.utils.localcadc import LocalCadc
+import niriPipe.utils.localcadc
+import niriPipe.utils.state
+
+FRAMES = [
+    # observationID, productID, type, time_bounds_lower, time_exposure
+    ('GN-CAL20190404-10-001', 'N20190404S0001', 'FLAT', 58577.20, 5.0),
+    ('GN-CAL20190404-10-002', 'N20190404S0002', 'FLAT', 58577.21, 5.0),
+    ('GN-CAL20190404-11-001', 'N20190404S0011', 'DARK', 58577.30, 20.0),
+    ('GN-CAL20190404-11-002', 'N20190404S0012', 'DARK', 58577.31, 20.0),
+    ('GN-CAL20190404-13-001', 'N20190404S0031', 'DARK', 58577.40, 60.0),
+    ('GN-2019A-FT-108-10-001', 'N20190404S0101', 'OBJECT', 58577.50, 20.0),
+    ('GN-2019A-FT-108-11-001', 'N20190404S0111', 'OBJECT', 58577.60, 20.0),
+    ('GN-2019A-FT-108-12-001', 'N20190404S0121', 'OBJECT', 58577.70, 60.0),
+]
+
+OBS_NAMES = [
+    'GN-2019A-FT-108-10', 'GN-2019A-FT-108-11', 'GN-2019A-FT-108-12']
+
+
+class QueryCountingCadc(LocalCadc):
+    def __init__(self, *args, **kwargs):
+        self.queries = []
+        super().__init__(*args, **kwargs)
+
+    def tap(self, adql):
+        self.queries.append(adql)
+        return super().tap(adql)
+
+
+def write_catalog(directory='archive'):
+    os.mkdir(directory)
+    rows = []
+    for obs_id, product_id, obstype, mjd, exptime in FRAMES:
+        filename = product_id + '.fits'
+        hdu = fits.PrimaryHDU(np.zeros((8, 8), dtype=np.float32))
+        hdu.header['CAMERA'] = 'f6'
+        hdu.writeto(os.path.join(directory, filename))
+        rows.append((
+            'ivo://cadc.nrc.ca/GEMINI?{}/{}'.format(obs_id, product_id),
+            product_id, 'J', mjd, exptime, obstype,
+            'science' if obstype == 'OBJECT' else 'calibration',
+            'GN-2019A-FT-108', obs_id, filename))
+    catalog = astropy.table.Table(rows=rows, names=[
+        'publisherID', 'productID', 'energy_bandpassName',
+        'time_bounds_lower', 'time_exposure', 'type', 'intent',
+        'proposal_id', 'observationID', 'filename'])
+    catalog.write(os.path.join(directory, 'catalog.ecsv'))
+    return niriPipe.utils.localcadc.read_catalog(
+        os.path.join(directory, 'catalog.ecsv'))
+
+
+def get_state(obs_name, url):
+    state = niriPipe.utils.state.get_initial_state(
+        obs_name=[obs_name], intent=['science'], bandpass=['J'])
+    state['config']['DATARETRIEVAL']['datasource'] = url
+    return state
+
+
+def frames(table):
+    return sorted(zip(table['niriPipe_type'], table['productID']))
+
+
+def finder_pipeline(state):
+    """
+    Stands in for niriReduce.run_pipeline; only finds frames.
+    """
+    return {'frames': frames(Finder(state).run()),
+            'camera': state['current_stack']['camera']}
+
+
+def fake_reduce(state, table, directory):
+    with open(os.path.join(directory, 'reduced.json'), 'w') as f:
+        json.dump(frames(table), f)
+    return ['processed_dark']
+
+
+class TestAssociation(unittest.TestCase):
+    """
+    Class for testing calibration association.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_associate(self):
+        """
+        Stacks get the frames their Finder would find, from one query per
+        bandpass or exposure time; identical calibrations are one set.
+        """
+        with QueryCountingCadc(write_catalog()) as server:
+            states = [get_state(obs_name, server.url)
+                      for obs_name in OBS_NAMES + ['GN-2019A-FT-108-99']]
+            expected = [frames(Finder(copy.deepcopy(state)).run())
+                        for state in states[:3]]
+            del server.queries[:]
+            stacks, sets = Associator(states).run()
+
+        assert [frames(stack['table']) for stack in stacks[:3]] == expected
+        assert stacks[3]['table'] is None
+        assert stacks[3]['error'].startswith('RuntimeError')
+        assert states[0]['current_stack']['camera'] == 'f6'
+        # 4 object queries, flats in J, and darks of 20 s and 60 s.
+        assert len(server.queries) == 7
+
+        assert stacks[0]['calibration_set'] == stacks[1]['calibration_set']
+        assert stacks[0]['calibration_set'] != stacks[2]['calibration_set']
+        assert sorted(len(s['stacks']) for s in sets.values()) == [1, 2]
+        assert frames(sets[stacks[2]['calibration_set']]['table']) == [
+            ('flat', 'N20190404S0001'), ('flat', 'N20190404S0002'),
+            ('longdark', 'N20190404S0031')]
+
+    def test_associate_config(self):
+        """
+        Stacks with the same calibration frames but config that changes
+        their products don't share a calibration set.
+        """
+        with LocalCadc(write_catalog()) as server:
+            states = [get_state(obs_name, server.url)
+                      for obs_name in OBS_NAMES[:2]]
+            states[1]['config']['REDUCTION']['in_memory'] = 'True'
+            stacks, sets = Associator(states).run()
+
+        assert frames(stacks[0]['table'])[:-1] == \
+            frames(stacks[1]['table'])[:-1]
+        assert stacks[0]['calibration_set'] != stacks[1]['calibration_set']
+        assert len(sets) == 2
+
+    @patch('niriPipe.utils.prefetch.reduce_calibrations', fake_reduce)
+    def test_batch(self):
+        """
+        With associate, each calibration set is reduced once, and stacks
+        don't query for frames again.
+        """
+        with QueryCountingCadc(write_catalog()) as server:
+            with open('niri.cfg', 'w') as f:
+                f.write("[DATARETRIEVAL]\ndataSource = {}\n".format(
+                    server.url))
+            results = Batch(
+                pipeline=finder_pipeline,
+                stacks=[{'obsID': obs_name, 'intent': 'science',
+                         'bandpass': 'J', 'config': ''}
+                        for obs_name in OBS_NAMES],
+                directory='batch',
+                processes=2,
+                configfile='niri.cfg',
+                associate=True
+            ).run()
+        assert len(server.queries) == 6
+        assert all(result['succeeded'] for result in results)
+        assert results[0]['products']['camera'] == 'f6'
+        assert results[0]['products']['frames'] == [
+            ('flat', 'N20190404S0001'), ('flat', 'N20190404S0002'),
+            ('longdark', 'N20190404S0011'), ('longdark', 'N20190404S0012'),
+            ('object', 'N20190404S0101')]
+
+        with open(os.path.join('batch', Batch.report_name)) as f:
+            report = json.load(f)
+        calibration_sets = report['calibration_sets']
+        assert sorted(s['stacks'] for s in calibration_sets) == [
+            OBS_NAMES[:2], OBS_NAMES[2:]]
+        assert all(s['succeeded'] for s in calibration_sets)
+        for calibration_set in calibration_sets:
+            assert os.path.exists(os.path.join(
+                calibration_set['directory'], 'reduced.json'))
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import json
+import logging
+import niriPipe.utils.batch
+import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+from niriPipe.utils.batch import Batch
+
+MANIFEST = """# A test manifest
+obsID,intent,bandpass,config
+GN-2019A-FT-108-10,science,J,
+
+GN-2019A-FT-108-11, calibration, K(short),
+GN-2019A-FT-108-12,science,H,
+"""
+
+
+def fake_pipeline(state):
+    """
+    Stands in for niriReduce.run_pipeline; fails for one stack.
+    """
+    stack = state['current_stack']
+    niriPipe.utils.customLogger.get_logger('niriPipe.fake_pipeline').info(
+        "Running {}".format(stack['obs_name']))
+    niriPipe.utils.metrics.FRAMES_DOWNLOADED.inc(2)
+    if stack['obs_name'].endswith('-12'):
+        raise RuntimeError("Not enough flats.")
+    with open('stack.fits', 'w') as f:
+        f.write(stack['bandpass'])
+    return {
+        'processed_stack': os.path.abspath('stack.fits'),
+        'cwd': state['current_working_directory'],
+        'calibration_cache':
+            state['config']['REDUCTION']['calibration_cache'],
+    }
+
+
+def crashing_pipeline(state):
+    """
+    Kills its pool process: once for one stack, every time for another.
+    """
+    obs_name = state['current_stack']['obs_name']
+    if obs_name.endswith('-12') or (
+            obs_name.endswith('-11') and not os.path.exists('crashed')):
+        open('crashed', 'w').close()
+        os._exit(1)
+    return {'cwd': state['current_working_directory']}
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Class for testing batch mode.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_read_manifest(self):
+        with open('manifest.csv', 'w') as f:
+            f.write(MANIFEST)
+        stacks = niriPipe.utils.batch.read_manifest('manifest.csv')
+        assert [s['obsID'] for s in stacks] == [
+            'GN-2019A-FT-108-10', 'GN-2019A-FT-108-11', 'GN-2019A-FT-108-12']
+        assert stacks[1]['intent'] == 'calibration'
+        assert stacks[1]['bandpass'] == 'K(short)'
+        assert stacks[1]['config'] == ''
+
+        with open('bad.csv', 'w') as f:
+            f.write('obsID,bandpass\nGN-2019A-FT-108-10,J\n')
+        with pytest.raises(ValueError):
+            niriPipe.utils.batch.read_manifest('bad.csv')
+
+    def test_stack_directory(self):
+        assert niriPipe.utils.batch.stack_directory({
+            'obsID': 'GN-2019A-FT-108-11', 'intent': 'calibration',
+            'bandpass': 'K(short)'}) == \
+            'GN-2019A-FT-108-11_calibration_K_short_'
+
+    def test_batch(self):
+        """
+        Stacks run in their own directories with shared caches, and
+        failures are reported without stopping the batch.
+        """
+        with open('manifest.csv', 'w') as f:
+            f.write(MANIFEST)
+        home = os.getcwd()
+        niriPipe.utils.metrics.REGISTRY.clear()
+        batch = Batch(
+            pipeline=fake_pipeline,
+            stacks=niriPipe.utils.batch.read_manifest('manifest.csv'),
+            directory='batch',
+            processes=2
+        )
+        results = batch.run()
+
+        assert os.getcwd() == home
+        assert [r['succeeded'] for r in results] == [True, True, False]
+        assert 'Not enough flats' in results[2]['error']
+        for result in results[:2]:
+            directory = result['directory']
+            assert result['products']['cwd'] == directory
+            assert result['products']['processed_stack'] == \
+                os.path.join(directory, 'stack.fits')
+            assert result['products']['calibration_cache'] == \
+                os.path.join(home, 'batch', 'cache', 'calibrations')
+            assert os.path.exists(os.path.join(directory, 'niriPipe.log'))
+        assert len(set(r['directory'] for r in results)) == 3
+
+        with open(os.path.join('batch', Batch.report_name)) as f:
+            report = json.load(f)
+        assert report['succeeded'] == 2
+        assert report['failed'] == 1
+        assert all('metrics' not in r for r in report['results'])
+
+        # Metrics from all stacks' processes are collected.
+        with open(os.path.join('batch', Batch.metrics_name)) as f:
+            assert 'niripipe_frames_downloaded_total 6\n' in f.read()
+
+    def test_broken_pool(self):
+        """
+        Stacks lost when a pool process dies run again in a new pool, and
+        the report is written even if one keeps killing its process.
+        """
+        with open('manifest.csv', 'w') as f:
+            f.write(MANIFEST)
+        results = Batch(
+            pipeline=crashing_pipeline,
+            stacks=niriPipe.utils.batch.read_manifest('manifest.csv'),
+            directory='batch',
+            processes=1
+        ).run()
+
+        assert [r['succeeded'] for r in results] == [True, True, False]
+        assert results[2]['error'].startswith('BrokenProcessPool')
+        with open(os.path.join('batch', Batch.report_name)) as f:
+            report = json.load(f)
+        assert report['succeeded'] == 2
+        assert report['failed'] == 1
+
+    def test_bad_directory(self):
+        """
+        A stack whose directory can't be made fails like any other.
+        """
+        with open('batch', 'w') as f:
+            f.write('not a directory')
+        home = os.getcwd()
+        stack = {'obsID': 'GN-2019A-FT-108-10', 'intent': 'science',
+                 'bandpass': 'J', 'config': ''}
+        result = niriPipe.utils.batch.run_stack(
+            fake_pipeline, stack, os.path.join(home, 'batch', 'stack'),
+            None, [])
+
+        assert os.getcwd() == home
+        assert not result['succeeded']
+        assert result['error'].startswith(
+            ('FileExistsError', 'NotADirectoryError'))
+        assert 'metrics' in result
+
+    def test_queue_logging(self):
+        """
+        With queue logging, the stacks' log records reach this process,
+        and their own log files.
+        """
+        with open('manifest.csv', 'w') as f:
+            f.write(MANIFEST)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        root_logger = niriPipe.utils.customLogger.niriPipe_root_logger
+        root_logger.addHandler(handler)
+        level = root_logger.level
+        root_logger.setLevel(logging.INFO)
+        try:
+            results = Batch(
+                pipeline=fake_pipeline,
+                stacks=niriPipe.utils.batch.read_manifest('manifest.csv'),
+                directory='batch',
+                processes=2,
+                queue_logging=True
+            ).run()
+        finally:
+            root_logger.setLevel(level)
+            root_logger.removeHandler(handler)
+
+        messages = [record.getMessage() for record in records]
+        for result in results:
+            assert "Running {}".format(result['obsID']) in messages
+            record, = [r for r in records if r.getMessage() ==
+                       "Running {}".format(result['obsID'])]
+            # Tagged in the stack's process.
+            assert record.stack == result['obsID']
+            assert record.run_id == \
+                niriPipe.utils.customLogger.get_context()['run_id']
+            with open(os.path.join(result['directory'], 'niriPipe.log')) as f:
+                assert "Running {}".format(result['obsID']) in f.read()
+        # Tracebacks are formatted before records are sent, apart from the
+        # message.
+        failed, = [r for r in records if r.getMessage() ==
+                   "Stack GN-2019A-FT-108-12 failed."]
+        assert "RuntimeError: Not enough flats." in failed.exc_text
+        assert {record.processName for record in records
+                if record.getMessage().startswith('Running')} != \
+            {'MainProcess'}
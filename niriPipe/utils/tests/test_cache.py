@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+from niriPipe.utils.cache import FileCache
+import niriPipe.utils.cache
+
+
+class TestCache(unittest.TestCase):
+    """
+    Class for testing the shared file cache.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_read_write(self):
+        cache = FileCache('cache')
+        assert cache.read('foo.hdr') is None
+        cache.write('foo.hdr', b'SIMPLE')
+        assert cache.read('foo.hdr') == b'SIMPLE'
+        # No temporary files left behind.
+        assert os.listdir('cache') == ['foo.hdr']
+
+    def test_put_fetch(self):
+        with open('frame.fits', 'wb') as f:
+            f.write(b'data')
+        cache = FileCache('cache')
+        assert cache.fetch('frame.fits', 'copy.fits') is None
+        cache.put('frame.fits', 'frame.fits')
+
+        assert cache.fetch('frame.fits', 'copy.fits') == 'copy.fits'
+        assert not os.path.samefile('copy.fits', cache.get('frame.fits'))
+        assert cache.fetch('frame.fits', 'link.fits', link=True) == \
+            'link.fits'
+        assert os.path.samefile('link.fits', cache.get('frame.fits'))
+        with open('link.fits', 'rb') as f:
+            assert f.read() == b'data'
+
+    def test_bad_keys(self):
+        cache = FileCache('cache')
+        for key in ['', '../foo', 'sub/foo', '.hidden']:
+            with pytest.raises(ValueError):
+                cache.get(key)
+
+    def test_from_state(self):
+        state = {'config': {'DATAFINDER': {'header_cache': ''}}}
+        assert niriPipe.utils.cache.from_state(
+            state, 'DATAFINDER', 'header_cache') is None
+        assert niriPipe.utils.cache.from_state(
+            state, 'REDUCTION', 'calibration_cache') is None
+        state['config']['DATAFINDER']['header_cache'] = 'headers'
+        cache = niriPipe.utils.cache.from_state(
+            state, 'DATAFINDER', 'header_cache')
+        assert cache.path == os.path.abspath('headers')
+        assert os.path.isdir('headers')
+
+    def test_calibration_key_config(self):
+        state = {'config': {
+            'REDUCTION': {'in_memory': 'False', 'share_prepared': 'True'},
+            'DATAFINDER': {'min_longdarks': '1', 'min_shortdarks': '1',
+                           'min_flats': '1'},
+        }}
+
+        def key(frame_type):
+            return niriPipe.utils.cache.calibration_key(
+                frame_type, 'processed_' + frame_type, None, ['N1'], {},
+                niriPipe.utils.cache.product_config(state, frame_type))
+
+        dark, flat = key('longdark'), key('flat')
+        assert key('flat') == flat
+
+        # Sharing prepared flats and dark correction only change flats
+        state['config']['REDUCTION']['share_prepared'] = 'False'
+        state['config']['DATAFINDER']['min_longdarks'] = '0'
+        assert key('longdark') == dark
+        assert key('flat') != flat
+
+        state['config']['REDUCTION']['in_memory'] = 'True'
+        assert key('longdark') != dark
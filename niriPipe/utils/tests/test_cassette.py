@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import astropy.io.fits as fits
+from niriPipe.utils.cassette import Cassette
+from niriPipe.utils.downloader import Downloader
+from niriPipe.utils.finder import Finder
+from niriPipe.utils.localcadc import LocalCadc
+from niriPipe.utils.synthetic import Generator
+import niriPipe.utils.localcadc
+
+
+def get_state(url, raw_data_path='rawData'):
+    return {
+        'current_working_directory': os.getcwd(),
+        'config': {
+            'DATAFINDER': {
+                'min_objects': '2',
+                'min_flats': '2',
+                'min_longdarks': '2',
+                'min_shortdarks': '0',
+                'max_tries': '1'
+            },
+            'DATARETRIEVAL': {
+                'raw_data_path': raw_data_path,
+                'datasource': url
+            }
+        },
+        'current_stack': {
+            'obs_name': 'GN-2019A-FT-108-12',
+            'bandpass': 'J'
+        }
+    }
+
+
+def find_and_download(url, raw_data_path):
+    state = get_state(url, raw_data_path)
+    table = Finder(state).run()
+    Downloader(table=table, state=state).download_query_cadc()
+    return table
+
+
+class TestCassette(unittest.TestCase):
+    """
+    Class for testing recording and replaying archive responses.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_record_replay(self):
+        """
+        What is recorded from an archive is served back without it.
+        """
+        Generator('data', shape=(64, 64), seed=1).run(
+            n_objects=2, n_flats=2, n_longdarks=2, n_shortdarks=0)
+        with LocalCadc(niriPipe.utils.localcadc.read_catalog(
+                os.path.join('data', 'catalog.ecsv'))) as source:
+            with Cassette('cassette', record=True,
+                          source=source.url) as cassette:
+                recorded = find_and_download(cassette.url, 'recorded')
+            requests = source.requests
+
+        assert len(os.listdir(os.path.join('cassette', 'data'))) == 6
+        assert os.listdir(os.path.join('cassette', 'headers'))
+
+        # Recording again only asks the source for what's missing.
+        with LocalCadc(niriPipe.utils.localcadc.read_catalog(
+                os.path.join('data', 'catalog.ecsv'))) as source:
+            with Cassette('cassette', record=True,
+                          source=source.url) as cassette:
+                find_and_download(cassette.url, 'again')
+            assert source.requests == 0
+        assert requests > 0
+
+        with Cassette('cassette') as cassette:
+            replayed = find_and_download(cassette.url, 'replayed')
+        assert list(replayed['productID']) == list(recorded['productID'])
+        assert list(replayed['niriPipe_type']) == \
+            list(recorded['niriPipe_type'])
+        for name in os.listdir('recorded'):
+            assert (fits.getdata(os.path.join('replayed', name)) ==
+                    fits.getdata(os.path.join('data', name))).all()
+
+    def test_replay_missing(self):
+        """
+        Anything not recorded is an error when replaying.
+        """
+        with pytest.raises(FileNotFoundError):
+            Cassette('cassette')
+
+        with Cassette('cassette', record=True,
+                      source='http://127.0.0.1:1'):
+            pass
+        with Cassette('cassette') as cassette:
+            with pytest.raises(RuntimeError, match='Max retries exceeded'):
+                Finder(get_state(cassette.url)).run()
+            assert cassette.header('N20190405S0001') is None
@@ -70,6 +70,8 @@ from unittest.mock import patch
 import pytest
 import os
 import logging
+import numpy as np
+import astropy.io.fits as fits
 from niriPipe.utils.checker import Checker
 import niriPipe.utils.customLogger
 
@@ -128,6 +130,16 @@ def get_products(
     return products
 
 
+class FakeAstroData:
+    """
+    Just enough of an AstroData object for the Checker.
+    """
+    def __init__(self, software=None):
+        self.phu = fits.Header()
+        if software:
+            self.phu['SOFTWARE'] = software
+
+
 class TestChecker(unittest.TestCase):
     """
     Test the Checker class.
@@ -280,3 +292,126 @@ class TestChecker(unittest.TestCase):
                 checker.run()
 
         assert 'Malformed metadata' in str(exc_info.value)
+
+    def test_checker_in_memory(self):
+        """
+        Products written from memory are checked without reopening them.
+        """
+        state = get_state()
+        products = get_products()
+
+        checker = Checker(
+            state=state, products=products,
+            ad_products={'processed_stack': FakeAstroData('niriPipe')})
+        with patch('astropy.io.fits.getval', return_value='niriPipe') as gv:
+            checker.run()
+        assert '/fake/path/N2019_stack.fits' not in [
+            c[0][0] for c in gv.call_args_list]
+
+        checker = Checker(
+            state=state, products=products,
+            ad_products={'processed_stack': FakeAstroData()})
+        with patch('astropy.io.fits.getval', return_value='niriPipe'):
+            with pytest.raises(RuntimeError) as exc_info:
+                checker.run()
+        assert 'Malformed metadata in processed_stack' in str(exc_info.value)
+
+    def test_checker_checksums(self):
+        """
+        With verification on, a corrupted product should fail.
+        """
+        hdul = fits.HDUList([
+            fits.PrimaryHDU(), fits.ImageHDU(np.ones((8, 8)), name='SCI')])
+        hdul[0].header['SOFTWARE'] = 'niriPipe'
+        hdul.writeto('N2019_stack.fits', checksum=True)
+
+        state = get_state(min_flats='0', min_longdarks='0', min_shortdarks='0')
+        state['config']['CHECKING'] = {'verify_checksums': 'True'}
+        products = get_products(
+            processed_stack='N2019_stack.fits', processed_flat=None,
+            processed_dark=None, processed_bpm=None)
+
+        Checker(state=state, products=products).run()
+
+        with fits.open('N2019_stack.fits') as hdul:
+            data_offset = hdul.fileinfo(1)['datLoc']
+        with open('N2019_stack.fits', 'r+b') as f:
+            f.seek(data_offset)
+            f.write(b'\x00\x00\x00\x01')
+        with pytest.raises(RuntimeError) as exc_info:
+            Checker(state=state, products=products).run()
+        assert 'Checksum verification failed' in str(exc_info.value)
+
+    def test_checker_deep_check(self):
+        """
+        Deep check should pass good products and catch corrupt ones.
+        """
+        state = get_state(min_flats='0', min_longdarks='0', min_shortdarks='0')
+        state['config']['CHECKING'] = {
+            'deep_check': 'True',
+            'max_workers': '2',
+            'max_nan_fraction': '0.5',
+            'max_flagged_fraction': '0.5',
+            'min_finite_range': '0',
+        }
+        products = get_products(
+            processed_stack='N2019_stack.fits', processed_flat=None,
+            processed_dark=None, processed_bpm=None)
+
+        def write(sci, dq):
+            hdul = fits.HDUList([
+                fits.PrimaryHDU(),
+                fits.ImageHDU(sci.astype(np.float32), name='SCI')])
+            if dq is not None:
+                hdul.append(fits.ImageHDU(dq.astype(np.uint16), name='DQ'))
+            hdul[0].header['SOFTWARE'] = 'niriPipe'
+            hdul.writeto('N2019_stack.fits', overwrite=True)
+
+        good = np.arange(64.).reshape(8, 8)
+        write(good, np.zeros((8, 8)))
+        Checker(state=state, products=products).run()
+
+        for sci, dq, message in [
+                (np.full((8, 8), np.nan), np.zeros((8, 8)), '100.0% NaN'),
+                (np.zeros((8, 8)), np.zeros((8, 8)), 'finite range'),
+                (good, np.ones((8, 8)), 'flags 100.0% of pixels'),
+                (good, None, 'No DQ extension')]:
+            write(sci, dq)
+            with pytest.raises(RuntimeError) as exc_info:
+                Checker(state=state, products=products).run()
+            assert 'processed_stack' in str(exc_info.value)
+            assert message in str(exc_info.value)
+
+    def test_checker_deep_check_bpm(self):
+        """
+        A bad pixel mask is checked as a mask, without a DQ extension.
+        """
+        state = get_state(min_flats='0', min_longdarks='0', min_shortdarks='1')
+        state['config']['CHECKING'] = {
+            'deep_check': 'True',
+            'max_flagged_fraction': '0.5',
+            'min_finite_range': '0',
+        }
+        products = get_products(
+            processed_stack='N2019_stack.fits', processed_flat=None,
+            processed_dark=None, processed_bpm='N2019_bpm.fits')
+
+        def write(filename, hdus):
+            hdul = fits.HDUList([fits.PrimaryHDU()] + hdus)
+            hdul[0].header['SOFTWARE'] = 'niriPipe'
+            hdul.writeto(filename, overwrite=True)
+
+        write('N2019_stack.fits', [
+            fits.ImageHDU(np.arange(64.).reshape(8, 8), name='SCI'),
+            fits.ImageHDU(np.zeros((8, 8), dtype=np.uint16), name='DQ')])
+        mask = np.zeros((8, 8), dtype=np.uint16)
+        mask[0] = 1
+        write('N2019_bpm.fits', [fits.ImageHDU(mask, name='SCI')])
+        Checker(state=state, products=products).run()
+
+        write('N2019_bpm.fits', [
+            fits.ImageHDU(np.ones((8, 8), dtype=np.uint16), name='SCI')])
+        with pytest.raises(RuntimeError) as exc_info:
+            Checker(state=state, products=products).run()
+        assert 'processed_bpm: SCI[1] flags 100.0% of pixels' in \
+            str(exc_info.value)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import warnings
+import numpy as np
+import astropy.io.fits as fits
+import niriPipe.utils.checksum
+
+
+def make_file(filename):
+    hdul = fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.ImageHDU(
+            np.random.default_rng(1).random((64, 65)).astype(np.float32),
+            name='SCI'),
+        fits.ImageHDU(np.arange(9, dtype=np.uint16).reshape(3, 3),
+                      name='DQ')
+    ])
+    hdul.writeto(filename, overwrite=True)
+    return filename
+
+
+class TestChecksum(unittest.TestCase):
+    """
+    Class for testing streaming CHECKSUM/DATASUM.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_matches_astropy(self):
+        """
+        Cards should be the same as astropy's own.
+        """
+        ours = make_file('ours.fits')
+        with fits.open(ours, mode='update') as hdul:
+            niriPipe.utils.checksum.add_checksums(hdul)
+        theirs = 'theirs.fits'
+        with fits.open(make_file(theirs)) as hdul:
+            hdul.writeto(theirs, overwrite=True, checksum=True)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            with fits.open(ours, checksum=True) as a, \
+                    fits.open(theirs) as b:
+                for hdu_a, hdu_b in zip(a, b):
+                    assert hdu_a.verify_checksum() == 1
+                    assert hdu_a.verify_datasum() == 1
+                    assert hdu_a.header['CHECKSUM'] == hdu_b.header['CHECKSUM']
+                    assert hdu_a.header['DATASUM'] == hdu_b.header['DATASUM']
+
+    def test_blockwise_sum(self):
+        """
+        Summing in blocks should give the same result as in one go.
+        """
+        words = np.random.default_rng(2).integers(
+            0, 2 ** 32, size=1000, dtype=np.uint64).astype('>u4')
+        whole = niriPipe.utils.checksum.ones_complement_sum(
+            words, block_words=len(words))
+        assert niriPipe.utils.checksum.ones_complement_sum(
+            words, block_words=7) == whole
+
+    def test_verify(self):
+        """
+        Verification should catch corrupted data and headers.
+        """
+        filename = make_file('test.fits')
+        # No cards, nothing to check.
+        assert niriPipe.utils.checksum.verify(filename) == []
+
+        with fits.open(filename, mode='update') as hdul:
+            niriPipe.utils.checksum.add_checksums(hdul)
+        assert niriPipe.utils.checksum.verify(filename) == []
+
+        with fits.open(filename) as hdul:
+            data_offset = hdul.fileinfo(1)['datLoc']
+        with open(filename, 'r+b') as f:
+            f.seek(data_offset + 100)
+            f.write(b'\x01\x02\x03\x04')
+        assert niriPipe.utils.checksum.verify(filename) == [
+            'HDU 1: DATASUM mismatch.', 'HDU 1: CHECKSUM mismatch.']
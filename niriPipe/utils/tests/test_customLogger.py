@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import json
+import logging
+import threading
+import niriPipe.utils.customLogger as customLogger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.get_ident())
+
+
+class TestQueueLogging(unittest.TestCase):
+    """
+    Class for testing queued logging.
+    """
+    def setUp(self):
+        self.handler = ListHandler()
+        customLogger.niriPipe_root_logger.addHandler(self.handler)
+        self.level = customLogger.niriPipe_root_logger.level
+        customLogger.set_level(logging.INFO)
+
+    def tearDown(self):
+        customLogger.stop_queue_logging()
+        customLogger.niriPipe_root_logger.removeHandler(self.handler)
+        customLogger.set_level(self.level)
+
+    def test_queue_logging(self):
+        """
+        Records are handled by a background thread, and all of them are
+        handled by the time queue logging stops.
+        """
+        handlers = list(customLogger.niriPipe_root_logger.handlers)
+        customLogger.start_queue_logging()
+        assert self.handler not in customLogger.niriPipe_root_logger.handlers
+        logger = customLogger.get_logger('niriPipe.test')
+        for i in range(100):
+            logger.info("Message {}".format(i))
+        customLogger.stop_queue_logging()
+
+        assert [r.getMessage() for r in self.handler.records] == \
+            ["Message {}".format(i) for i in range(100)]
+        assert threading.get_ident() not in self.handler.threads
+        assert customLogger.niriPipe_root_logger.handlers == handlers
+
+    def test_add_remove_handler(self):
+        """
+        Handlers added while queue logging have handled every record by
+        the time they're removed.
+        """
+        customLogger.start_queue_logging()
+        extra = ListHandler()
+        customLogger.add_handler(extra)
+        logger = customLogger.get_logger('niriPipe.test')
+        logger.info("Both")
+        customLogger.remove_handler(extra)
+        logger.info("Only one")
+        customLogger.stop_queue_logging()
+
+        assert [r.getMessage() for r in extra.records] == ["Both"]
+        assert [r.getMessage() for r in self.handler.records] == \
+            ["Both", "Only one"]
+
+    def test_queued_exception(self):
+        """
+        Exceptions stay apart from the message through the queue.
+        """
+        customLogger.start_queue_logging()
+        logger = customLogger.get_logger('niriPipe.test')
+        try:
+            raise RuntimeError("Fake failure...")
+        except RuntimeError:
+            logger.exception("Finder failed with %d frames!", 3)
+        customLogger.stop_queue_logging()
+
+        record, = self.handler.records
+        entry = json.loads(customLogger.JsonFormatter().format(record))
+        assert entry['message'] == 'Finder failed with 3 frames!'
+        assert 'RuntimeError: Fake failure...' in entry['exception']
+        assert 'RuntimeError: Fake failure...' in \
+            logging.Formatter(customLogger.TEXT_FORMAT).format(record)
+
+
+class TestJsonLogging(unittest.TestCase):
+    """
+    Class for testing structured logging.
+    """
+    def setUp(self):
+        self.handler = ListHandler()
+        customLogger.add_handler(self.handler)
+        self.level = customLogger.niriPipe_root_logger.level
+        customLogger.set_level(logging.INFO)
+
+    def tearDown(self):
+        customLogger.remove_handler(self.handler)
+        customLogger.set_level(self.level)
+
+    def test_json_formatter(self):
+        """
+        Records are tagged with the log context.
+        """
+        logger = customLogger.get_logger('niriPipe.test')
+        with customLogger.log_context(stack='GN-2019A-FT-108-12'):
+            with customLogger.log_context(stage='finder'):
+                logger.info("Found %d frames.", 12)
+            try:
+                raise RuntimeError("Fake failure...")
+            except RuntimeError:
+                logger.exception("Finder failed!")
+        logger.info("Done.")
+
+        formatter = customLogger.JsonFormatter()
+        found, failed, done = [
+            json.loads(formatter.format(r)) for r in self.handler.records]
+        assert found['message'] == 'Found 12 frames.'
+        assert found['level'] == 'INFO'
+        assert found['logger'] == 'niriPipe.test'
+        assert found['stack'] == 'GN-2019A-FT-108-12'
+        assert found['stage'] == 'finder'
+        assert found['run_id'] == customLogger.get_context()['run_id']
+        assert found['worker'] is None
+        assert 'exception' not in found
+        assert failed['stage'] is None
+        assert 'RuntimeError: Fake failure...' in failed['exception']
+        assert done['stack'] is None
+
+    def test_context_filter(self):
+        """
+        The context is added by the niriPipe handlers, not by replacing
+        the process-wide log record factory.
+        """
+        assert logging.getLogRecordFactory() is logging.LogRecord
+        with customLogger.log_context(stack='GN-2019A-FT-108-12'):
+            other = logging.getLogger('astropy').makeRecord(
+                'astropy', logging.INFO, __file__, 0, "Other", None, None)
+            customLogger.get_logger('niriPipe.test').info("Tagged")
+        assert not hasattr(other, 'stack')
+        record, = self.handler.records
+        assert record.stack == 'GN-2019A-FT-108-12'
+
+    def test_log_context(self):
+        with pytest.raises(ValueError):
+            with customLogger.log_context(colour='blue'):
+                pass
+        with pytest.raises(ValueError):
+            customLogger.set_format('xml')
+
+    def test_lazy(self):
+        """
+        Lazy arguments are only computed if the message is logged.
+        """
+        calls = []
+
+        def payload():
+            calls.append(1)
+            return 'payload'
+
+        logger = customLogger.get_logger('niriPipe.test')
+        logger.debug("State:\n%s", customLogger.Lazy(payload))
+        assert calls == []
+        logger.info("State:\n%s", customLogger.Lazy(payload))
+        assert calls == [1]
+        assert self.handler.records[0].getMessage() == 'State:\npayload'
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import numpy as np
+import astropy.io.fits as fits
+import niriPipe.utils.datastats
+
+
+def make_file(filename, sci, dq):
+    fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.ImageHDU(sci, name='SCI'),
+        fits.ImageHDU(dq, name='DQ'),
+    ]).writeto(filename, overwrite=True)
+    return filename
+
+
+class TestDatastats(unittest.TestCase):
+    """
+    Class for testing blockwise image statistics.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_image_stats(self):
+        """
+        Blockwise statistics should match numpy on the whole array.
+        """
+        sci = np.random.default_rng(3).normal(
+            size=(37, 41)).astype(np.float32)
+        sci[0, :11] = np.nan
+        sci[1, 0] = np.inf
+        dq = np.zeros((37, 41), dtype=np.uint16)
+        dq[2, :7] = 8
+        make_file('test.fits', sci, dq)
+
+        sci_stats, dq_stats = niriPipe.utils.datastats.image_stats(
+            'test.fits', block_elements=100)
+
+        finite = sci[np.isfinite(sci)]
+        assert sci_stats['extname'] == 'SCI'
+        assert sci_stats['size'] == sci.size
+        assert sci_stats['nan'] == 11
+        assert sci_stats['finite'] == sci.size - 12
+        assert sci_stats['min'] == float(finite.min())
+        assert sci_stats['max'] == float(finite.max())
+        # Unsigned DQ is stored with BZERO and must be scaled back.
+        assert dq_stats['extname'] == 'DQ'
+        assert dq_stats['nonzero'] == 7
+        assert dq_stats['min'] == 0
+        assert dq_stats['max'] == 8
+
+    def test_image_stats_truncated(self):
+        """
+        A data unit cut short should be reported, not read past the end.
+        """
+        make_file('test.fits', np.ones((64, 64), dtype=np.float32),
+                  np.zeros((64, 64), dtype=np.uint16))
+        with open('test.fits', 'r+b') as f:
+            f.truncate(2880 * 4)
+
+        # The cut is inside SCI, so astropy doesn't see DQ at all.
+        stats = niriPipe.utils.datastats.image_stats('test.fits')
+        assert [(s['extname'], s['truncated']) for s in stats] == \
+            [('SCI', True)]
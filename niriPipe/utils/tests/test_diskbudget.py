@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import subprocess
+import sys
+import threading
+import time
+import astropy.table
+from niriPipe.utils.diskbudget import DiskBudget, DiskBudgetExceeded
+import niriPipe.utils.diskbudget
+
+
+class TestDiskBudget(unittest.TestCase):
+    """
+    Class for testing the disk budget.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_reserve(self):
+        budget = DiskBudget('budget.sqlite', 100, wait=False)
+        first = budget.reserve('GN-1', 60)
+        assert budget.reserved() == 60
+        with pytest.raises(DiskBudgetExceeded, match='No room'):
+            budget.reserve('GN-2', 60)
+        # Refused reservations don't linger.
+        assert len(budget.reservations()) == 1
+        with pytest.raises(DiskBudgetExceeded, match='whole budget'):
+            budget.reserve('GN-3', 101)
+
+        budget.shrink(first, 30)
+        second = budget.reserve('GN-2', 60)
+        assert budget.reserved() == 90
+        budget.release(first)
+        budget.release(second)
+        assert budget.reserved() == 0
+
+    def test_wait(self):
+        """
+        Reservations that don't fit wait their turn, shared between
+        DiskBudgets on the same ledger.
+        """
+        budget = DiskBudget('budget.sqlite', 100, poll_interval=0.01)
+        first = budget.reserve('GN-1', 80)
+        granted = []
+
+        def reserve(owner, n_bytes):
+            granted.append((owner, DiskBudget(
+                'budget.sqlite', 100, poll_interval=0.01).reserve(
+                    owner, n_bytes)))
+
+        large = threading.Thread(target=reserve, args=('GN-2', 50))
+        large.start()
+        while len(budget.reservations()) < 2:
+            time.sleep(0.01)
+        # Would fit, but GN-2 was first.
+        small = threading.Thread(target=reserve, args=('GN-3', 10))
+        small.start()
+        time.sleep(0.1)
+        assert granted == []
+
+        budget.release(first)
+        large.join()
+        small.join()
+        assert [owner for owner, _ in granted] == ['GN-2', 'GN-3']
+        assert budget.reserved() == 60
+
+        timeout = DiskBudget('budget.sqlite', 100, wait_timeout=0.05,
+                             poll_interval=0.01)
+        with pytest.raises(DiskBudgetExceeded):
+            timeout.reserve('GN-4', 50)
+
+    def test_recover(self):
+        """
+        Reservations of dead processes are dropped.
+        """
+        budget = DiskBudget('budget.sqlite', 100, wait=False)
+        budget.reserve('GN-1', 60)
+        finished = subprocess.Popen([sys.executable, '-c', ''])
+        finished.wait()
+        with budget._connect() as connection:
+            connection.execute(
+                "UPDATE reservations SET pid = ?", (finished.pid,))
+        assert budget.reserve('GN-2', 60)
+        assert [r['owner'] for r in budget.reservations()] == ['GN-2']
+
+    def test_state(self):
+        state = {
+            'current_stack': {'obs_name': 'GN-1'},
+            'config': {'DISKBUDGET': {
+                'budget_gb': '0', 'ledger': os.path.join('cache', 'b.sqlite'),
+                'frame_mb': '1', 'intermediate_ratio': '1'}}}
+        table = astropy.table.Table([['N1', 'N2']], names=['productID'])
+        assert niriPipe.utils.diskbudget.from_state(state) is None
+        niriPipe.utils.diskbudget.reserve(state, table)
+        assert 'disk_reservation' not in state
+
+        state['config']['DISKBUDGET']['budget_gb'] = '1'
+        assert niriPipe.utils.diskbudget.estimate(state, table) == 4e6
+        niriPipe.utils.diskbudget.reserve(state, table)
+        budget = niriPipe.utils.diskbudget.from_state(state)
+        assert budget.reserved() == 4e6
+        niriPipe.utils.diskbudget.shrink(state, 1e6)
+        assert budget.reserved() == 3e6
+        niriPipe.utils.diskbudget.release(state)
+        assert budget.reserved() == 0
+        assert 'disk_reservation' not in state
@@ -70,10 +70,14 @@ from unittest.mock import patch
 import pytest
 import astropy.table
 import os
+import json
 import shutil
 import logging
+import requests
 from niriPipe.utils.downloader import Downloader
 import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+import niriPipe.utils.tracing
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 TESTDATA_DIR = os.path.join(THIS_DIR, 'data')
@@ -100,6 +104,19 @@ class MockResponse:
     def iter_content(self, **args):
         return open(self.json_data['test_file'], mode='rb')
 
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 def get_state():
     return {
@@ -203,6 +220,32 @@ class TestDownloader(unittest.TestCase):
         assert d._get_file(url) == \
             'N20140505S0114.fits'
 
+    @patch('niriPipe.utils.downloader.time.sleep')
+    def test__get_file_retry(self, sleep):
+        """
+        Failed responses are closed before retrying, after a jittered,
+        growing delay.
+        """
+        with open('fake_content', 'w') as f:
+            f.write("bar\n")
+        responses = [
+            MockResponse({}, 503, headers={}),
+            MockResponse({}, 503, headers={}),
+            MockResponse({"test_file": 'fake_content'}, 200, headers={
+                "Content-Disposition": 'inline; filename="N1.fits"',
+                "Content-MD5": 'c157a79031e1c40f85931829bc5fc552'})
+        ]
+
+        d = Downloader(table=None, state=get_state())
+        with patch('niriPipe.utils.downloader.requests.get',
+                   side_effect=responses):
+            assert d._get_file('http://localhost/N1.fits') == 'N1.fits'
+
+        assert all(getattr(r, 'closed', False) for r in responses)
+        first, second = [c[0][0] for c in sleep.call_args_list]
+        assert 0.5 <= first <= 1
+        assert 1 <= second <= 2
+
     def test__write_with_temp_file(self):
         """
         Download file with a checksum validation if header present,
@@ -287,3 +330,51 @@ class TestDownloader(unittest.TestCase):
                 response,
                 filename='fake_file.txt'
             )
+
+    @patch('niriPipe.utils.downloader.Cadc.get_data_urls',
+           side_effect=lambda table: list(table['publisherID']))
+    def test_download_cache(self, mock):
+        """
+        Cached frames are linked in; only the others are downloaded, and
+        then cached.
+        """
+        os.mkdir('cache')
+        with open(os.path.join('cache', 'N20140505S0341.fits'), 'w') as f:
+            f.write('cached')
+        table = astropy.table.Table(
+            [['ivo://foo/N20140505S0341', 'ivo://foo/N20140505S0342'],
+             ['N20140505S0341', 'N20140505S0342']],
+            names=('publisherID', 'productID'))
+        state = get_state()
+        state['config']['DATARETRIEVAL']['cache_path'] = 'cache'
+
+        d = Downloader(table=table, state=state)
+
+        def get_file(url):
+            filename = url.split('/')[-1] + '.fits'
+            with open(os.path.join(d.download_path, filename), 'w') as f:
+                f.write('downloaded')
+            return filename
+
+        niriPipe.utils.metrics.REGISTRY.clear()
+        niriPipe.utils.tracing.start_tracing('trace.jsonl')
+        with patch.object(d, '_get_file', side_effect=get_file) as get:
+            d.download_query_cadc()
+        niriPipe.utils.tracing.stop_tracing()
+        assert [c[0][0] for c in get.call_args_list] == \
+            ['ivo://foo/N20140505S0342']
+        with open(os.path.join(d.download_path, 'N20140505S0341.fits')) as f:
+            assert f.read() == 'cached'
+        assert sorted(os.listdir('cache')) == \
+            ['N20140505S0341.fits', 'N20140505S0342.fits']
+
+        with open('trace.jsonl') as f:
+            spans = [json.loads(line)['attributes'] for line in f]
+        assert spans == [
+            {'product_id': 'N20140505S0341', 'cached': True, 'bytes': 6},
+            {'product_id': 'N20140505S0342', 'cached': False, 'bytes': 10}]
+
+        assert niriPipe.utils.metrics.CACHE_REQUESTS.values == {
+            ('rawData', 'hit'): 1, ('rawData', 'miss'): 1}
+        assert niriPipe.utils.metrics.FRAMES_DOWNLOADED.values == {(): 1}
+        assert niriPipe.utils.metrics.DOWNLOADED_BYTES.values == {(): 10}
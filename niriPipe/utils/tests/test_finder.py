@@ -333,6 +333,16 @@ class TestFinder(unittest.TestCase):
                 finder._find_frames('fake_query', 'object')
         assert 'Required 3 object' in str(exc_info.value)
 
+    def test_do_query_retry(self):
+        """
+        A query that succeeds on retry returns its result.
+        """
+        finder = Finder(get_state())
+        with patch.object(Finder, '_do_query',
+                          side_effect=[IOError, ['1.fits', '2.fits']]):
+            assert finder._find_frames('fake_query', 'object') == \
+                ['1.fits', '2.fits']
+
     @patch('niriPipe.utils.finder.Finder._do_query', raise_exception)
     def test_do_query_exceed_retries(self):
         """
@@ -433,4 +443,86 @@ class TestFinder(unittest.TestCase):
         two_row_table = finder._mark_as('object', two_row_table)
         assert two_row_table[1]['niriPipe_type'] == 'object'
 
+    def test_budget(self):
+        """
+        _budget caps calibration frames to max_<type>s, preferring whole
+        observations closest in time to the object frames.
+        """
+        state = get_state(stack_metadata={'mjd_date': 58000.0})
+        table = astropy.table.Table([
+            ['a1', 'a2', 'b1', 'b2', 'b3', 'c1'],
+            ['GN-CAL20190404-1-001', 'GN-CAL20190404-1-002',
+             'GN-CAL20190404-2-001', 'GN-CAL20190404-2-002',
+             'GN-CAL20190404-2-003', 'GN-CAL20190404-3-001'],
+            [58000.30, 58000.31, 58000.01, 58000.02, 58000.03, 58000.50]],
+            names=['productID', 'observationID', 'time_bounds_lower'])
+
+        # No budget means no limit.
+        finder = Finder(state)
+        assert len(finder._budget('flat', table)) == 6
+
+        # Observation 2 is closest and fits entirely.
+        state['config']['DATAFINDER']['max_flats'] = '3'
+        finder = Finder(state)
+        assert list(finder._budget('flat', table)['productID']) == \
+            ['b1', 'b2', 'b3']
+
+        # Observation 2, then the closest frame of observation 1.
+        state['config']['DATAFINDER']['max_flats'] = '4'
+        finder = Finder(state)
+        assert list(finder._budget('flat', table)['productID']) == \
+            ['a1', 'b1', 'b2', 'b3']
+
+        # Budget smaller than closest observation; take its closest frames.
+        state['config']['DATAFINDER']['max_flats'] = '2'
+        finder = Finder(state)
+        self._caplog.clear()
+        with self._caplog.at_level(logging.INFO):
+            out_table = finder._budget('flat', table)
+        assert list(out_table['productID']) == ['b1', 'b2']
+        assert 'Kept 2 of 6 flat frames' in self._caplog.text
+
+        # A budget below the required minimum is a configuration error.
+        state = get_state(
+            min_flats=3, stack_metadata={'mjd_date': 58000.0})
+        state['config']['DATAFINDER']['max_flats'] = '2'
+        finder = Finder(state)
+        with pytest.raises(ValueError):
+            finder._budget('flat', table)
+
+    @patch.object(Finder, '_fetch_header',
+                  return_value="SIMPLE  =                    T / \n"
+                               "CAMERA  = 'f6      '           / \n")
+    def test_header_cache(self, mock):
+        """
+        Headers should be fetched once and then read from the cache.
+        """
+        state = get_state()
+        state['config']['DATAFINDER']['header_cache'] = 'headers'
+
+        finder = Finder(state)
+        assert finder._metadata_from_header('N2019.fits', 'CAMERA') == 'f6'
+        assert finder._metadata_from_header('N2019.fits', 'CAMERA') == 'f6'
+        assert mock.call_count == 1
+        assert os.listdir('headers') == ['N2019.fits.hdr']
+
+        # A new Finder (e.g. another stack) shares the cache.
+        finder = Finder(state)
+        assert finder._metadata_from_header('N2019.fits', 'CAMERA') == 'f6'
+        assert mock.call_count == 1
 
+    def test_not_strict(self):
+        """
+        Without strict, missing frames are recorded instead of raising.
+        """
+        finder = Finder(get_state(min_flats=3), strict=False)
+        finder._check_sufficient_frames(
+            key='min_flats', frame_type='flat',
+            table=astropy.table.Table([[1, 2]], names=['productID']))
+        assert finder.shortfalls == {'flat': (3, 2)}
+
+        finder = Finder(get_state(min_flats=3))
+        with pytest.raises(RuntimeError):
+            finder._check_sufficient_frames(
+                key='min_flats', frame_type='flat',
+                table=astropy.table.Table([[1, 2]], names=['productID']))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import time
+import astropy.io.fits as fits
+import astropy.table
+import numpy as np
+import requests
+from niriPipe.utils.downloader import Downloader
+from niriPipe.utils.finder import Finder
+from niriPipe.utils.localcadc import LocalCadc
+import niriPipe.utils.localcadc
+
+FRAMES = [
+    # observationID, productID, type, time_bounds_lower, time_exposure
+    ('GN-2019A-FT-108-12-010', 'N20190405S0120', 'OBJECT', 58578.50, 20.0),
+    ('GN-2019A-FT-108-12-011', 'N20190405S0121', 'OBJECT', 58578.51, 20.0),
+    ('GN-CAL20190404-10-001', 'N20190404S0001', 'FLAT', 58577.40, 5.0),
+    ('GN-CAL20190404-10-002', 'N20190404S0002', 'FLAT', 58577.41, 5.0),
+    ('GN-CAL20190406-8-001', 'N20190406S0101', 'DARK', 58579.60, 20.0),
+    ('GN-CAL20190406-9-001', 'N20190406S0201', 'DARK', 58579.70, 60.0),
+]
+
+
+def write_catalog(directory='archive'):
+    """
+    A small archive of NIRI-like frames and its catalog.
+    """
+    os.mkdir(directory)
+    rows = []
+    for obs_id, product_id, obstype, mjd, exptime in FRAMES:
+        filename = product_id + '.fits'
+        hdu = fits.PrimaryHDU(np.zeros((64, 64), dtype=np.float32))
+        hdu.header['CAMERA'] = 'f6'
+        hdu.header['OBSTYPE'] = obstype
+        hdu.writeto(os.path.join(directory, filename))
+        rows.append((
+            'ivo://cadc.nrc.ca/GEMINI?{}/{}'.format(obs_id, product_id),
+            product_id, 'J', mjd, exptime, obstype,
+            'science' if obstype == 'OBJECT' else 'calibration',
+            'GN-2019A-FT-108', obs_id, filename))
+    catalog = astropy.table.Table(rows=rows, names=[
+        'publisherID', 'productID', 'energy_bandpassName',
+        'time_bounds_lower', 'time_exposure', 'type', 'intent',
+        'proposal_id', 'observationID', 'filename'])
+    catalog.write(os.path.join(directory, 'catalog.ecsv'))
+    return niriPipe.utils.localcadc.read_catalog(
+        os.path.join(directory, 'catalog.ecsv'))
+
+
+def get_state(url):
+    return {
+        'current_working_directory': os.getcwd(),
+        'config': {
+            'DATAFINDER': {
+                'min_objects': '1',
+                'min_flats': '1',
+                'min_longdarks': '1',
+                'min_shortdarks': '0',
+                'max_tries': '30'
+            },
+            'DATARETRIEVAL': {
+                'datasource': url,
+                'raw_data_path': 'rawData'
+            }
+        },
+        'current_stack': {
+            'obs_name': 'GN-2019A-FT-108-12',
+            'bandpass': 'J'
+        }
+    }
+
+
+class TestLocalCadc(unittest.TestCase):
+    """
+    Class for testing the local stand-in for CADC.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_query(self):
+        catalog = write_catalog()
+        result = niriPipe.utils.localcadc.query(
+            catalog,
+            "SELECT Plane.productID, Observation.type "
+            "FROM caom2.Plane AS Plane WHERE "
+            "Observation.collection = 'GEMINI' "
+            "AND Observation.type = 'DARK' "
+            "AND Plane.time_bounds_lower >= '58570.0000' "
+            "AND Plane.time_exposure = '20.0' "
+            "ORDER BY observationID")
+        assert result.colnames == ['productID', 'type']
+        assert list(result['productID']) == ['N20190406S0101']
+
+        result = niriPipe.utils.localcadc.query(
+            catalog,
+            "SELECT productID FROM caom2.Plane WHERE "
+            "Observation.observationID LIKE 'GN-CAL20190404-%' "
+            "ORDER BY observationID")
+        assert list(result['productID']) == [
+            'N20190404S0001', 'N20190404S0002']
+
+    def test_find_and_download(self):
+        """
+        Finder and Downloader work against the stand-in.
+        """
+        with LocalCadc(write_catalog()) as server:
+            state = get_state(server.url)
+            table = Finder(state).run()
+            assert sorted(table['productID']) == [
+                'N20190404S0001', 'N20190404S0002', 'N20190405S0120',
+                'N20190405S0121', 'N20190406S0101']
+            assert state['current_stack']['camera'] == 'f6'
+
+            Downloader(table=table, state=state).download_query_cadc()
+        for product_id in table['productID']:
+            with open(os.path.join('rawData', product_id + '.fits'),
+                      'rb') as f, \
+                    open(os.path.join('archive', product_id + '.fits'),
+                         'rb') as g:
+                assert f.read() == g.read()
+
+    def test_download_retries(self):
+        """
+        Injected errors are retried, not written out as frames.
+        """
+        with LocalCadc(write_catalog(), error_rate=0.5, seed=1) as server:
+            state = get_state(server.url)
+            state['config']['DATARETRIEVAL'].update(
+                {'max_tries': '20', 'retry_delay': '0'})
+            downloader = Downloader(table=None, state=state)
+            for product_id in ['N20190404S0001', 'N20190404S0002']:
+                downloader._get_file(
+                    server.url + '/data/{}.fits'.format(product_id))
+            assert server.errors
+        for product_id in ['N20190404S0001', 'N20190404S0002']:
+            with open(os.path.join('rawData', product_id + '.fits'),
+                      'rb') as f, \
+                    open(os.path.join('archive', product_id + '.fits'),
+                         'rb') as g:
+                assert f.read() == g.read()
+
+        with LocalCadc(write_catalog('archive2'), error_rate=1) as server:
+            state = get_state(server.url)
+            state['config']['DATARETRIEVAL'].update(
+                {'max_tries': '2', 'retry_delay': '0',
+                 'raw_data_path': 'rawData2'})
+            with pytest.raises(requests.HTTPError):
+                Downloader(table=None, state=state)._get_file(
+                    server.url + '/data/N20190404S0001.fits')
+            assert server.errors == 2
+        assert os.listdir('rawData2') == []
+
+    def test_file_headers(self):
+        with LocalCadc(write_catalog()) as server:
+            r = requests.head(server.url + '/data/N20190404S0001.fits')
+            assert int(r.headers['Content-Length']) == \
+                os.path.getsize(os.path.join('archive', 'N20190404S0001.fits'))
+            assert r.headers['Content-Disposition'] == \
+                'inline; filename="N20190404S0001.fits"'
+            assert len(r.headers['Content-MD5']) == 32
+            assert requests.get(server.url + '/data/foo.fits').status_code \
+                == 404
+
+    def test_error_injection(self):
+        """
+        Injected errors are retried by the Finder.
+        """
+        with LocalCadc(write_catalog(), error_rate=0.5, seed=3) as server:
+            finder = Finder(get_state(server.url))
+            table = finder._find_frames(
+                finder.query_prefix + "AND Observation.type = 'FLAT' " +
+                finder.query_suffix, 'flat')
+        assert len(table) == 2
+        assert server.errors > 0
+        assert server.requests == server.errors + 1
+
+    def test_latency_and_bandwidth(self):
+        with LocalCadc(write_catalog(), latency=0.1,
+                       bandwidth=100000) as server:
+            start = time.perf_counter()
+            r = requests.get(server.url + '/data/N20190404S0001.fits')
+            elapsed = time.perf_counter() - start
+        assert r.status_code == 200
+        # 0.1 s latency, plus ~17 kB at 100 kB/s.
+        assert elapsed >= 0.1 + len(r.content) / 100000
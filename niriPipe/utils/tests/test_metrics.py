@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+from unittest.mock import patch
+from niriPipe.utils.metrics import Registry, PeriodicWriter
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Class for testing the metrics registry.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.counter(
+            'niripipe_cache_requests_total', 'Cache lookups.',
+            ['cache', 'result'])
+        assert registry.counter(
+            'niripipe_cache_requests_total', 'Cache lookups.',
+            ['cache', 'result']) is counter
+        counter.inc(cache='rawData', result='hit')
+        counter.inc(2, cache='rawData', result='hit')
+        counter.inc(cache='head"ers', result='miss')
+        with pytest.raises(ValueError):
+            counter.inc(cache='rawData')
+
+        assert registry.to_text() == (
+            '# HELP niripipe_cache_requests_total Cache lookups.\n'
+            '# TYPE niripipe_cache_requests_total counter\n'
+            'niripipe_cache_requests_total'
+            '{cache="head\\"ers",result="miss"} 1\n'
+            'niripipe_cache_requests_total'
+            '{cache="rawData",result="hit"} 3\n')
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram(
+            'niripipe_download_duration_seconds', 'Download time.',
+            buckets=(1, 10))
+        for value in [0.5, 1, 5, 20]:
+            histogram.observe(value)
+
+        assert registry.to_text().splitlines()[2:] == [
+            'niripipe_download_duration_seconds_bucket{le="1.0"} 2',
+            'niripipe_download_duration_seconds_bucket{le="10.0"} 3',
+            'niripipe_download_duration_seconds_bucket{le="+Inf"} 4',
+            'niripipe_download_duration_seconds_sum 26.5',
+            'niripipe_download_duration_seconds_count 4',
+        ]
+
+        with histogram.time():
+            pass
+        assert sum(histogram.values[()]['buckets']) == 5
+
+    def test_merge(self):
+        """
+        Values from other processes' registries are added.
+        """
+        registries = []
+        for _ in range(2):
+            registry = Registry()
+            registry.counter('frames', 'Frames.').inc(3)
+            registry.histogram(
+                'seconds', 'Seconds.', ['stage'], buckets=(1,)).observe(
+                    2, stage='reducer')
+            registries.append(registry)
+
+        registries[0].merge(registries[1].dump())
+        registries[0].merge({'unknown': [[[], 1]]})
+        assert registries[0].metrics['frames'].values == {(): 6}
+        assert registries[0].metrics['seconds'].values == {
+            ('reducer',): {'buckets': [0, 2], 'sum': 4.0}}
+
+        registries[0].clear()
+        assert registries[0].dump() == {'frames': [], 'seconds': []}
+
+    def test_write_textfile(self):
+        registry = Registry()
+        registry.counter('frames', 'Frames.').inc()
+        registry.write_textfile(os.path.join('metrics', 'niriPipe.prom'))
+        assert os.listdir('metrics') == ['niriPipe.prom']
+        with open(os.path.join('metrics', 'niriPipe.prom')) as f:
+            assert f.read() == registry.to_text()
+
+    def test_periodic_writer(self):
+        registry = Registry()
+        writer = PeriodicWriter(registry, 'niriPipe.prom', interval=60)
+        with patch.object(registry, 'write_textfile') as write:
+            with patch('time.monotonic', return_value=100):
+                writer.maybe_write()
+                writer.maybe_write()
+            with patch('time.monotonic', return_value=160):
+                writer.maybe_write()
+            assert write.call_count == 2
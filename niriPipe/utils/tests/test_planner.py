@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+from unittest.mock import patch
+import pytest
+import os
+import json
+import logging
+import astropy.table
+from niriPipe.utils.finder import Finder
+from niriPipe.utils.planner import Planner
+from niriPipe.utils.state import get_initial_state
+import niriPipe.utils.cache
+import niriPipe.utils.customLogger
+
+# Need to enable propagation for log capturing to work
+niriPipe.utils.customLogger.enable_propagation()
+niriPipe.utils.customLogger.set_level(logging.DEBUG)
+
+
+def get_state():
+    state = get_initial_state(
+        obs_name=['GN-2019A-FT-108-12'],
+        intent=['science'],
+        bandpass=['K'])
+    state['config']['PLANNING']['timing_history'] = ''
+    return state
+
+
+def get_table():
+    return astropy.table.Table(
+        [['ivo://foo/N1', 'ivo://foo/N2', 'ivo://foo/N3', 'ivo://foo/N4',
+          'ivo://foo/N5'],
+         ['N1', 'N2', 'N3', 'N4', 'N5'],
+         ['object', 'object', 'flat', 'flat', 'longdark']],
+        names=['publisherID', 'productID', 'niriPipe_type'])
+
+
+def fake_find(shortfalls=None):
+    def run(self):
+        self.shortfalls = shortfalls or {}
+        return get_table()
+    return run
+
+
+class TestPlanner(unittest.TestCase):
+    """
+    Class for testing run planning.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    @pytest.fixture(autouse=True)
+    def inject_fixtures(self, caplog):
+        self._caplog = caplog
+
+    @patch.object(Planner, '_content_length', return_value=1000000)
+    @patch.object(Planner, '_data_urls',
+                  side_effect=lambda table: list(table['publisherID']))
+    @patch.object(Finder, 'run', autospec=True, side_effect=fake_find())
+    def test_plan(self, *mocks):
+        """
+        Frames, bytes, cached frames and estimates should all be reported.
+        """
+        state = get_state()
+        os.mkdir('rawData')
+        open(os.path.join('rawData', 'N3.fits'), 'w').close()
+        state['config']['DATARETRIEVAL']['cache_path'] = 'cache'
+        niriPipe.utils.cache.FileCache('cache').write('N1.fits', b'')
+
+        planner = Planner(state)
+        plan = planner.run()
+        with self._caplog.at_level(logging.INFO):
+            planner.report(plan)
+
+        assert plan['feasible']
+        assert plan['frames']['object'] == {
+            'required': 1, 'found': 2, 'cached': 1, 'bytes': 1000000}
+        assert plan['frames']['flat']['cached'] == 1
+        assert plan['frames']['shortdark']['found'] == 0
+        assert plan['bytes_to_transfer'] == 3000000
+        assert plan['reusable_calibrations'] == {}
+        # 3 MB at 20 MB/s; 5 frames at 10 s per frame.
+        assert plan['estimate']['download_seconds'] == pytest.approx(0.15)
+        assert plan['estimate']['reduction_seconds'] == 50
+        assert 'Requirements met' in self._caplog.text
+        with open('plan.json') as f:
+            assert json.load(f)['bytes_to_transfer'] == 3000000
+
+    @patch.object(Planner, '_content_length', return_value=None)
+    @patch.object(Planner, '_data_urls',
+                  side_effect=lambda table: list(table['publisherID']))
+    @patch.object(Finder, 'run', autospec=True, side_effect=fake_find())
+    def test_plan_reusable_calibrations(self, *mocks):
+        """
+        Cached calibrations are reported and left out of the estimate.
+        """
+        state = get_state()
+        state['config']['REDUCTION']['calibration_cache'] = 'calibrations'
+        with open('timing.json', 'w') as f:
+            json.dump({'products': [
+                {'frame_type': 'flat', 'n_inputs': 2, 'wall_seconds': 8},
+                {'frame_type': 'object', 'n_inputs': 4, 'wall_seconds': 4},
+            ]}, f)
+        state['config']['PLANNING']['timing_history'] = 'timing.json'
+        cache = niriPipe.utils.cache.FileCache('calibrations')
+        key = niriPipe.utils.cache.calibration_key(
+            'longdark', 'processed_dark', None, ['N5'], {},
+            niriPipe.utils.cache.product_config(state, 'longdark'))
+        cache.write(key + '.fits', b'')
+        cache.write(key + '.json', b'{"filename": "N5_dark.fits"}')
+
+        plan = Planner(state).run()
+
+        assert plan['reusable_calibrations'] == \
+            {'processed_dark': 'N5_dark.fits'}
+        assert plan['frames_of_unknown_size'] == 5
+        # Flats at 4 s per frame, objects at 1 s per frame; no dark.
+        assert plan['estimate']['reduction_seconds'] == 2 * 4 + 2 * 1
+
+    @patch.object(Planner, '_content_length', return_value=0)
+    @patch.object(Planner, '_data_urls',
+                  side_effect=lambda table: list(table['publisherID']))
+    @patch.object(Finder, 'run', autospec=True,
+                  side_effect=fake_find({'flat': (3, 2)}))
+    def test_plan_infeasible(self, *mocks):
+        planner = Planner(get_state())
+        plan = planner.run()
+        with self._caplog.at_level(logging.INFO):
+            planner.report(plan)
+
+        assert not plan['feasible']
+        assert plan['shortfalls'] == {'flat': {'required': 3, 'found': 2}}
+        assert 'Required 3 flat frames; found 2.' in self._caplog.text
+
+    @patch.object(Finder, 'run', autospec=True,
+                  side_effect=RuntimeError("No object frames."))
+    def test_plan_finder_failure(self, *mocks):
+        plan = Planner(get_state()).run()
+        assert not plan['feasible']
+        assert 'No object frames' in plan['error']
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+from unittest.mock import patch
+import pytest
+import os
+import astropy.io.fits as fits
+import astropy.table
+import numpy as np
+from niriPipe.utils.localcadc import LocalCadc
+from niriPipe.utils.prefetch import Prefetcher, night_bounds
+import niriPipe.utils.localcadc
+import niriPipe.utils.state
+
+FRAMES = [
+    # observationID, productID, type, time_bounds_lower, time_exposure
+    ('GN-CAL20190404-10-001', 'N20190404S0001', 'FLAT', 58577.20, 5.0),
+    ('GN-CAL20190404-10-002', 'N20190404S0002', 'FLAT', 58577.21, 5.0),
+    ('GN-CAL20190404-11-001', 'N20190404S0011', 'DARK', 58577.30, 20.0),
+    ('GN-CAL20190404-11-002', 'N20190404S0012', 'DARK', 58577.31, 20.0),
+    ('GN-CAL20190404-12-001', 'N20190404S0021', 'DARK', 58577.35, 1.0),
+    ('GN-2019A-FT-108-12-010', 'N20190404S0120', 'OBJECT', 58577.50, 20.0),
+    ('GN-CAL20190405-3-001', 'N20190405S0001', 'DARK', 58578.30, 20.0),
+]
+
+
+def write_catalog(directory='archive', cameras=None):
+    os.mkdir(directory)
+    rows = []
+    for obs_id, product_id, obstype, mjd, exptime in FRAMES:
+        filename = product_id + '.fits'
+        hdu = fits.PrimaryHDU(np.zeros((8, 8), dtype=np.float32))
+        if cameras:
+            hdu.header['CAMERA'] = cameras.get(product_id, 'f6')
+        hdu.writeto(os.path.join(directory, filename))
+        rows.append((
+            'ivo://cadc.nrc.ca/GEMINI?{}/{}'.format(obs_id, product_id),
+            product_id, 'J', mjd, exptime, obstype,
+            'science' if obstype == 'OBJECT' else 'calibration',
+            'GN-2019A-FT-108', obs_id, filename))
+    catalog = astropy.table.Table(rows=rows, names=[
+        'publisherID', 'productID', 'energy_bandpassName',
+        'time_bounds_lower', 'time_exposure', 'type', 'intent',
+        'proposal_id', 'observationID', 'filename'])
+    catalog.write(os.path.join(directory, 'catalog.ecsv'))
+    return niriPipe.utils.localcadc.read_catalog(
+        os.path.join(directory, 'catalog.ecsv'))
+
+
+def get_state(url):
+    config = niriPipe.utils.state.read_config()
+    config['DATARETRIEVAL']['datasource'] = url
+    config['DATARETRIEVAL']['cache_path'] = 'rawCache'
+    config['REDUCTION']['calibration_cache'] = 'calibrations'
+    return {'current_working_directory': os.getcwd(), 'config': config}
+
+
+class TestPrefetch(unittest.TestCase):
+    """
+    Class for testing the nightly calibration prefetcher.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_night_bounds(self):
+        assert night_bounds('20190404') == (58577, 58578)
+        with pytest.raises(ValueError):
+            night_bounds('2019-04-04')
+
+    def test_prefetch(self):
+        """
+        Only the night's flats and darks end up in the download cache.
+        """
+        with LocalCadc(write_catalog()) as server:
+            state = get_state(server.url)
+            summary = Prefetcher(state, '20190404').run()
+        assert summary['succeeded']
+        assert summary['frames'] == {
+            'flat': 2, 'longdark': 2, 'shortdark': 1}
+        assert sorted(os.listdir('rawCache')) == [
+            'N20190404S0001.fits', 'N20190404S0002.fits',
+            'N20190404S0011.fits', 'N20190404S0012.fits',
+            'N20190404S0021.fits']
+        assert not os.path.exists('prefetch_20190404')
+
+        state['config']['DATARETRIEVAL']['cache_path'] = ''
+        with pytest.raises(ValueError):
+            Prefetcher(state, '20190404')
+
+    def test_calibrations(self):
+        """
+        Darks are reduced on their own, and flats with each dark (and the
+        closest short darks, if a bad pixel mask is made).
+        """
+        def reduce(name, table):
+            if 'GN-CAL20190404-12' in name:
+                raise RuntimeError('failed')
+            assert os.path.isdir(os.path.join('prefetch_20190404', 'rawData'))
+            return ['processed_dark']
+
+        with LocalCadc(write_catalog()) as server:
+            state = get_state(server.url)
+            with patch.object(Prefetcher, '_reduce',
+                              side_effect=reduce) as mock:
+                summary = Prefetcher(
+                    state, '20190404', calibrations=True).run()
+            assert [c[0][0] for c in mock.call_args_list] == [
+                'GN-CAL20190404-11',
+                'GN-CAL20190404-11+GN-CAL20190404-10']
+            assert list(mock.call_args_list[1][0][1]['niriPipe_type']) == [
+                'longdark', 'longdark', 'flat', 'flat']
+            assert summary['succeeded']
+            assert [c['set'] for c in summary['calibrations']] == [
+                'GN-CAL20190404-11', 'GN-CAL20190404-11+GN-CAL20190404-10']
+
+            state['config']['DATAFINDER']['min_shortdarks'] = '1'
+            state['config']['DATAFINDER']['min_longdarks'] = '0'
+            with patch.object(Prefetcher, '_reduce',
+                              side_effect=reduce) as mock:
+                summary = Prefetcher(
+                    state, '20190404', calibrations=True).run()
+        assert [c[0][0] for c in mock.call_args_list] == [
+            'GN-CAL20190404-12+GN-CAL20190404-10']
+        assert not summary['succeeded']
+        assert summary['failed'] == [{
+            'set': 'GN-CAL20190404-12+GN-CAL20190404-10',
+            'error': 'RuntimeError: failed'}]
+        assert os.path.isdir('prefetch_20190404')
+
+    def test_calibration_sets_camera_budget(self):
+        """
+        Flats are split by camera, and sets over budget are skipped.
+        """
+        with LocalCadc(write_catalog(
+                cameras={'N20190404S0002': 'f32'})) as server:
+            state = get_state(server.url)
+            with patch.object(Prefetcher, '_reduce',
+                              return_value=['processed_flat']) as mock:
+                Prefetcher(state, '20190404', calibrations=True).run()
+            assert [c[0][0] for c in mock.call_args_list] == [
+                'GN-CAL20190404-11',
+                'GN-CAL20190404-11+GN-CAL20190404-10_f32',
+                'GN-CAL20190404-11+GN-CAL20190404-10_f6']
+            assert list(mock.call_args_list[1][0][1]['productID']) == [
+                'N20190404S0011', 'N20190404S0012', 'N20190404S0002']
+
+            state['config']['DATAFINDER']['max_longdarks'] = '1'
+            state['config']['DATAFINDER']['min_longdarks'] = '1'
+            with patch.object(Prefetcher, '_reduce',
+                              return_value=['processed_flat']) as mock:
+                summary = Prefetcher(
+                    state, '20190404', calibrations=True).run()
+        assert mock.call_args_list == []
+        assert summary['succeeded']
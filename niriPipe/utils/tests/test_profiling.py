@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+from unittest.mock import patch
+import pytest
+import concurrent.futures
+import os
+import pstats
+import time
+from niriPipe.utils.profiling import Profiler
+import niriPipe.utils.profiling
+
+
+def busy_stage(seconds=0.05):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(1000))
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Class for testing per-stage profiling.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_stages(self):
+        """
+        Each stage gets a .pstats file, and they're merged.
+        """
+        profiler = Profiler(directory='profile', flamegraph=True)
+        profiler.start()
+        for name in ['finder', 'reducer']:
+            with profiler.stage(name):
+                busy_stage()
+        profiler.finish()
+
+        assert sorted(os.listdir('profile')) == [
+            'finder.pstats', 'flamegraph.folded', 'merged.pstats',
+            'reducer.pstats']
+        stats = pstats.Stats(os.path.join('profile', 'merged.pstats'))
+        calls = {func[2]: stat[0] for func, stat in stats.stats.items()}
+        assert calls['busy_stage'] == 2
+
+        with open(os.path.join('profile', 'flamegraph.folded')) as f:
+            lines = f.read().splitlines()
+        assert any('busy_stage' in line for line in lines)
+        # Folded format: semicolon separated frames, then a count.
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+
+    def test_threads(self):
+        """
+        Threads a stage starts are profiled and sampled too.
+        """
+        profiler = Profiler(directory='profile', flamegraph=True)
+        profiler.start()
+        with profiler.stage('tagger'):
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix='Tagger') as pool:
+                list(pool.map(busy_stage, [0.05, 0.05]))
+        profiler.finish()
+
+        stats = pstats.Stats(os.path.join('profile', 'tagger.pstats'))
+        calls = {func[2]: stat[0] for func, stat in stats.stats.items()}
+        assert calls['busy_stage'] == 2
+
+        with open(os.path.join('profile', 'flamegraph.folded')) as f:
+            lines = f.read().splitlines()
+        assert any(line.startswith('Tagger') and 'busy_stage' in line
+                   for line in lines)
+
+    def test_failed_stage(self):
+        """
+        A stage that raises is still profiled.
+        """
+        profiler = Profiler(directory='profile')
+        profiler.start()
+        with pytest.raises(RuntimeError):
+            with profiler.stage('downloader'):
+                raise RuntimeError("Fake failure...")
+        profiler.finish()
+        assert sorted(os.listdir('profile')) == [
+            'downloader.pstats', 'merged.pstats']
+
+    def test_disabled(self):
+        profiler = Profiler()
+        profiler.start()
+        with profiler.stage('finder'):
+            busy_stage(0)
+        profiler.finish()
+        assert os.listdir('.') == []
+
+    def test_from_environment(self):
+        with patch.dict(os.environ, {
+                niriPipe.utils.profiling.PROFILE_ENV: 'profile',
+                niriPipe.utils.profiling.FLAMEGRAPH_ENV: 'yes'}):
+            profiler = Profiler.from_environment()
+        assert profiler.directory == os.path.abspath('profile')
+        assert profiler.flamegraph
+
+        with patch.dict(os.environ, clear=True):
+            profiler = Profiler.from_environment()
+        assert profiler.directory is None
+        assert not profiler.flamegraph
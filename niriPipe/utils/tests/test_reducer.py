@@ -68,12 +68,16 @@
 import unittest
 from unittest.mock import patch
 import pytest
+import astropy.io.fits
 import astropy.table
 import os
+import json
 import logging
 from niriPipe.utils.reducer import Reducer
 from niriPipe.utils.state import get_initial_state
 import niriPipe.utils.customLogger
+import niriPipe.utils.diskbudget
+import niriPipe.utils.tagger
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 TESTDATA_DIR = os.path.join(THIS_DIR, 'data')
@@ -158,9 +162,142 @@ class MockReduce:
         self.recipename = ""
 
     def runr(self):
+        astropy.io.fits.PrimaryHDU().writeto('fake_file.fits', overwrite=True)
         self.output_filenames = ['fake_file.fits']
 
 
+class StagingMockReduce(MockReduce):
+    """
+    MockReduce that writes its output to the working directory, like
+    DRAGONS does, and remembers where it ran.
+    """
+    calls = []
+
+    def runr(self):
+        StagingMockReduce.calls.append({
+            'cwd': os.getcwd(), 'files': list(self.files)})
+        for f in self.files:
+            assert os.path.exists(f)
+        astropy.io.fits.PrimaryHDU().writeto('fake_file.fits', overwrite=True)
+        self.output_filenames = ['fake_file.fits']
+
+
+class FailingMockReduce(StagingMockReduce):
+    def runr(self):
+        super().runr()
+        raise RuntimeError("Fake DRAGONS failure...")
+
+
+class PreparingMockReduce(StagingMockReduce):
+    """
+    StagingMockReduce that writes one output per input for 'prepare'.
+    """
+    def runr(self):
+        if self.recipename != 'prepare':
+            return super().runr()
+        StagingMockReduce.calls.append({
+            'cwd': os.getcwd(), 'files': list(self.files),
+            'recipename': self.recipename})
+        self.output_filenames = []
+        for f in self.files:
+            output = os.path.basename(f).replace('.fits', '_prepared.fits')
+            open(output, 'w').close()
+            self.output_filenames.append(output)
+
+
+class FullHeaderMockReduce(StagingMockReduce):
+    """
+    StagingMockReduce whose products' headers fill their last block.
+    """
+    def runr(self):
+        super().runr()
+        phu = astropy.io.fits.PrimaryHDU()
+        for i in range(36 * 2 - 1 - len(phu.header)):
+            phu.header['HIERARCH FAKE{}'.format(i)] = i
+        phu.writeto('fake_file.fits', overwrite=True)
+
+
+def free_cards(filename):
+    """
+    Number of cards a file's primary header has room for.
+    """
+    header = astropy.io.fits.getheader(filename)
+    blank = 0
+    for card in reversed(header.cards):
+        if card.keyword:
+            break
+        blank += 1
+    return -(len(header) + 1) % 36 + blank
+
+
+class BpmFailingMockReduce(PreparingMockReduce):
+    """
+    PreparingMockReduce that fails recipes using the prepared flats.
+    """
+    def runr(self):
+        if any(f.endswith('_prepared.fits') for f in self.files):
+            raise RuntimeError("Fake DRAGONS failure...")
+        return super().runr()
+
+
+class MockAstroData:
+    """
+    Mocks an AstroData object as returned by the DRAGONS mappers.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.phu = astropy.io.fits.Header()
+
+    def write(self, filename, overwrite=False):
+        with open(filename, 'w') as f:
+            f.write('fake')
+
+
+class MockPrimitives:
+    def __init__(self, adinputs):
+        self.streams = {'main': adinputs}
+
+
+class MockPrimitiveMapper:
+    """
+    Mocks recipe_system.mappers.primitiveMapper.PrimitiveMapper
+    """
+    calls = []
+
+    def __init__(self, adinputs, **kwargs):
+        MockPrimitiveMapper.calls.append(kwargs)
+        self.adinputs = adinputs
+
+    def get_applicable_primitives(self):
+        return MockPrimitives(self.adinputs)
+
+
+class MockRecipeMapper:
+    """
+    Mocks recipe_system.mappers.recipeMapper.RecipeMapper; the 'recipe'
+    turns each input into a product.
+    """
+    def __init__(self, adinputs, **kwargs):
+        pass
+
+    def get_applicable_recipe(self):
+        def recipe(p):
+            p.streams['main'] = [
+                MockAstroData(ad.filename.replace('.fits', '_product.fits'))
+                for ad in p.streams['main'][:1]]
+        return recipe
+
+
+def make_raw_files(state, table):
+    """
+    Write empty raw files for every frame in table.
+    """
+    raw_dir = state['config']['DATARETRIEVAL']['raw_data_path']
+    os.mkdir(raw_dir)
+    for product_id in table['productID']:
+        open(os.path.join(raw_dir, product_id + '.fits'), 'w').close()
+
+
 class TestReducer(unittest.TestCase):
     """
     Test the Reducer class.
@@ -220,6 +357,229 @@ class TestReducer(unittest.TestCase):
             products['processed_stack'] == 'fake_file.fits'
         ])
 
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', MockReduce)
+    def test_timing_report(self, mock):
+        """
+        A JSON timing report should be written alongside the products.
+        """
+        state, table = get_state_table(min_shortdarks='1')
+
+        reducer = Reducer(state=state, table=table)
+        reducer.run()
+
+        with open(state['config']['REDUCTION']['timing_report']) as f:
+            report = json.load(f)
+
+        assert [p['product'] for p in report['products']] == [
+            'processed_dark', 'processed_bpm',
+            'processed_flat', 'processed_stack']
+        assert report['products'][1]['recipename'] == 'makeProcessedBPM'
+        assert all(p['wall_seconds'] >= 0 for p in report['products'])
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', StagingMockReduce)
+    def test_scratch_staging(self, mock):
+        """
+        With scratch_path set, DRAGONS should run in a scratch directory
+        on staged copies of the inputs, and only products come back.
+        """
+        state, table = get_state_table()
+        state['config']['REDUCTION']['scratch_path'] = 'scratch'
+        make_raw_files(state, table)
+        home = os.getcwd()
+        StagingMockReduce.calls = []
+
+        reducer = Reducer(state=state, table=table)
+        products = reducer.run()
+
+        assert os.getcwd() == home
+        for call in StagingMockReduce.calls:
+            assert call['cwd'].startswith(os.path.join(home, 'scratch'))
+            assert all(f.startswith(call['cwd']) for f in call['files'])
+        assert products['processed_stack'] == \
+            os.path.join(home, 'fake_file.fits')
+        assert os.path.exists(products['processed_stack'])
+        # Scratch directories are cleaned up.
+        assert os.listdir('scratch') == []
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', FullHeaderMockReduce)
+    def test_reserved_cards(self, mock):
+        """
+        Products DRAGONS writes get room for the Tagger's cards, with or
+        without scratch staging.
+        """
+        home = os.getcwd()
+        for scratch_path in ['', 'scratch']:
+            os.mkdir('run_' + scratch_path)
+            os.chdir('run_' + scratch_path)
+            state, table = get_state_table()
+            state['config']['REDUCTION']['scratch_path'] = scratch_path
+            make_raw_files(state, table)
+
+            products = Reducer(state=state, table=table).run()
+
+            assert free_cards(products['processed_stack']) >= \
+                niriPipe.utils.tagger.Tagger.reserved_cards
+            os.chdir(home)
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', StagingMockReduce)
+    def test_calibration_cache(self, mock):
+        """
+        A second stack with the same calibration inputs should reuse the
+        cached calibrations and only make its own stack.
+        """
+        home = os.getcwd()
+        for run in ['first', 'second']:
+            os.mkdir(run)
+            os.chdir(run)
+            state, table = get_state_table(min_shortdarks='1')
+            state['config']['REDUCTION']['calibration_cache'] = \
+                os.path.join(home, 'calibrations')
+            make_raw_files(state, table)
+            StagingMockReduce.calls = []
+
+            reducer = Reducer(state=state, table=table)
+            products = reducer.run()
+            os.chdir(home)
+
+        assert len(StagingMockReduce.calls) == 1
+        assert products['processed_dark'] == 'fake_file.fits'
+        assert products['processed_flat'] == 'fake_file.fits'
+        assert os.path.exists(os.path.join('second', 'fake_file.fits'))
+        # Three calibrations, each a file and its description.
+        assert len(os.listdir('calibrations')) == 6
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', PreparingMockReduce)
+    def test_share_prepared(self, mock):
+        """
+        Flats should be prepared once, used by both the BPM and flat
+        recipes, and removed once the flat is made.
+        """
+        state, table = get_state_table(min_shortdarks='1')
+        state['config']['REDUCTION']['share_prepared'] = 'True'
+        make_raw_files(state, table)
+        StagingMockReduce.calls = []
+
+        reducer = Reducer(state=state, table=table)
+        reducer.run()
+
+        prepare_calls = [
+            c for c in StagingMockReduce.calls
+            if c.get('recipename') == 'prepare']
+        assert len(prepare_calls) == 1
+        assert prepare_calls[0]['files'] == [
+            os.path.join('rawData', 'N20190406S0007.fits')]
+        # dark, prepare, bpm, flat, stack
+        bpm_call, flat_call = StagingMockReduce.calls[2:4]
+        assert 'N20190406S0007_prepared.fits' in bpm_call['files']
+        assert flat_call['files'] == ['N20190406S0007_prepared.fits']
+        assert not os.path.exists('N20190406S0007_prepared.fits')
+        assert 'prepared_flat' not in reducer.products
+        assert reducer.timings[1]['product'] == 'prepared_flat'
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', BpmFailingMockReduce)
+    def test_share_prepared_failure(self, mock):
+        """
+        Prepared flats should be removed when a recipe using them fails.
+        """
+        state, table = get_state_table(min_shortdarks='1')
+        state['config']['REDUCTION']['share_prepared'] = 'True'
+        make_raw_files(state, table)
+
+        reducer = Reducer(state=state, table=table)
+        with pytest.raises(RuntimeError):
+            reducer.run()
+
+        assert not os.path.exists('N20190406S0007_prepared.fits')
+        assert reducer.intermediates == {}
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.mappers.primitiveMapper.PrimitiveMapper',
+           MockPrimitiveMapper)
+    @patch('recipe_system.mappers.recipeMapper.RecipeMapper',
+           MockRecipeMapper)
+    @patch('astrodata.open',
+           lambda path: MockAstroData(os.path.basename(path)))
+    def test_in_memory(self, mock):
+        """
+        In in-memory mode, calibrations are written for later recipes,
+        but the stack is kept in memory for the Tagger.
+        """
+        state, table = get_state_table(min_shortdarks='1')
+        state['config']['REDUCTION']['in_memory'] = 'True'
+        MockPrimitiveMapper.calls = []
+
+        reducer = Reducer(state=state, table=table)
+        products = reducer.run()
+
+        assert products['processed_dark'] == 'N20190406S0042_product.fits'
+        assert os.path.exists(products['processed_dark'])
+        assert products['processed_stack'] == 'N20190405S0111_product.fits'
+        assert not os.path.exists(products['processed_stack'])
+        assert reducer.ad_products['processed_stack'].filename == \
+            products['processed_stack']
+        assert ('addDQ:user_bpm', 'N20190406S0007_product.fits') in \
+            MockPrimitiveMapper.calls[-1]['uparms']
+        assert MockPrimitiveMapper.calls[1]['recipename'] == \
+            'makeProcessedBPM'
+
+    @patch('recipe_system.utils.reduce_utils.normalize_ucals', return_value=[])
+    @patch('recipe_system.reduction.coreReduce.Reduce', StagingMockReduce)
+    def test_cleanup(self, mock):
+        """
+        With [DISKBUDGET] cleanup, raw frames are removed once all products
+        using them are made, and their space given back to the budget.
+        """
+        state, table = get_state_table(min_shortdarks='1')
+        state['config']['DISKBUDGET'].update(
+            {'cleanup': 'True', 'ledger': 'budget.sqlite', 'budget_gb': '1'})
+        make_raw_files(state, table)
+        for product_id in table['productID']:
+            with open(os.path.join('rawData', product_id + '.fits'),
+                      'w') as f:
+                f.write('x' * 10)
+        # A frame linked in from the download cache frees nothing.
+        os.mkdir('cache')
+        os.link(os.path.join('rawData', table['productID'][0] + '.fits'),
+                os.path.join('cache', 'linked.fits'))
+        niriPipe.utils.diskbudget.reserve(state, table)
+        budget = niriPipe.utils.diskbudget.from_state(state)
+        reserved = budget.reserved()
+        StagingMockReduce.calls = []
+
+        # StagingMockReduce checks its inputs exist.
+        Reducer(state=state, table=table).run()
+
+        assert len(StagingMockReduce.calls) == 4
+        assert os.listdir('rawData') == []
+        assert budget.reserved() == reserved - 30
+        assert os.path.exists(os.path.join('cache', 'linked.fits'))
+        niriPipe.utils.diskbudget.release(state)
+        assert budget.reserved() == 0
+
+    @patch('recipe_system.reduction.coreReduce.Reduce', FailingMockReduce)
+    def test_scratch_staging_failure(self):
+        """
+        Scratch directories should be cleaned up when DRAGONS fails too.
+        """
+        state, table = get_state_table()
+        state['config']['REDUCTION']['scratch_path'] = 'scratch'
+        make_raw_files(state, table)
+        home = os.getcwd()
+
+        reducer = Reducer(state=state, table=table)
+        with pytest.raises(RuntimeError):
+            reducer.run()
+
+        assert os.getcwd() == home
+        assert os.listdir('scratch') == []
+        assert not os.path.exists('fake_file.fits')
+
     @patch('recipe_system.reduction.coreReduce.Reduce', raise_exception)
     @patch('gempy.utils.logutils')
     def test_reduction_exception(self, mock):
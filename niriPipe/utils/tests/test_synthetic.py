@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import astropy.io.fits as fits
+import numpy as np
+from niriPipe.utils.finder import Finder
+from niriPipe.utils.localcadc import LocalCadc
+from niriPipe.utils.synthetic import Generator
+import niriPipe.utils.localcadc
+import niriPipe.utils.synthetic
+
+
+class TestSynthetic(unittest.TestCase):
+    """
+    Class for testing the synthetic dataset generator.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def generate(self, **kwargs):
+        return Generator('data', shape=(128, 128), seed=1).run(**kwargs)
+
+    def test_catalog(self):
+        catalog = self.generate(
+            n_objects=4, n_flats=3, n_longdarks=2, n_shortdarks=1)
+        assert catalog.colnames == niriPipe.utils.synthetic.CATALOG_COLUMNS
+        assert list(catalog['type']) == \
+            ['OBJECT'] * 4 + ['FLAT'] * 3 + ['DARK'] * 3
+        assert list(catalog['time_exposure'][-3:]) == [20.0, 20.0, 1.0]
+        assert catalog['observationID'][0] == 'GN-2019A-FT-108-12-001'
+        assert catalog['productID'][0] == 'N20190405S0001'
+        assert len(set(catalog['productID'])) == 10
+        for row in catalog:
+            assert os.path.exists(os.path.join('data', row['filename']))
+        assert len(niriPipe.utils.localcadc.read_catalog(
+            os.path.join('data', 'catalog.ecsv'))) == 10
+
+    def test_frames(self):
+        catalog = self.generate(n_objects=2, n_flats=2, n_longdarks=2)
+        data = {}
+        for row in catalog:
+            with fits.open(os.path.join('data', row['filename'])) as hdul:
+                header = hdul[0].header
+                assert header['INSTRUME'] == 'NIRI'
+                assert header['OBSTYPE'] == row['type']
+                assert header['DATALAB'] == row['observationID']
+                assert header['EXPTIME'] == row['time_exposure']
+                assert header['CAMERA'] == 'f6'
+                assert abs(header['MJD-OBS'] - row['time_bounds_lower']) \
+                    < 1e-9
+                data.setdefault(row['type'], []).append(hdul[0].data)
+
+        dark = data['DARK'][0]
+        # Dark current of 0.25 ADU/s for 20 s, plus hot pixels.
+        assert abs(np.median(dark) - 5) < 1
+        assert dark.max() > 400
+        hot = np.argwhere(dark > 300)
+        assert (data['DARK'][1][tuple(hot.T)] > 300).all()
+
+        # Stars stand out of the object frames, and are dithered.
+        obj = data['OBJECT']
+        assert obj[0].max() > 10 * np.median(obj[0])
+        assert np.argmax(obj[0]) != np.argmax(obj[1])
+
+        # Flats show the flat field: vignetted corners.
+        flat = data['FLAT'][0]
+        assert flat[60:68, 60:68].mean() > 1.05 * flat[:8, :8].mean()
+
+    def test_reproducible(self):
+        self.generate(n_objects=1, n_flats=0, n_longdarks=0)
+        first = fits.getdata(os.path.join('data', 'N20190405S0001.fits'))
+        self.generate(n_objects=1, n_flats=0, n_longdarks=0)
+        assert (fits.getdata(
+            os.path.join('data', 'N20190405S0001.fits')) == first).all()
+
+    def test_finder(self):
+        """
+        The Finder finds a generated stack served by the local CADC.
+        """
+        catalog = self.generate(n_objects=3, n_flats=3, n_longdarks=3)
+        state = {
+            'config': {
+                'DATAFINDER': {
+                    'min_objects': '3',
+                    'min_flats': '3',
+                    'min_longdarks': '3',
+                    'min_shortdarks': '0',
+                    'max_tries': '1'
+                },
+                'DATARETRIEVAL': {}
+            },
+            'current_stack': {
+                'obs_name': 'GN-2019A-FT-108-12',
+                'bandpass': 'J'
+            }
+        }
+        with LocalCadc(niriPipe.utils.localcadc.read_catalog(
+                os.path.join('data', 'catalog.ecsv'))) as server:
+            state['config']['DATARETRIEVAL']['datasource'] = server.url
+            table = Finder(state).run()
+        assert sorted(table['productID']) == sorted(catalog['productID'])
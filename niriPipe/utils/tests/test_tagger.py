@@ -70,6 +70,8 @@ from unittest.mock import patch
 import pytest
 import os
 import logging
+import numpy as np
+import astropy.io.fits as fits
 from niriPipe.utils.tagger import Tagger
 import niriPipe.utils.customLogger
 
@@ -121,6 +123,42 @@ def get_products(
     return products
 
 
+def make_product(filename, fill_header=False, shape=(16, 16),
+                 reserve=Tagger.reserved_cards):
+    """
+    Write a small SCI/VAR/DQ product like DRAGONS makes.
+
+    With fill_header, the primary header fills its last block exactly
+    apart from reserve blank cards.
+    """
+    phu = fits.PrimaryHDU()
+    if fill_header:
+        n_cards = 36 * 4 - 1 - reserve - len(phu.header)
+        for i in range(n_cards):
+            phu.header['HIERARCH FAKE{}'.format(i)] = i
+        Tagger.reserve_cards(phu.header, reserve)
+    hdul = fits.HDUList([
+        phu,
+        fits.ImageHDU(np.ones(shape, dtype=np.float32), name='SCI'),
+        fits.ImageHDU(np.ones(shape, dtype=np.float32), name='VAR'),
+        fits.ImageHDU(np.zeros(shape, dtype=np.uint16), name='DQ'),
+    ])
+    hdul.writeto(filename)
+    return filename
+
+
+class FakeAstroData:
+    """
+    Just enough of an AstroData object for the Tagger.
+    """
+    def __init__(self):
+        self.phu = fits.Header()
+        self.written = []
+
+    def write(self, filename, overwrite=False):
+        self.written.append(filename)
+
+
 class TestTagger(unittest.TestCase):
     """
     Test the Tagger class.
@@ -152,7 +190,7 @@ class TestTagger(unittest.TestCase):
                         min_shortdarks='0'
                     )
         )
-        with patch('astropy.io.fits.setval'):
+        with patch('astropy.io.fits.open'):
             with self._caplog.at_level(logging.DEBUG):
                 tagger.run()
 
@@ -180,7 +218,7 @@ class TestTagger(unittest.TestCase):
                 )
         )
         with self._caplog.at_level(logging.DEBUG):
-            with patch('astropy.io.fits.setval'):
+            with patch('astropy.io.fits.open'):
                 tagger.run()
 
         assert 'Setting SOFTWARE' in self._caplog.text
@@ -200,7 +238,125 @@ class TestTagger(unittest.TestCase):
         self._caplog.clear()
         tagger = Tagger(products=products, state=get_state())
         with self._caplog.at_level(logging.DEBUG):
-            with patch('astropy.io.fits.setval'):
+            with patch('astropy.io.fits.open'):
                 tagger.run()
 
         assert 'Setting BPMIMG' in self._caplog.text
+
+    def test_tagger_in_memory(self):
+        """
+        Products still in memory get all keywords, then are written once.
+        """
+        ad = FakeAstroData()
+        products = get_products()
+
+        tagger = Tagger(
+            products=products,
+            state=get_state(),
+            ad_products={'processed_stack': ad}
+        )
+        with patch('astropy.io.fits.open') as fits_open:
+            tagger.run()
+
+        assert ad.phu['SOFTWARE'] == 'niriPipe'
+        assert ad.phu['BPMIMG'] == 'N2019_bpm.fits'
+        assert ad.written == ['/fake/path/N2019_stack.fits']
+        # The other products are still tagged on disk.
+        assert '/fake/path/N2019_stack.fits' not in [
+            c[0][0] for c in fits_open.call_args_list]
+        assert '/fake/path/N2019_flat.fits' in [
+            c[0][0] for c in fits_open.call_args_list]
+
+    def test_tagger_single_open(self):
+        """
+        Each product should be opened once, with all cards set in it.
+        """
+        products = {}
+        for name in ['flat', 'dark', 'bpm', 'stack']:
+            products['processed_' + name] = make_product(
+                'N2019_{}.fits'.format(name))
+
+        tagger = Tagger(products=products, state=get_state())
+        tagger.state['config']['TAGGING'] = {'max_workers': '4'}
+        with patch('astropy.io.fits.open', wraps=fits.open) as fits_open:
+            tagger.run()
+
+        assert sorted(c[0][0] for c in fits_open.call_args_list) == \
+            sorted(products.values())
+        for filename in products.values():
+            header = fits.getheader(filename)
+            assert header['BPMIMG'] == 'N2019_bpm.fits'
+            assert header['SOFTWARE'] == 'niriPipe'
+            assert header['SOFT_VER'] == '0.1'
+            assert header['SOFT_DOI'] == '10.5281/zenodo.4729003'
+
+    def test_tagger_reserved_cards_in_place(self):
+        """
+        With reserved blank cards, tagging a full header shouldn't grow it.
+        """
+        filename = make_product('N2019_stack.fits', fill_header=True)
+        size = os.path.getsize(filename)
+
+        tagger = Tagger(
+            products=get_products(processed_stack=filename),
+            state=get_state(
+                min_flats='0', min_longdarks='0', min_shortdarks='0'))
+        tagger.run()
+
+        assert os.path.getsize(filename) == size
+        assert fits.getval(filename, 'SOFT_DOI') == '10.5281/zenodo.4729003'
+
+    def test_reserve_file_cards(self):
+        """
+        A full header written by someone else gets room for the Tagger's
+        cards, and is then tagged in place; one with room is left alone.
+        """
+        filename = make_product('N2019_stack.fits', fill_header=True,
+                                reserve=0)
+        size = os.path.getsize(filename)
+        assert Tagger.reserve_file_cards(filename) == filename
+        assert os.path.getsize(filename) == size + 2880
+        with fits.open(filename) as hdul:
+            assert hdul['PRIMARY'].header['FAKE0'] == 0
+            assert (hdul['SCI'].data == 1).all()
+            assert (hdul['DQ'].data == 0).all()
+
+        size = os.path.getsize(filename)
+        Tagger(
+            products=get_products(processed_stack=filename),
+            state=get_state(
+                min_flats='0', min_longdarks='0', min_shortdarks='0')
+        ).run()
+        assert os.path.getsize(filename) == size
+        assert fits.getval(filename, 'SOFTWARE') == 'niriPipe'
+
+        filename = make_product('N2019_flat.fits', fill_header=True)
+        inode = os.stat(filename).st_ino
+        os.mkdir('products')
+        dest = Tagger.reserve_file_cards(
+            filename, os.path.join('products', filename))
+        assert dest == os.path.join('products', filename)
+        assert os.stat(dest).st_ino == inode
+        assert not os.path.exists(filename)
+
+        with open('not_fits.fits', 'w') as f:
+            f.write('fake')
+        with pytest.raises(ValueError):
+            Tagger.reserve_file_cards('not_fits.fits')
+
+    def test_tagger_checksum(self):
+        """
+        With checksums on, every HDU gets valid CHECKSUM/DATASUM cards.
+        """
+        filename = make_product('N2019_stack.fits')
+        tagger = Tagger(
+            products=get_products(processed_stack=filename),
+            state=get_state(
+                min_flats='0', min_longdarks='0', min_shortdarks='0'))
+        tagger.state['config']['TAGGING'] = {'checksum': 'True'}
+        tagger.run()
+
+        with fits.open(filename, checksum=True) as hdul:
+            for hdu in hdul:
+                assert hdu.verify_checksum() == 1
+                assert hdu.verify_datasum() == 1
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import json
+import logging
+from niriPipe.utils.timing import PrimitiveTimer, ProductTimer, write_report
+
+
+class TestTiming(unittest.TestCase):
+    """
+    Test the reduction timing helpers.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_primitive_timer(self):
+        """
+        Nested PRIMITIVE/"." messages should become timed primitives.
+        """
+        logger = logging.getLogger('fake_dragons')
+        logger.setLevel(logging.INFO)
+        timer = PrimitiveTimer()
+        logger.addHandler(timer)
+        try:
+            logger.info("PRIMITIVE: prepare")
+            logger.info("------------------")
+            logger.info("   PRIMITIVE: validateData")
+            logger.info("   .")
+            logger.info(".")
+            logger.info("PRIMITIVE: stackFrames")
+        finally:
+            logger.removeHandler(timer)
+
+        names = [p['name'] for p in timer.primitives]
+        assert names == ['prepare', 'validateData', 'stackFrames']
+        assert timer.primitives[0]['depth'] == 0
+        assert timer.primitives[1]['depth'] == 1
+        assert timer.primitives[0]['wall_seconds'] >= 0
+        # stackFrames never finished.
+        assert timer.primitives[2]['wall_seconds'] is None
+
+    def test_product_timer(self):
+        """
+        ProductTimer should report even if the timed block fails.
+        """
+        timer = ProductTimer('processed_flat')
+        with pytest.raises(RuntimeError):
+            with timer:
+                logging.getLogger('fake_dragons').warning(
+                    "PRIMITIVE: addDQ")
+                raise RuntimeError("DRAGONS failed")
+
+        assert timer.report['product'] == 'processed_flat'
+        assert not timer.report['succeeded']
+        assert timer.report['wall_seconds'] >= 0
+        assert timer.report['cpu_seconds'] >= 0
+        assert timer.report['peak_rss_mb'] > 0
+        assert timer.report['primitives'][0]['name'] == 'addDQ'
+        # Handler should be removed again.
+        assert timer._primitive_timer not in logging.getLogger().handlers
+
+    def test_write_report(self):
+        write_report('timing.json', [{'product': 'foo'}], obs_name='GN-X')
+        with open('timing.json') as f:
+            report = json.load(f)
+        assert report['obs_name'] == 'GN-X'
+        assert report['products'][0]['product'] == 'foo'
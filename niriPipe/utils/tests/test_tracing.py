@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import concurrent.futures
+import json
+import niriPipe.utils.tracing as tracing
+
+
+def read_spans(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestTracing(unittest.TestCase):
+    """
+    Class for testing tracing spans.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+        yield
+        tracing.stop_tracing()
+
+    def test_nested_spans(self):
+        """
+        Spans nest, and are written as they finish.
+        """
+        trace_id = tracing.start_tracing('trace.jsonl')
+        with tracing.span('pipeline') as outer:
+            assert tracing.current_span() is outer
+            with tracing.span('download', product_id='foo') as inner:
+                inner.set(bytes=10)
+                inner.increment('retries')
+                inner.increment('retries')
+        assert tracing.current_span() is None
+        tracing.stop_tracing()
+
+        download, pipeline = read_spans('trace.jsonl')
+        assert download['name'] == 'download'
+        assert download['parent_id'] == pipeline['span_id']
+        assert download['attributes'] == {
+            'product_id': 'foo', 'bytes': 10, 'retries': 2}
+        assert pipeline['parent_id'] is None
+        assert download['trace_id'] == pipeline['trace_id'] == trace_id
+        assert download['status'] == 'ok'
+        assert pipeline['duration'] >= download['duration'] >= 0
+
+    def test_failed_span(self):
+        tracing.start_tracing('trace.jsonl')
+        with pytest.raises(RuntimeError):
+            with tracing.span('tap_query'):
+                raise RuntimeError("Fake failure...")
+        tracing.stop_tracing()
+
+        span, = read_spans('trace.jsonl')
+        assert span['status'] == 'error'
+        assert span['attributes']['error'] == 'RuntimeError: Fake failure...'
+
+    def test_explicit_parent(self):
+        """
+        Spans in other threads are parented explicitly.
+        """
+        tracing.start_tracing('trace.jsonl')
+        with tracing.span('tagger') as parent:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                pool.submit(self._traced, parent).result()
+        tracing.stop_tracing()
+
+        spans = read_spans('trace.jsonl')
+        assert [span['name'] for span in spans] == ['fits_update', 'tagger']
+        assert spans[0]['parent_id'] == spans[1]['span_id']
+        assert spans[0]['thread'] != spans[1]['thread']
+
+    @staticmethod
+    def _traced(parent):
+        with tracing.span('fits_update', parent=parent):
+            pass
+
+    def test_disabled(self):
+        """
+        Without a trace file, spans are still usable but not written.
+        """
+        assert tracing.start_tracing('') is None
+        with tracing.span('pipeline') as span:
+            span.set(rows=1)
+        assert span.duration is not None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+
+import unittest
+import pytest
+import os
+import json
+import signal
+from niriPipe.utils.worker import JobQueue, Worker
+
+
+def fake_pipeline(state):
+    """
+    Stands in for niriReduce.run_pipeline; fails for K band.
+    """
+    if state['current_stack']['bandpass'] == 'K':
+        raise RuntimeError("Not enough flats.")
+    return {'processed_stack': os.path.abspath('stack.fits')}
+
+
+def draining_pipeline(state):
+    """
+    Asks the worker (the parent process) to drain while a job runs.
+    """
+    os.kill(os.getppid(), signal.SIGTERM)
+    return fake_pipeline(state)
+
+
+def crashing_pipeline(state):
+    """
+    Kills its pool process the first time it runs a stack.
+    """
+    if not os.path.exists('crashed'):
+        open('crashed', 'w').close()
+        os._exit(1)
+    return fake_pipeline(state)
+
+
+class TestWorker(unittest.TestCase):
+    """
+    Class for testing the job queue and worker.
+    """
+    @pytest.fixture(autouse=True)
+    def initdir(self, tmpdir):
+        tmpdir.chdir()
+
+    def test_queue(self):
+        queue = JobQueue('jobs.sqlite')
+        first = queue.submit('GN-2019A-FT-108-10', 'science', 'J')
+        second = queue.submit('GN-2019A-FT-108-11', 'science', 'H')
+
+        # Another process sees the same queue.
+        other = JobQueue('jobs.sqlite')
+        assert other.claim('a')['id'] == first
+        assert queue.claim('b')['id'] == second
+        assert queue.claim('a') is None
+
+        queue.finish(first, {'succeeded': True, 'directory': 'foo',
+                             'products': {'processed_stack': 'stack.fits'}})
+        assert [j['id'] for j in queue.jobs('succeeded')] == [first]
+        assert json.loads(queue.jobs('succeeded')[0]['products']) == \
+            {'processed_stack': 'stack.fits'}
+
+        # Only the given worker's running jobs are requeued.
+        assert queue.recover('a') == 0
+        assert queue.recover('b') == 1
+        assert [j['id'] for j in queue.jobs('queued')] == [second]
+
+    def test_worker(self):
+        """
+        A worker should run every queued job and record the results.
+        """
+        queue = JobQueue('jobs.sqlite')
+        for bandpass in ['J', 'K', 'H']:
+            queue.submit('GN-2019A-FT-108-10', 'science', bandpass)
+
+        worker = Worker(pipeline=fake_pipeline, queue=queue,
+                        directory='work', concurrency=2,
+                        poll_interval=0.1, exit_when_empty=True)
+        assert worker.run() == 3
+
+        jobs = queue.jobs()
+        assert [j['status'] for j in jobs] == \
+            ['succeeded', 'failed', 'succeeded']
+        assert 'Not enough flats' in jobs[1]['error']
+        assert json.loads(jobs[0]['products'])['processed_stack'] == \
+            os.path.join(jobs[0]['directory'], 'stack.fits')
+        assert len(set(j['directory'] for j in jobs)) == 3
+
+    def test_worker_drain(self):
+        """
+        On SIGTERM, running jobs finish but no new ones are started.
+        """
+        queue = JobQueue('jobs.sqlite')
+        for bandpass in ['J', 'H']:
+            queue.submit('GN-2019A-FT-108-10', 'science', bandpass)
+
+        worker = Worker(pipeline=draining_pipeline, queue=queue,
+                        directory='work', concurrency=1, poll_interval=0.1)
+        assert worker.run() == 1
+        assert worker.draining
+        assert [j['status'] for j in queue.jobs()] == ['succeeded', 'queued']
+
+    def test_worker_broken_pool(self):
+        """
+        Jobs lost when a pool process dies are requeued and run in a new
+        pool.
+        """
+        queue = JobQueue('jobs.sqlite')
+        for bandpass in ['J', 'H']:
+            queue.submit('GN-2019A-FT-108-10', 'science', bandpass)
+
+        worker = Worker(pipeline=crashing_pipeline, queue=queue,
+                        directory='work', concurrency=1,
+                        poll_interval=0.1, exit_when_empty=True)
+        assert worker.run() == 4
+
+        assert [j['status'] for j in queue.jobs()] == \
+            ['succeeded', 'succeeded']
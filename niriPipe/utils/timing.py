@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+import json
+import logging
+import re
+import resource
+import sys
+import time
+
+
+class PrimitiveTimer(logging.Handler):
+    """
+    Logging handler that times DRAGONS primitives.
+
+    DRAGONS announces each primitive with a "PRIMITIVE: <name>" status
+    message and closes it with a lone "." message; primitives called
+    from other primitives are nested between those two messages. While
+    attached to the root logger (which is where DRAGONS logs to), this
+    handler turns those boundaries into a list of timed primitives.
+    """
+    start_pattern = re.compile(r'^\s*PRIMITIVE:\s*(\w+)')
+    end_pattern = re.compile(r'^\s*\.\s*$')
+
+    def __init__(self):
+        super().__init__()
+        self.primitives = []
+        self._open = []
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+
+        start = self.start_pattern.match(message)
+        if start:
+            primitive = {
+                'name': start.group(1),
+                'depth': len(self._open),
+                'wall_seconds': None
+            }
+            self.primitives.append(primitive)
+            self._open.append((primitive, record.created))
+        elif self.end_pattern.match(message) and self._open:
+            primitive, started = self._open.pop()
+            primitive['wall_seconds'] = record.created - started
+
+
+class ProductTimer:
+    """
+    Records wall time, CPU time and peak RSS for one reduction product.
+
+    Use as a context manager around the DRAGONS call; afterwards the
+    measurements are available as a JSON-friendly dict in self.report.
+    Peak RSS is the high-water mark of the whole process, so it can only
+    grow from one product to the next.
+    """
+    def __init__(self, product_name):
+        self.product_name = product_name
+        self.report = None
+        self._primitive_timer = PrimitiveTimer()
+
+    def __enter__(self):
+        logging.getLogger().addHandler(self._primitive_timer)
+        self._wall_start = time.time()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self._wall_start
+        cpu = time.process_time() - self._cpu_start
+        logging.getLogger().removeHandler(self._primitive_timer)
+
+        self.report = {
+            'product': self.product_name,
+            'succeeded': exc_type is None,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'primitives': self._primitive_timer.primitives
+        }
+        return False
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process, in megabytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform == 'darwin':
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+
+def write_report(filename, reports, **metadata):
+    """
+    Write a list of ProductTimer reports to a JSON file.
+    """
+    out = dict(metadata)
+    out['products'] = reports
+    with open(filename, 'w') as f:
+        json.dump(out, f, sort_keys=True, indent=4)
+    return filename
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Tracing of a pipeline run.
+
+A span is a timed operation (a pipeline stage, a TAP query, a download,
+...) with attributes. Finished spans are logged as records to the
+'niriPipe.trace' logger, which doesn't propagate to the console; while
+tracing (start_tracing()), a handler writes them to a file as JSON lines.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import niriPipe.utils.customLogger
+
+_trace_logger = niriPipe.utils.customLogger.get_logger(
+    '{}.trace'.format(niriPipe.utils.customLogger.niriPipe_root_logger.name))
+_trace_logger.propagate = False
+_trace_logger.setLevel(logging.INFO)
+_trace_id = uuid.uuid4().hex
+_local = threading.local()
+# Handlers added by start_tracing().
+_span_handlers = []
+
+
+class Span:
+    """
+    A timed operation with attributes; see span().
+    """
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else _trace_id
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def increment(self, key, n=1):
+        self.attributes[key] = self.attributes.get(key, 0) + n
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'status': self.status,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'attributes': self.attributes,
+        }
+
+
+class SpanFileHandler(logging.FileHandler):
+    """
+    Writes spans as JSON lines.
+    """
+    def format(self, record):
+        return json.dumps(record.span, default=str)
+
+
+def current_span():
+    """
+    Innermost open span in this thread, or None.
+    """
+    spans = getattr(_local, 'spans', None)
+    return spans[-1] if spans else None
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Trace the body of the with statement as a span; yields the Span, to
+    add attributes to.
+
+    Spans nest within a thread. Pass parent explicitly for work handed to
+    other threads (e.g. parent=current_span() when submitting to a pool).
+    An exception marks the span as an error and is re-raised.
+    """
+    new_span = Span(name, parent or current_span(), attributes)
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    _local.spans.append(new_span)
+    start = time.perf_counter()
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = 'error'
+        new_span.attributes['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        new_span.duration = time.perf_counter() - start
+        _local.spans.pop()
+        if _span_handlers:
+            _trace_logger.info(new_span.name,
+                               extra={'span': new_span.to_dict()})
+
+
+def start_tracing(filename):
+    """
+    Start a new trace, appending its spans to filename; returns the trace
+    id. Does nothing (and returns None) if filename is empty.
+    """
+    global _trace_id
+    stop_tracing()
+    if not filename:
+        return None
+    _trace_id = uuid.uuid4().hex
+    handler = SpanFileHandler(filename)
+    _span_handlers.append(handler)
+    _trace_logger.addHandler(handler)
+    return _trace_id
+
+
+def stop_tracing():
+    while _span_handlers:
+        handler = _span_handlers.pop()
+        _trace_logger.removeHandler(handler)
+        handler.close()
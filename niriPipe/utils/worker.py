@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2021.                            (c) 2021.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#
+# ***********************************************************************
+"""
+Long-running worker pulling stacks from a durable local job queue.
+"""
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import json
+import os
+import signal
+import socket
+import sqlite3
+import time
+import niriPipe.utils.batch
+import niriPipe.utils.customLogger
+import niriPipe.utils.metrics
+
+
+class JobQueue:
+    """
+    A queue of stacks to process, kept in an SQLite database so jobs
+    survive restarts and can be submitted from other processes.
+
+    Jobs go from 'queued' to 'running' when a worker claims them, then to
+    'succeeded' or 'failed'.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            obsID TEXT NOT NULL,
+            intent TEXT NOT NULL,
+            bandpass TEXT NOT NULL,
+            config TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'queued',
+            worker TEXT,
+            submitted REAL,
+            started REAL,
+            finished REAL,
+            directory TEXT,
+            error TEXT,
+            products TEXT
+        )
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with self._connect() as connection:
+            connection.execute(self.schema)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per operation: connections can't be shared between
+        # threads or processes, and workers and submitters are separate.
+        # Changes are committed (or rolled back on errors), then the
+        # connection is closed.
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def submit(self, obsID, intent, bandpass, config=''):
+        """
+        Add a stack to the queue and return its job id.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (obsID, intent, bandpass, config, "
+                "submitted) VALUES (?, ?, ?, ?, ?)",
+                (obsID, intent, bandpass, config or '', time.time()))
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Mark the oldest queued job as running and return it, or None if
+        nothing is queued.
+        """
+        with self._connect() as connection:
+            # Take the write lock before reading, so two workers can't
+            # claim the same job.
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                "ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, "
+                    "started = ? WHERE id = ?",
+                    (worker, time.time(), row['id']))
+        return dict(row) if row is not None else None
+
+    def finish(self, job_id, result):
+        """
+        Record the result of a job (see niriPipe.utils.batch.run_stack()).
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, directory = ?, "
+                "error = ?, products = ? WHERE id = ?",
+                ('succeeded' if result['succeeded'] else 'failed',
+                 time.time(), result.get('directory'), result.get('error'),
+                 json.dumps(result.get('products')), job_id))
+
+    def requeue(self, job_id):
+        """
+        Put a running job back in the queue, to be claimed again.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, "
+                "started = NULL WHERE id = ? AND status = 'running'",
+                (job_id,))
+
+    def recover(self, worker):
+        """
+        Requeue jobs a worker left running (e.g. it was killed); returns
+        how many.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, "
+                "started = NULL WHERE status = 'running' AND worker = ?",
+                (worker,))
+            return cursor.rowcount
+
+    def jobs(self, status=None):
+        """
+        All jobs, or those with a given status, oldest first.
+        """
+        with self._connect() as connection:
+            if status is None:
+                rows = connection.execute(
+                    "SELECT * FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id",
+                    (status,)).fetchall()
+        return [dict(row) for row in rows]
+
+
+class Worker:
+    """
+    Runs queued stacks until told to stop.
+
+    Everything is imported once, in the worker; stacks then run in a pool
+    of processes forked from it, each in its own working directory under
+    the worker directory, sharing caches like a batch does. On SIGTERM or
+    SIGINT the worker drains: it claims no new jobs, waits for running
+    ones to finish and records their results, then exits.
+
+    If a pool process dies (e.g. it is killed, or DRAGONS crashes the
+    interpreter), the pool can't run anything more: jobs it was running
+    are requeued, up to max_requeues times each, and a new pool is
+    started.
+
+    Parameters
+    ----------
+    pipeline: callable
+        Runs one stack given its initial state; must be picklable.
+    queue: JobQueue
+        Queue to take jobs from.
+    directory: str
+        Worker directory.
+    concurrency: int
+        Number of stacks to run at once.
+    configfile: str
+        Config file for jobs that don't name their own.
+    poll_interval: float
+        Seconds between checks for new jobs when idle.
+    exit_when_empty: bool
+        Exit once the queue is empty and nothing is running, instead of
+        waiting for more jobs.
+    name: str
+        Worker name recorded with its jobs; must be stable across restarts
+        for recover() to find jobs left running. Defaults to the host name
+        and worker directory.
+    metrics_interval: float
+        Seconds between snapshots of the metrics of all jobs run, written
+        to niriPipe.prom in the worker directory.
+    queue_logging: bool
+        Send the jobs' log records to this process through a queue, rather
+        than having each process write them to stderr.
+    """
+    metrics_name = 'niriPipe.prom'
+    max_requeues = 2
+
+    def __init__(self, pipeline, queue, directory='.', concurrency=1,
+                 configfile=None, poll_interval=5, exit_when_empty=False,
+                 name=None, metrics_interval=60, queue_logging=False):
+        self.pipeline = pipeline
+        self.queue = queue
+        self.directory = os.path.abspath(directory)
+        self.concurrency = max(1, concurrency)
+        self.configfile = os.path.abspath(configfile) if configfile \
+            else None
+        self.poll_interval = poll_interval
+        self.exit_when_empty = exit_when_empty
+        self.name = name or '{}:{}'.format(
+            socket.gethostname(), self.directory)
+        self.draining = False
+        self.metrics = niriPipe.utils.metrics.PeriodicWriter(
+            niriPipe.utils.metrics.REGISTRY,
+            os.path.join(self.directory, self.metrics_name),
+            metrics_interval)
+        self.queue_logging = queue_logging
+        self._log_queue = None
+        self._requeues = collections.Counter()
+        self.logger = niriPipe.utils.customLogger.get_logger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+    def drain(self, signum=None, frame=None):
+        """
+        Stop claiming jobs; the worker exits once running jobs finish.
+        """
+        if not self.draining:
+            self.logger.info(
+                "Draining: waiting for running jobs, then exiting.")
+        self.draining = True
+
+    def run(self):
+        """
+        Process jobs until drained (or the queue is empty, with
+        exit_when_empty). Returns the number of jobs run.
+        """
+        caches = niriPipe.utils.batch.shared_caches(self.directory)
+        recovered = self.queue.recover(self.name)
+        if recovered:
+            self.logger.warning(
+                "Requeued {} jobs left running by a previous run.".format(
+                    recovered))
+
+        with niriPipe.utils.customLogger.log_context(worker=self.name):
+            handlers = {
+                signum: signal.signal(signum, self.drain)
+                for signum in (signal.SIGTERM, signal.SIGINT)
+            }
+            self.logger.info(
+                "Worker {} started, running {} jobs at once.".format(
+                    self.name, self.concurrency))
+            n_jobs = 0
+            try:
+                with niriPipe.utils.batch.log_aggregator(
+                        self.queue_logging) as self._log_queue:
+                    broken = True
+                    while broken:
+                        n_pool_jobs, broken = self._run_pool(caches)
+                        n_jobs += n_pool_jobs
+            finally:
+                self.metrics.write()
+                for signum, handler in handlers.items():
+                    signal.signal(signum, handler)
+            self.logger.info("Worker {} stopped after {} jobs.".format(
+                self.name, n_jobs))
+        return n_jobs
+
+    def _run_pool(self, caches):
+        """
+        Run jobs in a new process pool until drained (or the queue is
+        empty, with exit_when_empty) or the pool breaks; returns the number
+        of jobs started and whether the pool broke.
+        """
+        n_jobs = 0
+        running = {}
+        broken = False
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.concurrency) as pool:
+            while True:
+                while not (self.draining or broken) and \
+                        len(running) < self.concurrency:
+                    job = self.queue.claim(self.name)
+                    if job is None:
+                        break
+                    try:
+                        future = self._submit(pool, job, caches)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        self.queue.requeue(job['id'])
+                        broken = True
+                        break
+                    running[future] = job
+                    n_jobs += 1
+
+                if not running:
+                    if broken:
+                        break
+                    if self.draining or self.exit_when_empty:
+                        return n_jobs, False
+                    time.sleep(self.poll_interval)
+                    continue
+
+                done, _ = concurrent.futures.wait(
+                    running, timeout=self.poll_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    broken |= isinstance(
+                        future.exception(),
+                        concurrent.futures.process.BrokenProcessPool)
+                    self._finish(running.pop(future), future)
+                self.metrics.maybe_write()
+
+        self.logger.warning("A pool process died; starting a new pool.")
+        return n_jobs, True
+
+    def _submit(self, pool, job, caches):
+        self.logger.info("Starting job {}: {} {} {}".format(
+            job['id'], job['obsID'], job['intent'], job['bandpass']))
+        stack = {key: job[key] for key in
+                 niriPipe.utils.batch.MANIFEST_COLUMNS + ['config']}
+        directory = os.path.join(self.directory, '{}_{}'.format(
+            job['id'], niriPipe.utils.batch.stack_directory(stack)))
+        return pool.submit(
+            niriPipe.utils.batch.run_stack, self.pipeline, stack,
+            directory, self.configfile, caches, self._log_queue,
+            niriPipe.utils.customLogger.get_context())
+
+    def _finish(self, job, future):
+        try:
+            result = future.result()
+            niriPipe.utils.batch.pop_metrics(result)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # The job may have been killed with another job's process.
+            self._requeues[job['id']] += 1
+            if self._requeues[job['id']] <= self.max_requeues:
+                self.logger.warning(
+                    "Requeueing job {}, lost with its pool.".format(
+                        job['id']))
+                self.queue.requeue(job['id'])
+                return
+            result = {'succeeded': False,
+                      'error': '{}: {}'.format(type(e).__name__, e)}
+        except Exception as e:
+            # run_stack() doesn't raise, so the pool process itself died.
+            result = {'succeeded': False,
+                      'error': '{}: {}'.format(type(e).__name__, e)}
+        self.queue.finish(job['id'], result)
+        if result['succeeded']:
+            self.logger.info("Job {} succeeded.".format(job['id']))
+        else:
+            self.logger.error("Job {} failed: {}".format(
+                job['id'], result['error']))
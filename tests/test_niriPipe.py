@@ -66,10 +66,46 @@
 #
 # ***********************************************************************
 #
+import argparse
+import logging
 import subprocess
+import sys
+from unittest.mock import patch
 import pkg_resources
 import os
 import configparser
+import niriPipe.niriReduce
+import niriPipe.utils.customLogger
+
+# Modules too slow to import on every invocation; only subcommands that
+# run a pipeline may import them.
+SLOW_MODULES = [
+    'astroquery', 'cadcdata', 'astrodata', 'gemini_instruments',
+    'recipe_system', 'pkg_resources'
+]
+# Budget for importing the CLI module, in seconds (typically ~10 ms).
+IMPORT_BUDGET = 0.5
+
+
+def import_time(module):
+    """
+    Seconds a fresh interpreter takes to import module, and the modules
+    that import adds (beyond those loaded at startup).
+
+    Timed directly rather than with -X importtime, which needs Python 3.7.
+    """
+    code = (
+        "import sys, time\n"
+        "before = set(sys.modules)\n"
+        "start = time.time()\n"
+        "import {}\n"
+        "print(time.time() - start)\n"
+        "print(' '.join(sorted(set(sys.modules) - before)))\n"
+    ).format(module)
+    result = subprocess.run(
+        [sys.executable, '-c', code], stdout=subprocess.PIPE, check=True)
+    seconds, modules = result.stdout.decode().splitlines()
+    return float(seconds), modules.split()
 
 
 def test_console_help():
@@ -78,6 +114,13 @@ def test_console_help():
     assert result.returncode == 0
 
 
+def test_import_time():
+    seconds, modules = import_time('niriPipe.niriReduce')
+    slow = [name for name in modules if name.split('.')[0] in SLOW_MODULES]
+    assert not slow
+    assert seconds < IMPORT_BUDGET
+
+
 def test_default_config_present():
     config = configparser.ConfigParser()
     config.read(pkg_resources.resource_filename(
@@ -85,3 +128,20 @@ def test_default_config_present():
                 os.path.join('cfg', 'default_config.cfg')))
 
     assert 'DATARETRIEVAL' in config.sections()
+
+
+def test_run_verbose():
+    """
+    'run' only logs debug messages with -v.
+    """
+    root_logger = niriPipe.utils.customLogger.niriPipe_root_logger
+    level = root_logger.level
+    try:
+        for verbose, expected in [(False, level), (True, logging.DEBUG)]:
+            with patch('niriPipe.niriReduce._initial_state'), \
+                    patch('niriPipe.niriReduce.run_pipeline'):
+                niriPipe.niriReduce.run_main(
+                    argparse.Namespace(verbose=verbose))
+            assert root_logger.level == expected
+    finally:
+        root_logger.setLevel(level)